@@ -0,0 +1,210 @@
+"""
+The async entry point for the application.
+
+Downloads from /files/<filename> and /public/<token>/<filename> are served
+natively on the event loop, with the storage calls run in a bounded thread
+pool, so a single worker can serve many slow downloads at the same time.
+Every other request, and every download that needs something the native
+path does not handle, is passed on to the Flask application.
+
+Run it with an ASGI server, for example:
+
+    uvicorn asgi:application
+"""
+
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.http import parse_cookie, parse_etags
+from werkzeug.http import parse_if_range_header, parse_range_header, unquote_etag
+from werkzeug.utils import secure_filename
+import asyncio
+import hmac
+import re
+
+from downloads import download_headers, plan_download
+from redwood import app, decode_identity, mimetype_from_extension
+from settings import load_environment_variable
+from storage import AsyncStorage, FileChangedError, get_backend
+
+FILES_PATH = re.compile(r'^/files/([^/]+)$')
+PUBLIC_PATH = re.compile(r'^/public/([^/]+)/([^/]+)$')
+
+async_storage = AsyncStorage(max_workers=app.config['ASYNC_STORAGE_MAX_WORKERS'])
+
+wsgi_application = WsgiToAsgi(app)
+
+
+def get_headers(scope):
+    """
+    Returns the request headers as a dict with lower case names.
+    """
+    return {name.decode('latin-1').lower(): value.decode('latin-1')
+            for name, value in scope['headers']}
+
+
+def is_logged_in(headers):
+    """
+    Checks if the request has a valid identity JWT, in the same places as
+    get_jwt_from_request.
+    """
+    identity_jwt = parse_cookie(headers.get('cookie', '')).get('identity_jwt')
+    identity_jwt = identity_jwt or headers.get('authorization')
+
+    return bool(identity_jwt) and decode_identity(identity_jwt) is not None
+
+
+def get_download_key(scope, headers):
+    """
+    Returns the key of the file to download natively, or None if the request
+    has to be handled by the Flask application.
+    """
+    if app.config['HTTPS_REQUIRED'] and headers.get('x-forwarded-proto') != 'https':
+        return None
+
+    match = FILES_PATH.match(scope['path'])
+    if match:
+        return match.group(1) if is_logged_in(headers) else None
+
+    match = PUBLIC_PATH.match(scope['path'])
+    if match:
+        expected_token = load_environment_variable('PUBLIC_FILE_TOKEN')
+        token = match.group(1)
+
+        if expected_token and hmac.compare_digest(token.encode('utf-8'),
+                                                  expected_token.encode('utf-8')):
+            return secure_filename(match.group(2))
+
+    return None
+
+
+def encode_headers(headers):
+    return [(name.encode('latin-1'), str(value).encode('latin-1'))
+            for name, value in headers.items()]
+
+
+async def send_response(send, status, headers, body=b''):
+    await send({'type': 'http.response.start',
+                'status': status,
+                'headers': encode_headers(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def wait_for_disconnect(receive):
+    """
+    Waits until the client has disconnected.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def serve_download(scope, receive, send):
+    """
+    Serves a download natively. Returns False without sending anything if
+    the request has to be handled by the Flask application.
+    """
+    headers = get_headers(scope)
+    key = get_download_key(scope, headers)
+
+    if not key:
+        return False
+
+    bucket_name = app.config['FILES_BUCKET']
+
+    # Files on the local disk are sent with sendfile by the Flask application.
+    if get_backend().local_path(bucket_name, key):
+        return False
+
+    info = await async_storage.stat(bucket_name, key)
+    if info is None:
+        return False
+
+    size = info['size']
+    mimetype = mimetype_from_extension(key)
+
+    if app.config['DOWNLOAD_REDIRECT'] and size >= app.config['DOWNLOAD_REDIRECT_MIN_SIZE']:
+        url = await async_storage.presigned_url(bucket_name, key, mimetype,
+                                                app.config['PRESIGNED_URL_EXPIRATION'])
+        if url:
+            await send_response(send, 302, {'Location': url, 'Content-Length': 0})
+            return True
+
+    etag, _ = unquote_etag(info['etag'])
+    last_modified = info['last_modified']
+
+    status, byte_range = plan_download(size, etag, last_modified,
+                                       parse_etags(headers.get('if-none-match')),
+                                       parse_range_header(headers.get('range')),
+                                       parse_if_range_header(headers.get('if-range')))
+    response_headers = download_headers(status, size, etag, last_modified, byte_range)
+
+    if status in (304, 416):
+        await send_response(send, status, response_headers)
+        return True
+
+    if byte_range is None:
+        length = size
+    else:
+        length = byte_range[1] - byte_range[0] + 1
+
+    response_headers['Content-Type'] = mimetype
+    response_headers['Content-Length'] = length
+
+    if scope['method'] == 'HEAD':
+        await send_response(send, status, response_headers)
+        return True
+
+    try:
+        stream = await async_storage.read_stream(bucket_name, key, byte_range=byte_range,
+                                                 etag=info['etag'])
+    except FileChangedError:
+        # The file was replaced after it was stat'ed. The Flask application
+        # starts over with the new file.
+        return False
+
+    # Sending to a client that has gone away does nothing, so the download
+    # is stopped when the client disconnects instead of reading the rest of
+    # the file from the backend.
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    chunks = async_storage.iter_chunks(stream, length, app.config['DOWNLOAD_BUFFER_SIZE'])
+
+    try:
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': encode_headers(response_headers)})
+
+        async for chunk in chunks:
+            if disconnected.done():
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        if not disconnected.done():
+            await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnected.cancel()
+        await chunks.aclose()
+        stream.close()
+
+    return True
+
+
+async def application(scope, receive, send):
+    """
+    The ASGI application.
+    """
+    if scope['type'] == 'lifespan':
+        # There is nothing to set up or tear down, but the server expects
+        # the lifespan messages to be answered.
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        if await serve_download(scope, receive, send):
+            return
+
+    await wsgi_application(scope, receive, send)
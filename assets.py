@@ -0,0 +1,274 @@
+from http_cache import gzip_bytes
+from util import file_digest, file_signature
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+
+# Brotli is optional. Without it only gzip variants are written.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ASSET_FOLDER = "static/"
+
+# The format version of the asset manifest.
+MANIFEST_VERSION = 2
+MANIFEST_FILENAME = 'manifest.json'
+
+# Only text assets are compressed. Images are already compressed.
+COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.html', '.txt', '.json'}
+
+# The file extensions used for the compressed variants.
+ENCODING_EXTENSIONS = {'br': '.br', 'gzip': '.gz'}
+
+# The preferred encodings, best first.
+ENCODINGS = ['br', 'gzip']
+
+
+def fingerprint(name, content):
+    """
+    Returns the name of an asset with a digest of its content inserted before
+    the extension, like styles/redwood.0123456789ab.css.
+    """
+    root, extension = os.path.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return '{}.{}{}'.format(root, digest, extension)
+
+def compress_variants(name, content):
+    """
+    Returns a dict that maps an encoding to the compressed content for every
+    encoding that makes the asset smaller.
+    """
+    if os.path.splitext(name)[1] not in COMPRESSIBLE_EXTENSIONS:
+        return {}
+
+    variants = {'gzip': gzip_bytes(content)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(content)
+
+    return {encoding: data for encoding, data in variants.items()
+            if len(data) < len(content)}
+
+def list_asset_names(folder):
+    """
+    Returns the sorted names of all the files in the asset folder, relative
+    to the folder and with / as separator.
+    """
+    names = []
+
+    for directory, _, filenames in os.walk(folder):
+        relative = os.path.relpath(directory, folder)
+        for filename in filenames:
+            if filename.startswith('.'):
+                continue
+            path = filename if relative == '.' else os.path.join(relative, filename)
+            names.append(path.replace(os.sep, '/'))
+
+    return sorted(names)
+
+def compile_assets(folder):
+    """
+    Reads all the assets in the folder. Returns a dict that maps the name of
+    every asset to a dict with the fingerprinted name, the mimetype, the
+    content of every variant and the signature and digest of the source
+    file.
+    """
+    assets = {}
+
+    for name in list_asset_names(folder):
+        path = os.path.join(folder, name)
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        variants = compress_variants(name, content)
+        variants['identity'] = content
+
+        assets[name] = {"path": fingerprint(name, content),
+                        "mimetype": mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                        "variants": variants,
+                        "signature": file_signature(path),
+                        "digest": file_digest(path)}
+
+    return assets
+
+def write_assets(output_folder, folder=ASSET_FOLDER):
+    """
+    Writes the fingerprinted assets, their compressed variants and a manifest
+    to the output folder. Returns the manifest.
+    """
+    assets = compile_assets(folder)
+    manifest = {}
+
+    for name, asset in assets.items():
+        path = os.path.join(output_folder, asset["path"])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        for encoding, content in asset["variants"].items():
+            with open(path + ENCODING_EXTENSIONS.get(encoding, ''), 'wb') as f:
+                f.write(content)
+
+        manifest[name] = {"path": asset["path"],
+                          "mimetype": asset["mimetype"],
+                          "encodings": sorted(asset["variants"]),
+                          "signature": asset["signature"],
+                          "digest": asset["digest"]}
+
+    temporary_filename = os.path.join(output_folder, MANIFEST_FILENAME + '.tmp')
+    with open(temporary_filename, 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "assets": manifest}, f, indent=4, sort_keys=True)
+    os.replace(temporary_filename, os.path.join(output_folder, MANIFEST_FILENAME))
+
+    return manifest
+
+
+class Asset:
+    """
+    A fingerprinted asset. Small assets keep the content of every variant in
+    memory, larger assets are read from the build folder.
+    """
+
+    def __init__(self, path, mimetype, variants, files):
+        self.path = path
+        self.mimetype = mimetype
+        # Maps an encoding to the content of the variant in memory.
+        self.variants = variants
+        # Maps an encoding to the filename of the variant on disk.
+        self.files = files
+
+    def encodings(self):
+        return set(self.variants) | set(self.files)
+
+    def choose_encoding(self, accept_encodings):
+        """
+        Picks the best encoding that the client accepts.
+        """
+        encodings = self.encodings()
+
+        for encoding in ENCODINGS:
+            if encoding in encodings and accept_encodings[encoding]:
+                return encoding
+
+        return 'identity'
+
+
+class AssetStore:
+    """
+    Serves the assets under fingerprinted urls.
+
+    The assets are loaded from the manifest written by write_assets. If
+    there is no manifest, or any file in the asset folder has been added,
+    removed or changed since the manifest was written, the assets are
+    compiled from the asset folder at startup instead. Variants up to
+    max_memory_size bytes are kept in memory.
+    """
+
+    def __init__(self, folder=ASSET_FOLDER, build_folder=None, max_memory_size=256*1024):
+        self.folder = folder
+        self.build_folder = build_folder
+        self.max_memory_size = max_memory_size
+
+        # Maps an asset name to its fingerprinted path.
+        self.paths = None
+        # Maps a fingerprinted path to the asset.
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def load_manifest(self):
+        if not self.build_folder:
+            return None
+
+        try:
+            with open(os.path.join(self.build_folder, MANIFEST_FILENAME)) as f:
+                manifest = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if manifest.get("version") != MANIFEST_VERSION:
+            return None
+
+        assets = manifest["assets"]
+        if sorted(assets) != list_asset_names(self.folder):
+            return None
+
+        for name, entry in assets.items():
+            path = os.path.join(self.folder, name)
+            signature = file_signature(path)
+            if signature is None:
+                return None
+
+            # The modification time changes when the files are copied, so
+            # the content is compared when the signature differs.
+            if list(signature) != entry["signature"] and file_digest(path) != entry["digest"]:
+                return None
+
+        return assets
+
+    def load(self):
+        """
+        Loads the assets. Does nothing if they are already loaded.
+        """
+        if self.paths is not None:
+            return
+
+        with self.lock:
+            if self.paths is not None:
+                return
+
+            paths = {}
+            assets = {}
+            manifest = self.load_manifest()
+
+            if manifest is not None:
+                for name, entry in manifest.items():
+                    variants = {}
+                    files = {}
+                    for encoding in entry["encodings"]:
+                        filename = os.path.join(self.build_folder, entry["path"] +
+                                                ENCODING_EXTENSIONS.get(encoding, ''))
+                        if os.path.getsize(filename) <= self.max_memory_size:
+                            with open(filename, 'rb') as f:
+                                variants[encoding] = f.read()
+                        else:
+                            files[encoding] = filename
+
+                    paths[name] = entry["path"]
+                    assets[entry["path"]] = Asset(entry["path"], entry["mimetype"], variants, files)
+            else:
+                for name, entry in compile_assets(self.folder).items():
+                    # Without a build folder every variant is kept in memory,
+                    # except the original of large assets which is on disk.
+                    variants = dict(entry["variants"])
+                    files = {}
+                    if len(variants['identity']) > self.max_memory_size:
+                        del variants['identity']
+                        files['identity'] = os.path.join(self.folder, name)
+
+                    paths[name] = entry["path"]
+                    assets[entry["path"]] = Asset(entry["path"], entry["mimetype"], variants, files)
+
+            self.assets = assets
+            self.paths = paths
+
+    def url(self, name):
+        """
+        Returns the fingerprinted url of an asset. Unknown assets are served
+        from the static folder.
+        """
+        self.load()
+        path = self.paths.get(name)
+
+        if path is None:
+            return '/static/' + name
+
+        return '/assets/' + path
+
+    def get(self, path):
+        """
+        Returns the asset with the fingerprinted path or None if there is no
+        such asset.
+        """
+        self.load()
+        return self.assets.get(path)
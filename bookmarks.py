@@ -1,45 +1,60 @@
-from util import load_json
+from util import load_json, file_signature, file_digest
+import base64
+import json
+import os
 import os.path
+import pickle
+import struct
+import threading
+import time
 
-def load_all_bookmarks():
-    filenames = [
-        "api.json",
-        "audio.json",
-        "bookmarks.json",
-        "c.json",
-        "clojure.json",
-        "commerce.json",
-        "compilers.json",
-        "database.json",
-        "design.json",
-        "driving.json",
-        "editors.json",
-        "erlang.json",
-        "games.json",
-        "graphics.json",
-        "go.json",
-        "hardware.json",
-        "infrastructure.json",
-        "javascript.json",
-        "linux.json",
-        "lisp.json",
-        "machine_learning.json",
-        "math.json",
-        "project_management.json",
-        "python.json",
-        "organization.json",
-        "other_languages.json",
-        "shell.json",
-        "software_engineering.json",
-        "swift.json",
-        "testing.json",
-        "web.json",
-    ]
+BOOKMARK_FOLDER = "bookmarks"
+
+# The bookmark bundle starts with a magic string and a format version. The
+# format version must be increased whenever the layout of the bundle changes.
+BUNDLE_MAGIC = b'RWBM'
+BUNDLE_VERSION = 1
+BUNDLE_HEADER = struct.Struct('>4sH')
+
+BOOKMARK_FILENAMES = [
+    "api.json",
+    "audio.json",
+    "bookmarks.json",
+    "c.json",
+    "clojure.json",
+    "commerce.json",
+    "compilers.json",
+    "database.json",
+    "design.json",
+    "driving.json",
+    "editors.json",
+    "erlang.json",
+    "games.json",
+    "graphics.json",
+    "go.json",
+    "hardware.json",
+    "infrastructure.json",
+    "javascript.json",
+    "linux.json",
+    "lisp.json",
+    "machine_learning.json",
+    "math.json",
+    "project_management.json",
+    "python.json",
+    "organization.json",
+    "other_languages.json",
+    "shell.json",
+    "software_engineering.json",
+    "swift.json",
+    "testing.json",
+    "web.json",
+]
 
+def load_all_bookmarks():
     result = []
 
-    for filename in filenames:
-        result.extend(load_bookmarks(os.path.join("bookmarks", filename)))
+    for filename in BOOKMARK_FILENAMES:
+        result.extend(load_bookmarks(os.path.join(BOOKMARK_FOLDER, filename)))
 
     return result
 
@@ -63,3 +78,305 @@ def load_bookmark_collections():
         collections[collection['slug']] = collection
 
     return collections
+
+def validate_bookmarks(bookmark_categories):
+    """
+    Validate a list of bookmark categories from the bookmarks.
+    """
+    errors = []
+    for collection in bookmark_categories:
+        slug = collection.get('slug', None)
+        category = collection.get('category', None)
+        visibility = collection.get('visibility', None)
+
+        if category is None:
+            errors.append("Missing category")
+
+        if slug is None:
+            if category is not None:
+                errors.append("Missing slug for category {}".format(category))
+            else:
+                errors.append("Missing slug")
+
+        if visibility is None:
+            if category is not None:
+                errors.append("Missing visibility for category {}".format(category))
+            elif slug is not None:
+                errors.append("Missing visibility for slug {}".format(slug))
+            else:
+                errors.append("Missing visibility")
+
+    return errors
+
+def encode_cursor(filename, ordinal):
+    """
+    Encodes the position of a bookmark collection as an opaque cursor. The
+    position is the bookmark file and the ordinal of the collection in the
+    file, so a cursor stays valid when collections are added to other files.
+    """
+    data = json.dumps([filename, ordinal], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Decodes a cursor created by encode_cursor into a (filename, ordinal)
+    tuple. Raises ValueError if the cursor is invalid.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        data = base64.urlsafe_b64decode((cursor + padding).encode('ascii'))
+        filename, ordinal = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor")
+
+    if not isinstance(filename, str) or not isinstance(ordinal, int):
+        raise ValueError("Invalid cursor")
+
+    return filename, ordinal
+
+def write_bookmark_bundle(bundle_filename, folder=BOOKMARK_FOLDER,
+                          filenames=BOOKMARK_FILENAMES):
+    """
+    Loads the given bookmark files and writes them to a single bundle file.
+    For every bookmark file the bundle stores the file signature, a digest of
+    the contents and the collections with ordinal and url already assigned.
+    """
+    files = {}
+    for filename in filenames:
+        path = os.path.join(folder, filename)
+        files[filename] = (file_signature(path),
+                           file_digest(path),
+                           load_bookmarks(path))
+
+    data = BUNDLE_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION)
+    data += pickle.dumps(files, protocol=4)
+
+    directory = os.path.dirname(bundle_filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temporary_filename = bundle_filename + '.tmp'
+    with open(temporary_filename, 'wb') as f:
+        f.write(data)
+    os.replace(temporary_filename, bundle_filename)
+
+    return files
+
+def load_bookmark_bundle(bundle_filename, folder=BOOKMARK_FOLDER):
+    """
+    Loads a bookmark bundle written by write_bookmark_bundle. Returns a dict
+    that maps a filename to a (signature, collections) tuple for every
+    bookmark file in the bundle that is still up to date. Returns an empty
+    dict if the bundle is missing or has the wrong format version.
+
+    A file whose signature has changed is still considered up to date if
+    the digest of its contents matches, since a deploy can change the
+    modification times without changing the files.
+    """
+    try:
+        with open(bundle_filename, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+
+    if len(data) < BUNDLE_HEADER.size:
+        return {}
+
+    magic, version = BUNDLE_HEADER.unpack_from(data)
+    if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+        return {}
+
+    try:
+        bundled_files = pickle.loads(data[BUNDLE_HEADER.size:])
+    except Exception:
+        return {}
+
+    result = {}
+    for filename, (signature, digest, collections) in bundled_files.items():
+        path = os.path.join(folder, filename)
+        current_signature = file_signature(path)
+
+        if current_signature is None:
+            continue
+
+        if current_signature != signature and file_digest(path) != digest:
+            continue
+
+        result[filename] = (current_signature, collections)
+
+    return result
+
+
+class BookmarkCatalog:
+    """
+    Keeps all the bookmark collections in memory so that a request does not
+    have to read and parse every bookmark file.
+
+    The bookmark files are checked for changes at most once every
+    reload_interval seconds. Only the files whose modification time or size
+    has changed are loaded again. The collections returned by the catalog are
+    shared between requests and must not be modified.
+
+    If a bundle filename is given the catalog starts from the bookmark bundle
+    and only parses the json files that are missing from the bundle or have
+    changed since the bundle was built.
+    """
+
+    def __init__(self, folder=BOOKMARK_FOLDER, filenames=BOOKMARK_FILENAMES,
+                 reload_interval=5, bundle_filename=None):
+        self.folder = folder
+        self.filenames = list(filenames)
+        self.reload_interval = reload_interval
+        self.bundle_filename = bundle_filename
+        self.version = 0
+
+        # Maps a filename to a (signature, collections) tuple.
+        self.files = {}
+        self.listeners = []
+        self.last_checked = None
+        self.lock = threading.Lock()
+
+        self.all = []
+        self.public = []
+        self.by_slug = {}
+        self.errors = []
+
+    def add_listener(self, listener):
+        """
+        Adds a listener that is called with the catalog and the list of
+        changed filenames every time the catalog has been reloaded.
+        """
+        self.listeners.append(listener)
+
+    def refresh(self, force=False):
+        """
+        Reloads the bookmark files that have changed since they were last
+        loaded. Returns True if anything was reloaded.
+        """
+        now = time.monotonic()
+        if not force and self.last_checked is not None:
+            if now - self.last_checked < self.reload_interval:
+                return False
+
+        with self.lock:
+            self.last_checked = now
+            changed = []
+
+            if not self.files and self.bundle_filename:
+                self.files = load_bookmark_bundle(self.bundle_filename, self.folder)
+                changed.extend(f for f in self.filenames if f in self.files)
+
+            for filename in self.filenames:
+                path = os.path.join(self.folder, filename)
+                signature = file_signature(path)
+                entry = self.files.get(filename)
+
+                if entry is None or entry[0] != signature:
+                    self.files[filename] = (signature, load_bookmarks(path))
+                    changed.append(filename)
+
+            if changed:
+                self._build_indexes()
+                self.version += 1
+
+        if changed:
+            for listener in self.listeners:
+                listener(self, changed)
+
+        return bool(changed)
+
+    def _build_indexes(self):
+        """
+        Rebuilds the list of all collections, the public collections and the
+        slug index from the loaded files.
+        """
+        all_collections = []
+        for filename in self.filenames:
+            all_collections.extend(self.files[filename][1])
+
+        by_slug = {}
+        for collection in all_collections:
+            by_slug[collection['slug']] = collection
+
+        self.errors = validate_bookmarks(all_collections)
+        self.public = [c for c in all_collections if c.get('visibility') == 'public']
+        self.by_slug = by_slug
+        self.all = all_collections
+
+    def current_version(self):
+        """
+        Returns the version of the catalog, which changes every time any of
+        the bookmark files is reloaded.
+        """
+        self.refresh()
+        return self.version
+
+    def all_collections(self):
+        """
+        Returns all the bookmark collections.
+        """
+        self.refresh()
+        return self.all
+
+    def public_collections(self):
+        """
+        Returns the bookmark collections with public visibility.
+        """
+        self.refresh()
+        return self.public
+
+    def get(self, slug):
+        """
+        Returns the bookmark collection with the given slug or None if there
+        is no such collection.
+        """
+        self.refresh()
+        return self.by_slug.get(slug)
+
+    def iter_collections(self, after=None):
+        """
+        Returns an iterator over (filename, collection) tuples for all
+        bookmark collections in catalog order. If after is a (filename,
+        ordinal) tuple the iterator starts after that position. Raises
+        ValueError if the file in the position is not in the catalog.
+        """
+        self.refresh()
+        files = [(filename, self.files[filename][1]) for filename in self.filenames]
+
+        if after is None:
+            return self._iter_files(files, None, None)
+
+        after_filename, after_ordinal = after
+        if after_filename not in self.filenames:
+            raise ValueError("Unknown bookmark file {}".format(after_filename))
+
+        start = self.filenames.index(after_filename)
+        return self._iter_files(files[start:], after_filename, after_ordinal)
+
+    def _iter_files(self, files, after_filename, after_ordinal):
+        for filename, collections in files:
+            for collection in collections:
+                if filename == after_filename and collection['ordinal'] <= after_ordinal:
+                    continue
+
+                yield filename, collection
+
+    def last_modified(self):
+        """
+        Returns the modification time of the most recently modified bookmark
+        file as seconds since the epoch.
+        """
+        self.refresh()
+        signatures = [signature for signature, _ in self.files.values() if signature]
+
+        if not signatures:
+            return None
+
+        return max(mtime for mtime, _ in signatures) / 1e9
+
+    def validation_errors(self):
+        """
+        Returns the validation errors for the loaded bookmark collections.
+        """
+        self.refresh()
+        return self.errors
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Builds the precompiled artifacts that the application loads at startup.
+
+Usage:
+
+    python build.py [target ...]
+
+Builds every target if no target is given.
+"""
+
+import sys
+import timeit
+
+from bookmarks import BookmarkCatalog
+from bookmarks import load_all_bookmarks
+from bookmarks import load_bookmark_bundle
+from bookmarks import validate_bookmarks
+from bookmarks import write_bookmark_bundle
+from settings import DefaultConfiguration
+from writings import write_writings_artifact
+from assets import brotli, write_assets
+
+
+def build_bookmarks():
+    """
+    Validates the bookmark files and writes the bookmark bundle.
+    """
+    bundle_filename = DefaultConfiguration.BOOKMARK_BUNDLE_FILENAME
+
+    try:
+        errors = validate_bookmarks(load_all_bookmarks())
+    except ValueError as e:
+        print("There was an exception when loading the bookmarks.")
+        print(e)
+        return False
+
+    if errors:
+        for error in errors:
+            print(error)
+        return False
+
+    write_bookmark_bundle(bundle_filename)
+
+    runs = 20
+    json_time = timeit.timeit(
+        lambda: BookmarkCatalog().refresh(), number=runs) / runs
+    bundle_time = timeit.timeit(
+        lambda: BookmarkCatalog(bundle_filename=bundle_filename).refresh(),
+        number=runs) / runs
+
+    print("Wrote {} with {} bookmark files.".format(
+        bundle_filename, len(load_bookmark_bundle(bundle_filename))))
+    print("Loading from json: {:.2f} ms".format(json_time * 1000))
+    print("Loading from bundle: {:.2f} ms".format(bundle_time * 1000))
+    print("Saved {:.2f} ms per load.".format((json_time - bundle_time) * 1000))
+
+    return True
+
+
+def build_writings():
+    """
+    Converts the markdown writings to html and writes the writings artifact.
+    """
+    artifact_filename = DefaultConfiguration.WRITINGS_ARTIFACT_FILENAME
+    writings = write_writings_artifact(artifact_filename)
+
+    print("Wrote {} with {} writings.".format(artifact_filename, len(writings)))
+
+    return True
+
+
+def build_assets():
+    """
+    Fingerprints the static files and writes their compressed variants.
+    """
+    build_folder = DefaultConfiguration.ASSET_BUILD_FOLDER
+    manifest = write_assets(build_folder)
+
+    print("Wrote {} assets to {}.".format(len(manifest), build_folder))
+    if brotli is None:
+        print("Brotli is not installed. Only gzip variants were written.")
+
+    return True
+
+
+def build_templates():
+    """
+    Compiles the templates into the template cache folder.
+    """
+    # The templates have to be compiled with the jinja environment of the
+    # application, since the bytecode depends on its options.
+    from redwood import precompile_templates
+
+    count = precompile_templates()
+    print("Compiled {} templates to {}.".format(count, DefaultConfiguration.TEMPLATE_CACHE_FOLDER))
+
+    return True
+
+
+TARGETS = {
+    'assets': build_assets,
+    'bookmarks': build_bookmarks,
+    'templates': build_templates,
+    'writings': build_writings,
+}
+
+
+def main(targets):
+    for target in targets:
+        if target not in TARGETS:
+            print("Unknown build target {}".format(target))
+            return 1
+
+    for target in targets or sorted(TARGETS):
+        print("Building {}".format(target))
+        if not TARGETS[target]():
+            print("Building {} failed.".format(target))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
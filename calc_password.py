@@ -1,12 +1,65 @@
-import hashlib
+#!/usr/bin/env python3
 
-# Calculates the password hash
+"""
+Calculates the password hash for the PASSWORD_HASH environment variable.
 
-password="henrik"
-salt = "123456789"
-m = hashlib.sha256()
-m.update(salt.encode('utf-8'))
-m.update(password.encode('utf-8'))
-password_hash = m.hexdigest()
+Usage:
 
-print(password_hash)
+    python calc_password.py [--algorithm pbkdf2_sha256|scrypt] [--target-ms 250]
+
+Prompts for the password. With --target-ms the work factor is picked so that
+checking the password takes about that many milliseconds on this machine.
+Otherwise the parameters from the settings are used. With --benchmark only
+the parameters for the target time are printed.
+"""
+
+import argparse
+import getpass
+import sys
+
+from flask import Config
+
+from passwords import benchmark, configured_parameters, hash_password
+from passwords import PBKDF2_ALGORITHM, SCRYPT_ALGORITHM, SCRYPT_AVAILABLE
+from settings import DefaultConfiguration
+
+
+def main():
+    config = Config('.')
+    config.from_object(DefaultConfiguration)
+
+    parser = argparse.ArgumentParser(description="Calculates a password hash.")
+    parser.add_argument('--algorithm', choices=[PBKDF2_ALGORITHM, SCRYPT_ALGORITHM],
+                        default=config['PASSWORD_ALGORITHM'])
+    parser.add_argument('--target-ms', type=float,
+                        help="pick the work factor for this many milliseconds per hash")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="only print the parameters for the target time")
+    args = parser.parse_args()
+
+    if args.algorithm == SCRYPT_ALGORITHM and not SCRYPT_AVAILABLE:
+        print("scrypt needs Python built with OpenSSL 1.1 or later.", file=sys.stderr)
+        return 1
+
+    if args.target_ms:
+        parameters, elapsed = benchmark(args.algorithm, args.target_ms)
+        print("{} {} takes {:.0f} ms.".format(args.algorithm, parameters, elapsed),
+              file=sys.stderr)
+    else:
+        config['PASSWORD_ALGORITHM'] = args.algorithm
+        _, parameters = configured_parameters(config)
+
+    if args.benchmark:
+        return 0
+
+    password = getpass.getpass("Password: ")
+    if password != getpass.getpass("Repeat password: "):
+        print("The passwords do not match.", file=sys.stderr)
+        return 1
+
+    print(hash_password(password, args.algorithm, parameters))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
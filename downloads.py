@@ -0,0 +1,146 @@
+from flask import abort, redirect, request, send_file, Response
+from storage import FileChangedError, get_backend
+from werkzeug.http import http_date, quote_etag, unquote_etag
+import calendar
+
+
+def stream_chunks(stream, length, buffer_size):
+    """
+    Generates the first length bytes of the stream in chunks of at most
+    buffer_size bytes. Closes the stream when done.
+    """
+    try:
+        remaining = length
+        while remaining > 0:
+            chunk = stream.read(min(buffer_size, remaining))
+            if not chunk:
+                break
+
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        stream.close()
+
+
+def if_range_matches(if_range, etag, last_modified):
+    """
+    Checks the If-Range header of a request. A range request without an
+    If-Range header always matches.
+    """
+    if if_range.etag is not None:
+        return if_range.etag == etag
+
+    if if_range.date is not None:
+        timestamp = calendar.timegm(last_modified.utctimetuple())
+        return calendar.timegm(if_range.date.utctimetuple()) == timestamp
+
+    return True
+
+
+def plan_download(size, etag, last_modified, if_none_match, byte_ranges, if_range):
+    """
+    Decides how to answer a download request from its If-None-Match, Range
+    and If-Range headers, parsed the way werkzeug parses them. Returns a
+    tuple with the status code and the inclusive byte range to send, or None
+    to send the whole file.
+    """
+    if if_none_match and if_none_match.contains(etag):
+        return 304, None
+
+    if byte_ranges is not None and if_range_matches(if_range, etag, last_modified):
+        range_for_length = byte_ranges.range_for_length(size)
+
+        if range_for_length is not None:
+            start, stop = range_for_length
+            return 206, (start, stop - 1)
+        elif len(byte_ranges.ranges) == 1:
+            return 416, None
+
+    return 200, None
+
+
+def download_headers(status, size, etag, last_modified, byte_range):
+    """
+    Returns the headers for a download response planned by plan_download,
+    without the Content-Type and Content-Length headers.
+    """
+    if status == 416:
+        return {'Content-Range': 'bytes */{}'.format(size)}
+
+    headers = {'ETag': quote_etag(etag),
+               'Accept-Ranges': 'bytes',
+               'Last-Modified': http_date(last_modified)}
+
+    if byte_range is not None:
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(byte_range[0], byte_range[1], size)
+
+    return headers
+
+
+def send_stored_file(bucket_name, key, mimetype, buffer_size=64*1024,
+                     redirect_min_size=None, redirect_expires_in=300):
+    """
+    Sends a file from the storage backend with support for conditional and
+    range requests.
+
+    A file on the local disk is sent by path, which lets the server use
+    sendfile instead of copying the file through the worker. Other files are
+    streamed in chunks of buffer_size bytes. A range request only fetches
+    the requested bytes from the backend.
+
+    If redirect_min_size is set, files of at least that size are not sent
+    through the worker at all. The client is redirected to a presigned url
+    that is valid for redirect_expires_in seconds instead. Any access checks
+    must be done before calling this function.
+    """
+    backend = get_backend()
+    path = backend.local_path(bucket_name, key)
+
+    if path:
+        return send_file(path, mimetype=mimetype, conditional=True)
+
+    # The file is read with the etag from the stat, so that the headers
+    # always describe the bytes that are sent. If the file is replaced in
+    # between it is stat'ed again.
+    for attempt in range(2):
+        info = backend.stat(bucket_name, key)
+        if info is None:
+            abort(404)
+
+        size = info['size']
+
+        if redirect_min_size is not None and size >= redirect_min_size:
+            url = backend.presigned_url(bucket_name, key, mimetype, redirect_expires_in)
+            if url:
+                return redirect(url, code=302)
+
+        etag, _ = unquote_etag(info['etag'])
+        last_modified = info['last_modified']
+
+        status, byte_range = plan_download(size, etag, last_modified, request.if_none_match,
+                                           request.range, request.if_range)
+        headers = download_headers(status, size, etag, last_modified, byte_range)
+
+        if status in (304, 416):
+            return Response(status=status, headers=headers)
+
+        try:
+            stream = backend.read_stream(bucket_name, key, byte_range=byte_range,
+                                         etag=info['etag'])
+        except FileChangedError:
+            continue
+
+        if byte_range is None:
+            length = size
+        else:
+            length = byte_range[1] - byte_range[0] + 1
+
+        response = Response(stream_chunks(stream, length, buffer_size),
+                            status=status, mimetype=mimetype, headers=headers,
+                            direct_passthrough=True)
+        response.content_length = length
+
+        return response
+
+    # The file keeps changing.
+    abort(503)
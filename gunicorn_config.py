@@ -0,0 +1,161 @@
+"""
+The gunicorn configuration.
+
+Usage:
+
+    gunicorn -c gunicorn_config.py redwood:app
+
+With PRELOAD_APP the application is loaded and warmed up in the master, and
+the workers are forked from it. The loaded bookmarks, photo collections,
+writings, assets and compiled templates are then shared by all the workers
+through copy-on-write instead of every worker loading its own copy. The
+garbage collector is kept from touching the shared objects, since that
+would copy the pages they are on into every worker. Without PRELOAD_APP
+every worker warms up on its own before it serves its first request.
+
+To print the shared and private memory of a running master and its workers
+use the following command.
+
+    python gunicorn_config.py <master-pid>
+"""
+
+import gc
+import os
+import sys
+
+from settings import DefaultConfiguration
+
+preload_app = DefaultConfiguration.PRELOAD_APP
+
+# gc.freeze is only available in Python 3.7 and later.
+freeze_gc = preload_app and hasattr(gc, 'freeze')
+
+if freeze_gc:
+    # Collections while the application is loaded would leave freed holes in
+    # the pages that the workers share, so the collector is disabled until
+    # the objects have been frozen.
+    gc.disable()
+
+
+def warm_up():
+    import redwood
+    redwood.warm_up()
+
+
+def when_ready(server):
+    """
+    Runs in the master before the workers are forked.
+    """
+    if DefaultConfiguration.NOTES_SYNC_ON_STARTUP:
+        # The sync runs to the end before the workers are forked, so that
+        # no sync thread holds a lock while forking.
+        import redwood
+        redwood.sync_notes_mirror()
+
+    if not preload_app:
+        return
+
+    warm_up()
+
+    if freeze_gc:
+        # Moves every object into the permanent generation, so that
+        # collections in the workers do not write to the shared pages.
+        gc.freeze()
+        gc.enable()
+
+    server.log.info("Loaded the application before forking the workers.")
+
+
+def post_fork(server, worker):
+    if freeze_gc:
+        gc.enable()
+
+
+def post_worker_init(worker):
+    """
+    Runs in a worker after it has loaded the application.
+    """
+    if not preload_app:
+        warm_up()
+
+    if DefaultConfiguration.WORKER_MEMORY_REPORT:
+        worker.log.info(format_memory(os.getpid(), memory_usage(os.getpid())))
+
+
+def memory_usage(pid):
+    """
+    Returns the resident, proportional, shared and private memory of a
+    process in kilobytes, or None if it is not available. The proportional
+    memory is the private memory plus this process's share of the shared
+    memory.
+    """
+    fields = {}
+
+    # smaps_rollup has the totals but needs Linux 4.14. Otherwise the
+    # mappings in smaps are added up.
+    for filename in ('smaps_rollup', 'smaps'):
+        try:
+            with open('/proc/{}/{}'.format(pid, filename)) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 3 and parts[2] == 'kB':
+                        fields[parts[0]] = fields.get(parts[0], 0) + int(parts[1])
+            break
+        except OSError:
+            continue
+    else:
+        return None
+
+    return {"rss": fields.get('Rss:', 0),
+            "pss": fields.get('Pss:', 0),
+            "shared": fields.get('Shared_Clean:', 0) + fields.get('Shared_Dirty:', 0),
+            "private": fields.get('Private_Clean:', 0) + fields.get('Private_Dirty:', 0)}
+
+
+def format_memory(pid, usage):
+    if usage is None:
+        return "Memory of {} is not available.".format(pid)
+
+    return "Memory of {}: {rss} kB resident, {pss} kB proportional, " \
+        "{shared} kB shared, {private} kB private".format(pid, **usage)
+
+
+def child_pids(pid):
+    """
+    Returns the process ids of the children of a process.
+    """
+    children = []
+
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                # The parent pid is the second field after the command,
+                # which is in parentheses and may contain spaces.
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+
+        if int(fields[1]) == pid:
+            children.append(int(name))
+
+    return sorted(children)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: python gunicorn_config.py <master-pid>")
+        return 1
+
+    master = int(sys.argv[1])
+
+    print("master " + format_memory(master, memory_usage(master)))
+    for pid in child_pids(master):
+        print("worker " + format_memory(pid, memory_usage(pid)))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,121 @@
+from io import BytesIO
+from flask import request, Response
+from werkzeug.http import http_date
+import calendar
+import gzip
+import hashlib
+import threading
+
+
+def gzip_bytes(data):
+    """
+    Gzip compresses the data. The gzip header does not contain a timestamp
+    so the same data always gives the same bytes.
+    """
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+        f.write(data)
+
+    return buffer.getvalue()
+
+
+class Payload:
+    """
+    A serialized response body together with its gzip compressed bytes and
+    the validators used for conditional requests. The strong ETag is a
+    digest of the body.
+    """
+
+    def __init__(self, body, mimetype, last_modified=None):
+        self.body = body
+        self.gzipped = gzip_bytes(body)
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.last_modified = last_modified
+
+
+class PayloadCache:
+    """
+    Keeps the payloads for the current version of some data. The payloads
+    for all variants are dropped as soon as the version changes.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.payloads = {}
+        self.lock = threading.Lock()
+
+    def get(self, version, variant, build):
+        """
+        Returns the payload for the given version and variant. Calls build
+        to create the payload if it is not cached.
+        """
+        with self.lock:
+            if version != self.version:
+                self.version = version
+                self.payloads = {}
+
+            payload = self.payloads.get(variant)
+
+        if payload is None:
+            payload = build()
+
+            with self.lock:
+                if version == self.version:
+                    self.payloads[variant] = payload
+
+        return payload
+
+
+def accepts_gzip():
+    """
+    Checks if the client of the current request accepts gzip encoded
+    responses.
+    """
+    return request.accept_encodings['gzip'] > 0
+
+
+def is_not_modified(etag, last_modified=None):
+    """
+    Checks the conditional headers of the current request against the given
+    validators. If-Modified-Since is only used when there is no If-None-Match
+    header.
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+
+    if last_modified is not None and request.if_modified_since is not None:
+        if_modified_since = calendar.timegm(request.if_modified_since.utctimetuple())
+        return int(last_modified) <= if_modified_since
+
+    return False
+
+
+def payload_response(payload):
+    """
+    Creates the response for the current request from a payload. Returns
+    304 Not Modified when the client already has the payload and the gzip
+    compressed body when the client accepts it.
+    """
+    use_gzip = accepts_gzip()
+
+    # The gzip encoded body is a different representation so it needs a
+    # different strong ETag.
+    etag = payload.etag + '-gzip' if use_gzip else payload.etag
+
+    if is_not_modified(etag, payload.last_modified):
+        response = Response(status=304)
+    elif use_gzip:
+        response = Response(payload.gzipped, mimetype=payload.mimetype)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(payload.body, mimetype=payload.mimetype)
+
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'
+
+    if payload.last_modified is not None:
+        response.headers['Last-Modified'] = http_date(payload.last_modified)
+
+    return response
@@ -0,0 +1,71 @@
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+
+
+class IdentityCache:
+    """
+    Remembers the claims of identity JWTs whose signature has been verified,
+    so that a token that is sent with many requests is only verified once.
+
+    Entries are keyed by a digest of the secret and the token. A token that
+    has been tampered with gets another digest and is verified as usual, and
+    changing the secret makes all the cached entries unreachable. An entry is
+    only used until the exp claim of the token. The cache is a least recently
+    used cache with at most max_entries entries.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def key(self, secret, token):
+        m = hashlib.sha256()
+        m.update(secret.encode('utf-8'))
+        m.update(b'\0')
+        m.update(token.encode('utf-8'))
+        return m.digest()
+
+    def get(self, secret, token):
+        """
+        Returns a copy of the verified claims of the token or None if the
+        token is not in the cache or has expired.
+        """
+        key = self.key(secret, token)
+
+        with self.lock:
+            claims = self.entries.get(key)
+
+            if claims is not None and claims['exp'] <= time.time():
+                del self.entries[key]
+                claims = None
+
+            if claims is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return dict(claims)
+
+    def put(self, secret, token, claims):
+        """
+        Stores the verified claims of a token. Tokens without an exp claim are
+        not cached.
+        """
+        if 'exp' not in claims:
+            return
+
+        with self.lock:
+            self.entries[self.key(secret, token)] = dict(claims)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,225 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixTree:
+    """
+    The keys of a bucket arranged as a tree of folders, so that the contents
+    of any folder can be listed without a call to the storage backend.
+    """
+
+    def __init__(self, keys=()):
+        self.root = self.create_node()
+
+        for key in keys:
+            self.add(key)
+
+    def create_node(self):
+        return {'folders': {}, 'files': set()}
+
+    def add(self, key):
+        """
+        Adds a key to the tree. A key that ends with / only creates the
+        folder.
+        """
+        parts = key.split('/')
+        node = self.root
+
+        for part in parts[:-1]:
+            node = node['folders'].setdefault(part, self.create_node())
+
+        if parts[-1]:
+            node['files'].add(parts[-1])
+
+    def remove(self, key):
+        """
+        Removes a key from the tree. Empty folders are kept.
+        """
+        parts = key.split('/')
+        node = self.root
+
+        for part in parts[:-1]:
+            node = node['folders'].get(part)
+            if node is None:
+                return
+
+        node['files'].discard(parts[-1])
+
+    def list_folder(self, folder):
+        """
+        Lists the contents of a folder the same way as
+        StorageBackend.list_folder.
+        """
+        prefix = '' if folder == '/' else folder
+        node = self.root
+
+        for part in prefix.split('/')[:-1]:
+            node = node['folders'].get(part)
+            if node is None:
+                return [], []
+
+        folders = [prefix + name + '/' for name in sorted(node['folders'])]
+        files = [prefix + name for name in sorted(node['files'])]
+
+        return folders, files
+
+
+class ListingCache:
+    """
+    Serves folder listings from an in-memory prefix tree per bucket.
+
+    The tree for a bucket is built by crawling all the keys in the bucket in
+    a background thread, and crawled again in the background when it is older
+    than ttl seconds. Requests are never blocked on a crawl: until the first
+    crawl of a bucket is done folders are listed with the backend directly,
+    and a stale tree is served while it is being refreshed.
+
+    Writes and deletes made by the application must be reported with added
+    and removed so the tree stays up to date between crawls.
+    """
+
+    def __init__(self, get_backend, ttl=60):
+        self.get_backend = get_backend
+        self.ttl = ttl
+
+        # Maps a bucket name to a (backend, tree, crawled at) tuple.
+        self.trees = {}
+        # Maps a bucket name to the changes made while the bucket was being
+        # crawled. The changes are applied to the new tree.
+        self.pending = {}
+        self.requested = set()
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+
+        self.hits = 0
+        self.misses = 0
+        self.crawls = 0
+
+    def ensure_refresher(self):
+        """
+        Starts the background refresh thread in the current process. The
+        thread is started again after a fork since threads do not survive a
+        fork.
+        """
+        pid = os.getpid()
+        if self.thread is not None and self.thread_pid == pid:
+            return
+
+        with self.lock:
+            if self.thread is None or self.thread_pid != pid:
+                self.thread = threading.Thread(target=self.refresh_loop,
+                                               name='listing-cache-refresher',
+                                               daemon=True)
+                self.thread_pid = pid
+                self.thread.start()
+
+    def refresh_loop(self):
+        while True:
+            self.wakeup.wait(self.ttl)
+            self.wakeup.clear()
+
+            for bucket_name in list(self.requested):
+                if self.is_stale(bucket_name):
+                    try:
+                        self.crawl(bucket_name)
+                    except Exception:
+                        logger.exception("Could not crawl bucket {}".format(bucket_name))
+
+    def is_stale(self, bucket_name):
+        """
+        Checks if the tree for the bucket is missing, too old or was built
+        from another backend.
+        """
+        entry = self.trees.get(bucket_name)
+
+        if entry is None or entry[0] is not self.get_backend():
+            return True
+
+        return time.monotonic() - entry[2] >= self.ttl
+
+    def crawl(self, bucket_name):
+        """
+        Lists all the keys in the bucket and replaces the tree for the bucket.
+        """
+        backend = self.get_backend()
+
+        with self.lock:
+            self.pending[bucket_name] = []
+
+        tree = PrefixTree(backend.list_all(bucket_name))
+
+        with self.lock:
+            for change, key in self.pending.pop(bucket_name, []):
+                if change == 'added':
+                    tree.add(key)
+                else:
+                    tree.remove(key)
+
+            self.trees[bucket_name] = (backend, tree, time.monotonic())
+            self.crawls += 1
+
+    def list_folder(self, bucket_name, folder):
+        """
+        Lists the contents of a folder in a bucket.
+        """
+        self.ensure_refresher()
+
+        with self.lock:
+            self.requested.add(bucket_name)
+            entry = self.trees.get(bucket_name)
+            backend = self.get_backend()
+
+            if entry is not None and entry[0] is backend:
+                self.hits += 1
+                result = entry[1].list_folder(folder)
+            else:
+                self.misses += 1
+                result = None
+
+        if self.is_stale(bucket_name):
+            self.wakeup.set()
+
+        if result is None:
+            return backend.list_folder(bucket_name, folder)
+
+        return result
+
+    def record(self, bucket_name, change, key):
+        with self.lock:
+            if bucket_name in self.pending:
+                self.pending[bucket_name].append((change, key))
+
+            entry = self.trees.get(bucket_name)
+            if entry is not None:
+                if change == 'added':
+                    entry[1].add(key)
+                else:
+                    entry[1].remove(key)
+
+    def added(self, bucket_name, key):
+        """
+        Records that the application has written a file.
+        """
+        self.record(bucket_name, 'added', key)
+
+    def removed(self, bucket_name, key):
+        """
+        Records that the application has deleted a file.
+        """
+        self.record(bucket_name, 'removed', key)
+
+    def stats(self):
+        """
+        Returns the hit, miss and crawl counters.
+        """
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "crawls": self.crawls,
+                "buckets": sorted(self.trees)}
@@ -0,0 +1,341 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from listing_cache import PrefixTree
+from storage import LocalBackend
+from util import file_signature
+from writings import render_markdown_html
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# The format version of the notes mirror manifest.
+MANIFEST_VERSION = 1
+
+# The mirror stores the raw notes and the rendered html in these folders of
+# the mirror folder.
+MIRROR_TEXT_FOLDER = 'text'
+MIRROR_HTML_FOLDER = 'html'
+MIRROR_MANIFEST_FILENAME = 'manifest.json'
+
+
+class Note:
+    """
+    A note with its raw markdown text and the rendered html.
+    """
+
+    def __init__(self, key, etag, text, html):
+        self.key = key
+        self.etag = etag
+        self.text = text
+        self.html = html
+        self.size = len(text) + len(html)
+        self.checked = time.monotonic()
+
+    def to_dict(self):
+        return {"key": self.key,
+                "etag": self.etag,
+                "text": self.text,
+                "html": self.html}
+
+
+class NotesCache:
+    """
+    Caches the notes in a bucket together with their rendered html.
+
+    The cache has two tiers. The first is a least recently used cache in
+    memory that is bounded by the total size of the notes. The second is a
+    folder on the local disk that survives restarts and is shared by the
+    workers. Both tiers are keyed by the etag of the note.
+
+    A cached note is used without asking the backend for ttl seconds after it
+    was last validated. After that the note is validated with a conditional
+    get, which only downloads the note again if its etag has changed.
+    """
+
+    def __init__(self, get_backend, bucket_name, cache_folder=None,
+                 max_bytes=4*1024*1024, ttl=30):
+        self.get_backend = get_backend
+        self.bucket_name = bucket_name
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.validations = 0
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def cache_path(self, key):
+        """
+        Returns the path of the cached note on the local disk.
+        """
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(self.cache_folder, name)
+
+    def load_from_disk(self, key):
+        """
+        Loads a note from the cache folder. Returns None if the note is not in
+        the cache folder.
+        """
+        if not self.cache_folder:
+            return None
+
+        try:
+            with open(self.cache_path(key)) as f:
+                data = json.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if data.get("key") != key:
+            return None
+
+        note = Note(key, data["etag"], data["text"], data["html"])
+
+        # The note on disk has to be validated before it is used.
+        note.checked = None
+        return note
+
+    def save_to_disk(self, note):
+        if not self.cache_folder:
+            return
+
+        os.makedirs(self.cache_folder, exist_ok=True)
+
+        fd, temporary_path = tempfile.mkstemp(dir=self.cache_folder, prefix='.note-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(note.to_dict(), f)
+            os.replace(temporary_path, self.cache_path(note.key))
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def remove(self, key):
+        """
+        Removes a note that no longer exists from memory and the cache folder.
+        """
+        with self.lock:
+            note = self.entries.pop(key, None)
+            if note is not None:
+                self.size -= note.size
+
+        if self.cache_folder:
+            try:
+                os.unlink(self.cache_path(key))
+            except FileNotFoundError:
+                pass
+
+    def put(self, note):
+        """
+        Stores the note in memory and evicts the least recently used notes
+        until the cache is within its size limit.
+        """
+        with self.lock:
+            old_note = self.entries.pop(note.key, None)
+            if old_note is not None:
+                self.size -= old_note.size
+
+            if note.size > self.max_bytes:
+                return
+
+            self.entries[note.key] = note
+            self.size += note.size
+
+            while self.size > self.max_bytes:
+                _, oldest_note = self.entries.popitem(last=False)
+                self.size -= oldest_note.size
+
+    def get(self, key):
+        """
+        Returns the note with the given key or None if there is no such note.
+        """
+        with self.lock:
+            note = self.entries.get(key)
+            if note is not None:
+                self.entries.move_to_end(key)
+
+        if note is not None and time.monotonic() - note.checked < self.ttl:
+            self.hits += 1
+            return note
+
+        if note is None:
+            note = self.load_from_disk(key)
+
+        etag = note.etag if note is not None else None
+        try:
+            result = self.get_backend().read_if_changed(self.bucket_name, key, etag)
+        except FileNotFoundError:
+            self.remove(key)
+            return None
+
+        if result is None:
+            self.validations += 1
+            note.checked = time.monotonic()
+        else:
+            self.downloads += 1
+            content, etag = result
+            text = content.decode('utf-8')
+            note = Note(key, etag, text, render_markdown_html(text))
+            self.save_to_disk(note)
+
+        self.put(note)
+        return note
+
+    def stats(self):
+        """
+        Returns the hit, validation and download counters and the size of the
+        cache.
+        """
+        with self.lock:
+            return {"hits": self.hits,
+                    "validations": self.validations,
+                    "downloads": self.downloads,
+                    "entries": len(self.entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes}
+
+
+def load_mirror_manifest(mirror_folder):
+    """
+    Loads the manifest of a notes mirror. Returns a dict that maps the key of
+    every mirrored note to its etag, or None if there is no mirror or it has
+    the wrong format version.
+    """
+    try:
+        with open(os.path.join(mirror_folder, MIRROR_MANIFEST_FILENAME)) as f:
+            manifest = json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+
+    return manifest["notes"]
+
+def write_mirror_manifest(mirror_folder, notes, bucket_name):
+    fd, temporary_path = tempfile.mkstemp(dir=mirror_folder, prefix='.manifest-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({"version": MANIFEST_VERSION,
+                       "bucket": bucket_name,
+                       "synced": time.time(),
+                       "notes": notes}, f, indent=4, sort_keys=True)
+        os.replace(temporary_path, os.path.join(mirror_folder, MIRROR_MANIFEST_FILENAME))
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+def sync_notes(backend, bucket_name, mirror_folder, workers=8):
+    """
+    Mirrors the notes bucket to the mirror folder on the local disk. Only the
+    notes whose etag has changed since the last sync are downloaded, using a
+    pool of worker threads. Every note is rendered to html when it is
+    downloaded. Returns a tuple with the lists of changed and removed keys.
+    """
+    mirror = LocalBackend(mirror_folder)
+    os.makedirs(mirror.root, exist_ok=True)
+
+    notes = load_mirror_manifest(mirror_folder) or {}
+    # Keys that end with / are folder markers, not notes.
+    remote = {key: etag for key, etag in backend.list_etags(bucket_name)
+              if not key.endswith('/')}
+
+    changed = sorted(key for key, etag in remote.items() if notes.get(key) != etag)
+    removed = sorted(key for key in notes if key not in remote)
+
+    def download(key):
+        content, etag = backend.read_if_changed(bucket_name, key, None)
+        text = content.decode('utf-8', errors='replace')
+
+        mirror.write(MIRROR_TEXT_FOLDER, key, content)
+        mirror.write(MIRROR_HTML_FOLDER, key, render_markdown_html(text).encode('utf-8'))
+
+        return key, etag
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key, etag in executor.map(download, changed):
+            notes[key] = etag
+
+    for key in removed:
+        mirror.delete(MIRROR_TEXT_FOLDER, key)
+        mirror.delete(MIRROR_HTML_FOLDER, key)
+        del notes[key]
+
+    write_mirror_manifest(mirror_folder, notes, bucket_name)
+
+    return changed, removed
+
+
+class NotesMirror:
+    """
+    Serves notes from a mirror folder written by sync_notes. The manifest is
+    checked for a new sync at most once every reload_interval seconds.
+    """
+
+    def __init__(self, mirror_folder, reload_interval=5):
+        self.mirror = LocalBackend(mirror_folder)
+        self.manifest_filename = os.path.join(mirror_folder, MIRROR_MANIFEST_FILENAME)
+        self.reload_interval = reload_interval
+
+        self.notes = None
+        self.tree = None
+        self.signature = None
+        self.last_checked = None
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        """
+        Loads the manifest again if it has changed.
+        """
+        now = time.monotonic()
+        if not force and self.last_checked is not None:
+            if now - self.last_checked < self.reload_interval:
+                return
+
+        with self.lock:
+            self.last_checked = now
+            signature = file_signature(self.manifest_filename)
+
+            if signature != self.signature:
+                notes = load_mirror_manifest(self.mirror.root)
+                self.tree = PrefixTree(notes) if notes is not None else None
+                self.notes = notes
+                self.signature = signature
+
+    def available(self):
+        """
+        Checks if there is a synced mirror to serve notes from.
+        """
+        self.refresh()
+        return self.notes is not None
+
+    def list_folder(self, folder):
+        """
+        Lists a folder the same way as StorageBackend.list_folder.
+        """
+        self.refresh()
+        return self.tree.list_folder(folder)
+
+    def get(self, key):
+        """
+        Returns the mirrored note with the given key or None if there is no
+        such note.
+        """
+        self.refresh()
+        etag = self.notes.get(key)
+
+        if etag is None:
+            return None
+
+        try:
+            text = self.mirror.read(MIRROR_TEXT_FOLDER, key).decode('utf-8', errors='replace')
+            html = self.mirror.read(MIRROR_HTML_FOLDER, key).decode('utf-8')
+        except FileNotFoundError:
+            return None
+
+        return Note(key, etag, text, html)
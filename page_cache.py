@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from flask import current_app, request, make_response, Response
+from functools import wraps
+import threading
+import time
+
+
+class CachedPage:
+    """
+    A rendered response stored in the page cache.
+    """
+
+    def __init__(self, body, status, headers, tag, expires):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.tag = tag
+        self.expires = expires
+        self.size = len(body)
+
+
+class PageCache:
+    """
+    A cache for rendered pages that look the same for every visitor.
+
+    Pages are cached by path, by whether the visitor is logged in and by the
+    version of the data the page was rendered from. The cache is a least
+    recently used cache bounded by the total size of the cached bodies, and
+    every entry expires after a time to live.
+
+    Every cached page has a tag that names the data it was rendered from, like
+    bookmarks or photos. Invalidating a tag evicts all the pages with that tag.
+    """
+
+    def __init__(self, max_bytes, default_ttl, logged_in):
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.logged_in = logged_in
+
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the cached page for the key or None if there is no page or it
+        has expired.
+        """
+        with self.lock:
+            page = self.entries.get(key)
+
+            if page is not None and page.expires <= time.monotonic():
+                self._remove(key)
+                page = None
+
+            if page is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, page):
+        """
+        Stores the page in the cache and evicts the least recently used pages
+        until the cache is within its size limit.
+        """
+        if page.size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            self.entries[key] = page
+            self.size += page.size
+
+            while self.size > self.max_bytes:
+                oldest_key = next(iter(self.entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def _remove(self, key):
+        page = self.entries.pop(key)
+        self.size -= page.size
+
+    def invalidate(self, tag):
+        """
+        Evicts all the pages with the given tag.
+        """
+        with self.lock:
+            for key in [k for k, page in self.entries.items() if page.tag == tag]:
+                self._remove(key)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Evicts all the pages.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns the hit and miss counters and the size of the cache.
+        """
+        with self.lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self.entries),
+                    "bytes": self.size,
+                    "max_bytes": self.max_bytes}
+
+    def cached(self, tag, version=None, ttl=None):
+        """
+        Decorator that caches the response of a view. The version function
+        returns the current version of the data the view renders. Only
+        successful GET responses that do not set cookies are cached.
+        """
+        def decorator(f):
+            @wraps(f)
+            def cached_wrapper(*args, **kwargs):
+                if request.method != 'GET' or not current_app.config['PAGE_CACHE_ENABLED']:
+                    return f(*args, **kwargs)
+
+                # None of the cached views read the query string, so it is
+                # left out of the key. Otherwise every made up query string
+                # would add a page to the cache.
+                data_version = version() if version else None
+                key = (request.path, bool(self.logged_in()), tag, data_version)
+
+                page = self.get(key)
+                if page is None:
+                    response = make_response(f(*args, **kwargs))
+
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    if 'Set-Cookie' in response.headers:
+                        return response
+
+                    expires = time.monotonic() + (ttl or self.default_ttl)
+                    page = CachedPage(response.get_data(), response.status_code,
+                                      list(response.headers), tag, expires)
+                    self.put(key, page)
+                    return response
+
+                return Response(page.body, status=page.status, headers=page.headers)
+
+            return cached_wrapper
+
+        return decorator
@@ -0,0 +1,183 @@
+import base64
+import hashlib
+import hmac
+import os
+import time
+
+# Password hashes are stored as strings that contain the algorithm and its
+# parameters, so the parameters can be changed without breaking old hashes.
+#
+#     pbkdf2_sha256$<iterations>$<salt>$<hash>
+#     scrypt$<n>$<r>$<p>$<salt>$<hash>
+#
+# The salt and the hash are base64 encoded. A hash without any $ characters
+# is a legacy hex encoded sha256 hash of the salt in the PASSWORD_SALT
+# setting followed by the password.
+
+PBKDF2_ALGORITHM = 'pbkdf2_sha256'
+SCRYPT_ALGORITHM = 'scrypt'
+LEGACY_ALGORITHM = 'sha256'
+
+DEFAULT_PARAMETERS = {
+    PBKDF2_ALGORITHM: {'iterations': 260000},
+    SCRYPT_ALGORITHM: {'n': 2**14, 'r': 8, 'p': 1},
+}
+
+# hashlib.scrypt needs Python built with OpenSSL 1.1 or later.
+SCRYPT_AVAILABLE = hasattr(hashlib, 'scrypt')
+
+SALT_BYTES = 16
+HASH_BYTES = 32
+
+
+def b64encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+def b64decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+def scrypt_maxmem(n, r, p):
+    """
+    Returns a memory limit that is large enough for the scrypt parameters.
+    """
+    return 128 * r * (n + p + 2) + 1024 * 1024
+
+def derive_key(password, salt, algorithm, parameters):
+    """
+    Derives the hash of a password with the given algorithm and parameters.
+    Raises ValueError if the algorithm is unknown or not available.
+    """
+    password = password.encode('utf-8')
+
+    if algorithm == PBKDF2_ALGORITHM:
+        return hashlib.pbkdf2_hmac('sha256', password, salt,
+                                   parameters['iterations'], HASH_BYTES)
+    elif algorithm == SCRYPT_ALGORITHM:
+        if not SCRYPT_AVAILABLE:
+            raise ValueError("scrypt needs Python built with OpenSSL 1.1 or later")
+
+        n, r, p = parameters['n'], parameters['r'], parameters['p']
+        return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p,
+                              maxmem=scrypt_maxmem(n, r, p), dklen=HASH_BYTES)
+    else:
+        raise ValueError("Unknown password hash algorithm {}".format(algorithm))
+
+def hash_password(password, algorithm=PBKDF2_ALGORITHM, parameters=None):
+    """
+    Hashes a password with a random salt. Returns the encoded hash string.
+    """
+    parameters = parameters or DEFAULT_PARAMETERS[algorithm]
+    salt = os.urandom(SALT_BYTES)
+    key = b64encode(derive_key(password, salt, algorithm, parameters))
+
+    if algorithm == PBKDF2_ALGORITHM:
+        fields = [algorithm, parameters['iterations'], b64encode(salt), key]
+    else:
+        fields = [algorithm, parameters['n'], parameters['r'], parameters['p'],
+                  b64encode(salt), key]
+
+    return '$'.join(str(field) for field in fields)
+
+def parse_password_hash(encoded):
+    """
+    Parses an encoded hash string. Returns a tuple with the algorithm, the
+    parameters, the salt and the hash. Raises ValueError if the string is not
+    a valid hash.
+    """
+    fields = encoded.split('$')
+
+    if len(fields) == 1:
+        return LEGACY_ALGORITHM, {}, None, fields[0]
+
+    algorithm = fields[0]
+
+    if algorithm == PBKDF2_ALGORITHM and len(fields) == 4:
+        parameters = {'iterations': int(fields[1])}
+    elif algorithm == SCRYPT_ALGORITHM and len(fields) == 6:
+        parameters = {'n': int(fields[1]), 'r': int(fields[2]), 'p': int(fields[3])}
+    else:
+        raise ValueError("Invalid password hash")
+
+    return algorithm, parameters, b64decode(fields[-2]), b64decode(fields[-1])
+
+def verify_password(password, encoded, legacy_salt=None):
+    """
+    Checks a password against an encoded hash string in constant time.
+    """
+    if not encoded:
+        return False
+
+    algorithm, parameters, salt, expected = parse_password_hash(encoded)
+
+    if algorithm == LEGACY_ALGORITHM:
+        m = hashlib.sha256()
+        m.update((legacy_salt or '').encode('utf-8'))
+        m.update(password.encode('utf-8'))
+        return hmac.compare_digest(m.hexdigest(), expected)
+
+    return hmac.compare_digest(derive_key(password, salt, algorithm, parameters), expected)
+
+def needs_rehash(encoded, algorithm=PBKDF2_ALGORITHM, parameters=None):
+    """
+    Checks if an encoded hash string uses another algorithm or other
+    parameters than the given ones.
+    """
+    parameters = parameters or DEFAULT_PARAMETERS[algorithm]
+    current_algorithm, current_parameters, _, _ = parse_password_hash(encoded)
+
+    return current_algorithm != algorithm or current_parameters != parameters
+
+def configured_parameters(config):
+    """
+    Returns a tuple with the password hash algorithm and parameters from the
+    application configuration.
+    """
+    algorithm = config['PASSWORD_ALGORITHM']
+
+    if algorithm == PBKDF2_ALGORITHM:
+        return algorithm, {'iterations': config['PBKDF2_ITERATIONS']}
+    elif algorithm == SCRYPT_ALGORITHM:
+        return algorithm, {'n': config['SCRYPT_N'], 'r': config['SCRYPT_R'], 'p': config['SCRYPT_P']}
+    else:
+        raise ValueError("Unknown password hash algorithm {}".format(algorithm))
+
+def time_hash(algorithm, parameters):
+    """
+    Returns the number of seconds it takes to hash a password.
+    """
+    salt = os.urandom(SALT_BYTES)
+    start = time.perf_counter()
+    derive_key('benchmark password', salt, algorithm, parameters)
+    return time.perf_counter() - start
+
+def benchmark(algorithm, target_ms):
+    """
+    Finds the parameters for which hashing a password takes about target_ms
+    milliseconds on this machine. Returns a tuple with the parameters and
+    the measured number of milliseconds.
+    """
+    target = target_ms / 1000
+
+    if algorithm == SCRYPT_ALGORITHM and not SCRYPT_AVAILABLE:
+        raise ValueError("scrypt needs Python built with OpenSSL 1.1 or later")
+
+    if algorithm == PBKDF2_ALGORITHM:
+        iterations = 10000
+        elapsed = time_hash(algorithm, {'iterations': iterations})
+
+        # The time grows linearly with the number of iterations.
+        iterations = max(int(iterations * target / elapsed), 1000)
+        parameters = {'iterations': iterations}
+    elif algorithm == SCRYPT_ALGORITHM:
+        # The time and memory grow linearly with n, which has to be a power
+        # of two. Use the largest n that is within the target.
+        parameters = {'n': 2**10, 'r': 8, 'p': 1}
+        while parameters['n'] < 2**20:
+            larger = dict(parameters, n=parameters['n'] * 2)
+            if time_hash(algorithm, larger) > target:
+                break
+            parameters = larger
+    else:
+        raise ValueError("Unknown password hash algorithm {}".format(algorithm))
+
+    return parameters, time_hash(algorithm, parameters) * 1000
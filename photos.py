@@ -1,4 +1,7 @@
-from util import load_json
+from util import load_json, file_signature
+import os.path
+import threading
+import time
 
 def get_thumbnail_s3_url(collection_name, image_name):
     """
@@ -14,6 +17,22 @@ def get_photo_s3_url(collection_name, image_name):
     f = 'https://rainforestphotos.s3.amazonaws.com/{}/{}'
     return f.format(collection_name, image_name)
 
+def get_resized_s3_url(collection_name, image_name, width, extension):
+    """
+    Creates the url of a resized version of an image, as written by
+    process_photos.py.
+    """
+    stem = os.path.splitext(image_name)[0]
+    f = 'https://rainforestphotos.s3.amazonaws.com/{}/w{}/{}{}'
+    return f.format(collection_name, width, stem, extension)
+
+def get_srcset(collection_name, image_name, widths, extension):
+    """
+    Creates a srcset attribute value with the resized versions of an image.
+    """
+    return ', '.join('{} {}w'.format(get_resized_s3_url(collection_name, image_name, width, extension), width)
+                     for width in widths)
+
 def add_collection_thumbnail_url(collection):
     """
     Adds the collection thumbnail url to the collection.
@@ -51,14 +70,30 @@ def get_raw_photo_collection(collection_name, filename):
 
     return None
 
-def create_image_dict(collection_name, image_name):
+def create_image_dict(collection_name, image):
     """
-    Creates an image dict given the collection name and the image name.
+    Creates an image dict given the collection name and an image from the
+    collection file. The image is either the image name, or a dict with the
+    name, the width and height and the widths of the resized versions that
+    were written by process_photos.py.
     """
-    return {"name": image_name,
-            "s3url": get_photo_s3_url(collection_name, image_name),
-            "thumbnail": get_thumbnail_s3_url(collection_name, image_name),
-            "url": '/photos/{}/{}'.format(collection_name, image_name)}
+    if isinstance(image, str):
+        image = {"name": image}
+
+    image_name = image["name"]
+    result = {"name": image_name,
+              "s3url": get_photo_s3_url(collection_name, image_name),
+              "thumbnail": get_thumbnail_s3_url(collection_name, image_name),
+              "url": '/photos/{}/{}'.format(collection_name, image_name),
+              "width": image.get("width"),
+              "height": image.get("height")}
+
+    widths = image.get("widths")
+    if widths:
+        result["srcset_webp"] = get_srcset(collection_name, image_name, widths, '.webp')
+        result["srcset_jpeg"] = get_srcset(collection_name, image_name, widths, '.jpg')
+
+    return result
 
 def get_photo_collection(collection_name, filename):
     """
@@ -72,3 +107,135 @@ def get_photo_collection(collection_name, filename):
         return collection
     else:
         return None
+
+
+class PhotoRegistry:
+    """
+    Keeps the photo collection list and all the photo collections in memory,
+    with the image dicts already created, so that showing a collection or a
+    single photo is a dict lookup.
+
+    The photo collection files are checked for changes at most once every
+    reload_interval seconds. Only the collections whose file has changed are
+    loaded again. The collections returned by the registry are shared between
+    requests and must not be modified.
+    """
+
+    def __init__(self, filename, reload_interval=5):
+        self.filename = filename
+        self.folder = os.path.dirname(filename)
+        self.reload_interval = reload_interval
+        self.version = 0
+
+        self.index_signature = None
+        self.collection_list = []
+        # Maps a collection slug to a (path, signature) tuple.
+        self.signatures = {}
+        self.collections = {}
+        # Maps a (collection slug, image name) tuple to the image dict.
+        self.images = {}
+
+        self.listeners = []
+        self.last_checked = None
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        Adds a listener that is called with the registry and the list of
+        changed collection slugs every time the registry has been reloaded.
+        """
+        self.listeners.append(listener)
+
+    def refresh(self, force=False):
+        """
+        Reloads the photo collection list and the photo collections that have
+        changed since they were last loaded. Returns True if anything was
+        reloaded.
+        """
+        now = time.monotonic()
+        if not force and self.last_checked is not None:
+            if now - self.last_checked < self.reload_interval:
+                return False
+
+        with self.lock:
+            self.last_checked = now
+            changed = []
+
+            index_signature = file_signature(self.filename)
+            collection_list = self.collection_list
+            if index_signature != self.index_signature or self.index_signature is None:
+                collection_list = load_photo_collection_list(self.filename)
+
+            signatures = {}
+            collections = {}
+            for entry in collection_list:
+                slug = entry['slug']
+                path = os.path.join(self.folder, entry['collection'])
+                signature = (path, file_signature(path))
+
+                if slug in self.collections and self.signatures.get(slug) == signature:
+                    collections[slug] = self.collections[slug]
+                else:
+                    collections[slug] = self._load_collection(slug, path)
+                    changed.append(slug)
+
+                signatures[slug] = signature
+
+            changed.extend(slug for slug in self.collections if slug not in collections)
+            index_changed = index_signature != self.index_signature
+
+            if changed or index_changed:
+                images = {}
+                for slug, collection in collections.items():
+                    for image in collection['images']:
+                        images[(slug, image['name'])] = image
+
+                self.index_signature = index_signature
+                self.collection_list = collection_list
+                self.signatures = signatures
+                self.collections = collections
+                self.images = images
+                self.version += 1
+
+        if changed or index_changed:
+            for listener in self.listeners:
+                listener(self, changed)
+
+        return bool(changed or index_changed)
+
+    def _load_collection(self, collection_name, path):
+        collection = load_json(path)
+        collection['images'] = [create_image_dict(collection_name, img)
+                                for img in collection['images']]
+        return collection
+
+    def current_version(self):
+        """
+        Returns the version of the registry, which changes every time any of
+        the photo collection files is reloaded.
+        """
+        self.refresh()
+        return self.version
+
+    def get_collection_list(self):
+        """
+        Returns the photo collection list with collection and thumbnail urls.
+        """
+        self.refresh()
+        return self.collection_list
+
+    def get_collection(self, collection_name):
+        """
+        Returns the photo collection with the given name or None if there is
+        no such collection.
+        """
+        self.refresh()
+        return self.collections.get(collection_name)
+
+    def get_image(self, collection_name, image_name):
+        """
+        Returns the image dict for the given image in the given collection or
+        None if there is no such image.
+        """
+        self.refresh()
+        return self.images.get((collection_name, image_name))
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Creates the thumbnails and resized versions of the photos in a collection
+and uploads them to the photo bucket.
+
+Usage:
+
+    python process_photos.py <source-folder> <collection-slug> [--upload] [--workers N]
+
+The images are processed in parallel on all cores. Images whose source has
+not changed since the last run are skipped, and only files that have not
+been uploaded yet are uploaded. The width and height of every image and the
+widths of its resized versions are written to the collection file in the
+photos folder. Requires Pillow.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import hashlib
+import json
+import mimetypes
+import os
+import sys
+
+from flask import Config
+
+from settings import DefaultConfiguration
+from storage import create_backend
+
+# Pillow is only needed for processing photos, not for running the site.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# The widths of the resized versions. Images are never scaled up.
+WIDTHS = [480, 960, 1600]
+THUMBNAIL_SIZE = 300
+
+# The resized versions are written in these formats.
+FORMATS = [('.webp', 'WEBP', {'quality': 80, 'method': 6}),
+           ('.jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True})]
+
+# Change this when the output changes, so that every image is processed again.
+PIPELINE_VERSION = 1
+
+STATE_FILENAME = '.process_photos.json'
+
+
+def source_digest(path):
+    """
+    Returns a digest of the source image and the pipeline settings.
+    """
+    m = hashlib.sha256()
+    m.update(json.dumps([PIPELINE_VERSION, WIDTHS, THUMBNAIL_SIZE]).encode('utf-8'))
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            m.update(block)
+    return m.hexdigest()
+
+def resized_widths(width):
+    """
+    Returns the widths of the resized versions of an image that is width
+    pixels wide.
+    """
+    return [w for w in WIDTHS if w < width] or [width]
+
+def save_image(image, output_folder, key, format_name, options):
+    path = os.path.join(output_folder, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    image.save(path, format_name, **options)
+
+def process_image(source_path, output_folder, name):
+    """
+    Writes the original, the thumbnail and the resized versions of an image
+    to the output folder. Returns a dict with the image entry for the
+    collection file and the keys of the written files. Runs in a worker
+    process.
+    """
+    stem = os.path.splitext(name)[0]
+    keys = [name]
+
+    with open(source_path, 'rb') as source, open(os.path.join(output_folder, name), 'wb') as f:
+        f.write(source.read())
+
+    with Image.open(source_path) as original:
+        # Apply the exif orientation so that the resized versions are the
+        # right way up.
+        image = ImageOps.exif_transpose(original).convert('RGB')
+
+    width, height = image.size
+
+    # The thumbnail keeps the name of the image, so it has to keep the
+    # format too.
+    thumbnail = image.copy()
+    thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+    key = 'thumbs/thumb_' + name
+    if os.path.splitext(name)[1].lower() == '.png':
+        save_image(thumbnail, output_folder, key, 'PNG', {'optimize': True})
+    else:
+        save_image(thumbnail, output_folder, key, 'JPEG', FORMATS[1][2])
+    keys.append(key)
+
+    widths = resized_widths(width)
+    for w in widths:
+        resized = image.resize((w, max(1, round(height * w / width))), Image.LANCZOS)
+        for extension, format_name, options in FORMATS:
+            key = 'w{}/{}{}'.format(w, stem, extension)
+            save_image(resized, output_folder, key, format_name, options)
+            keys.append(key)
+
+    return {"entry": {"name": name, "width": width, "height": height, "widths": widths},
+            "keys": keys}
+
+def load_state(output_folder):
+    try:
+        with open(os.path.join(output_folder, STATE_FILENAME)) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def write_state(output_folder, state):
+    with open(os.path.join(output_folder, STATE_FILENAME), 'w') as f:
+        json.dump(state, f, indent=4, sort_keys=True)
+
+def process_photos(source_folder, output_folder, workers=None):
+    """
+    Processes the images in the source folder that are new or have changed
+    since the last run. Returns the image entries for all the images,
+    sorted by name.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    state = load_state(output_folder)
+
+    names = sorted(name for name in os.listdir(source_folder)
+                   if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    digests = {name: source_digest(os.path.join(source_folder, name)) for name in names}
+    changed = [name for name in names
+               if state.get(name, {}).get("digest") != digests[name]]
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(process_image,
+                               [os.path.join(source_folder, name) for name in changed],
+                               [output_folder] * len(changed),
+                               changed)
+
+        for name, result in zip(changed, results):
+            state[name] = {"digest": digests[name],
+                           "entry": result["entry"],
+                           "keys": result["keys"],
+                           "uploaded": False}
+            print("Processed {}".format(name))
+
+    for name in list(state):
+        if name not in digests:
+            del state[name]
+
+    write_state(output_folder, state)
+
+    return [state[name]["entry"] for name in names]
+
+def upload_photos(backend, bucket_name, collection_name, output_folder, workers=8):
+    """
+    Uploads the files of the images that have not been uploaded since they
+    were processed to the photo bucket in parallel.
+    """
+    state = load_state(output_folder)
+    names = [name for name, image in state.items() if not image["uploaded"]]
+    keys = [key for name in names for key in state[name]["keys"]]
+
+    def upload(key):
+        with open(os.path.join(output_folder, key), 'rb') as f:
+            content = f.read()
+
+        mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+        backend.write(bucket_name, '{}/{}'.format(collection_name, key), content, mimetype=mimetype)
+        return key
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for key in executor.map(upload, keys):
+            print("Uploaded {}".format(key))
+
+    for name in names:
+        state[name]["uploaded"] = True
+
+    write_state(output_folder, state)
+
+def update_collection_file(filename, collection_name, entries):
+    """
+    Writes the image entries to the collection file. Images that are already
+    in the collection keep their position, new images are added at the end.
+    """
+    try:
+        with open(filename) as f:
+            collection = json.loads(f.read())
+    except FileNotFoundError:
+        collection = {"name": collection_name, "images": []}
+
+    by_name = {entry["name"]: entry for entry in entries}
+    images = []
+
+    for image in collection["images"]:
+        name = image if isinstance(image, str) else image["name"]
+        images.append(by_name.pop(name, image))
+
+    images.extend(entry for entry in entries if entry["name"] in by_name)
+    collection["images"] = images
+
+    with open(filename, 'w') as f:
+        json.dump(collection, f, indent=4)
+        f.write('\n')
+
+def main():
+    config = Config('.')
+    config.from_object(DefaultConfiguration)
+
+    parser = argparse.ArgumentParser(description="Processes a photo collection.")
+    parser.add_argument('source_folder')
+    parser.add_argument('collection')
+    parser.add_argument('--upload', action='store_true',
+                        help="upload the new and changed files to the photo bucket")
+    parser.add_argument('--workers', type=int, help="the number of worker processes")
+    args = parser.parse_args()
+
+    if Image is None:
+        print("Processing photos requires Pillow. Install it with pip install Pillow.")
+        return 1
+
+    output_folder = os.path.join(config['PHOTO_BUILD_FOLDER'], args.collection)
+    entries = process_photos(args.source_folder, output_folder, args.workers)
+
+    collection_filename = os.path.join('photos', args.collection + '.json')
+    update_collection_file(collection_filename, args.collection, entries)
+    print("Wrote {} images to {}.".format(len(entries), collection_filename))
+
+    if args.upload:
+        upload_photos(create_backend(config), config['PHOTO_BUCKET'], args.collection,
+                      output_folder, workers=config['PHOTO_UPLOAD_WORKERS'])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
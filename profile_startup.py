@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Measures how long it takes to start the application and how much memory a
+freshly started worker uses.
+
+Usage:
+
+    python profile_startup.py [--module redwood] [--top 20] [--sort self|cumulative] [--repeat 3]
+
+The module is imported in a new interpreter with -X importtime. Prints the
+modules that take the longest to import, the total boot time, the resident
+memory after the import and the heavy dependencies that were imported at
+startup even though they are meant to be imported on first use. Exits with
+status 1 if any of them were imported. The import times of the modules are
+only available on Python 3.7 and later.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+# -X importtime was added in Python 3.7. Older versions ignore it, so only
+# the boot time, the memory and the loaded modules are reported there.
+IMPORT_TIMES_AVAILABLE = sys.version_info >= (3, 7)
+
+# The dependencies that are imported on first use rather than at startup.
+LAZY_MODULES = ['boto3', 'botocore', 'markdown', 'pytz', 'dateutil']
+
+# Runs in the new interpreter. Prints the boot time, the resident memory and
+# the loaded lazy modules as json.
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+rss = None
+try:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1])
+except OSError:
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"elapsed": elapsed, "rss": rss,
+                  "loaded": [m for m in {lazy_modules!r} if m in sys.modules]}}))
+"""
+
+
+def parse_import_times(output):
+    """
+    Parses the -X importtime output. Returns a list of (module, self
+    microseconds, cumulative microseconds) tuples.
+    """
+    times = []
+
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # The header line.
+            continue
+
+        times.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+
+    return times
+
+
+def profile_startup(module):
+    """
+    Imports the module in a new interpreter. Returns a dict with the boot
+    time in seconds, the resident memory in kilobytes, the loaded lazy
+    modules and the import times. The import times are empty if
+    IMPORT_TIMES_AVAILABLE is False.
+    """
+    probe = PROBE.format(module=module, lazy_modules=LAZY_MODULES)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+
+    profile = json.loads(result.stdout.strip().splitlines()[-1])
+    profile["imports"] = parse_import_times(result.stderr)
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profiles the application startup.")
+    parser.add_argument('--module', default='redwood', help="the module to import")
+    parser.add_argument('--top', type=int, default=20, help="the number of modules to show")
+    parser.add_argument('--sort', choices=['self', 'cumulative'], default='cumulative')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="import this many times and report the fastest run")
+    args = parser.parse_args()
+
+    profiles = [profile_startup(args.module) for _ in range(max(1, args.repeat))]
+    profile = min(profiles, key=lambda p: p["elapsed"])
+
+    if IMPORT_TIMES_AVAILABLE:
+        column = 1 if args.sort == 'self' else 2
+        imports = sorted(profile["imports"], key=lambda i: i[column], reverse=True)
+
+        print("{:>10} {:>10}  {}".format("self ms", "total ms", "module"))
+        for name, self_time, cumulative in imports[:args.top]:
+            print("{:>10.1f} {:>10.1f}  {}".format(self_time / 1000, cumulative / 1000, name))
+
+        print("")
+        print("Imported {} modules.".format(len(profile["imports"])))
+    else:
+        print("The import times of the modules need Python 3.7 or later.")
+
+    print("Boot time: {:.0f} ms".format(profile["elapsed"] * 1000))
+    if profile["rss"] is not None:
+        print("Resident memory: {:.1f} MB".format(profile["rss"] / 1024))
+
+    if profile["loaded"]:
+        print("Imported at startup: {}".format(", ".join(profile["loaded"])))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
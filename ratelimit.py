@@ -0,0 +1,200 @@
+from collections import OrderedDict
+import math
+import os
+import sqlite3
+import threading
+import time
+
+
+class MemoryStore:
+    """
+    Keeps the rate limit counters in memory. Only the counters of the
+    max_keys most recently used keys are kept, so the memory used is bounded
+    no matter how many clients there are.
+    """
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.counters = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, window):
+        """
+        Returns the counts of the previous and the current window for a key.
+        """
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None:
+                return 0, 0
+
+            return shift_counter(counter, window)
+
+    def increment(self, key, window):
+        """
+        Increments the count of the current window for a key.
+        """
+        with self.lock:
+            counter = self.counters.pop(key, None)
+            previous, current = shift_counter(counter, window) if counter else (0, 0)
+
+            self.counters[key] = (window, previous, current + 1)
+
+            while len(self.counters) > self.max_keys:
+                self.counters.popitem(last=False)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+
+
+class SqliteStore:
+    """
+    Keeps the rate limit counters in a sqlite database on the local disk, so
+    that all the worker processes on a machine share the counters. Counters
+    that are more than a window old are deleted every cleanup_interval
+    increments.
+    """
+
+    def __init__(self, filename, cleanup_interval=1000):
+        self.filename = filename
+        self.cleanup_interval = cleanup_interval
+        self.increments = 0
+        self.local = threading.local()
+
+        directory = os.path.dirname(filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS counters ("
+                               "key TEXT PRIMARY KEY, "
+                               "window INTEGER NOT NULL, "
+                               "previous INTEGER NOT NULL, "
+                               "current INTEGER NOT NULL)")
+
+    def connection(self):
+        """
+        Returns the database connection of the current thread. Connections
+        are not shared between threads or processes.
+        """
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            self.local.connection = sqlite3.connect(self.filename, timeout=5,
+                                                    isolation_level=None)
+            self.local.pid = pid
+
+        return self.local.connection
+
+    def get(self, key, window):
+        row = self.connection().execute(
+            "SELECT window, previous, current FROM counters WHERE key = ?", (key,)).fetchone()
+
+        if row is None:
+            return 0, 0
+
+        return shift_counter(row, window)
+
+    def increment(self, key, window):
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT window, previous, current FROM counters WHERE key = ?", (key,)).fetchone()
+            previous, current = shift_counter(row, window) if row else (0, 0)
+
+            connection.execute("INSERT OR REPLACE INTO counters VALUES (?, ?, ?, ?)",
+                               (key, window, previous, current + 1))
+
+            self.increments += 1
+            if self.increments % self.cleanup_interval == 0:
+                connection.execute("DELETE FROM counters WHERE window < ?", (window - 1,))
+
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def reset(self):
+        self.connection().execute("DELETE FROM counters")
+
+
+def shift_counter(counter, window):
+    """
+    Returns the counts of the previous and the current window for a counter
+    that was last incremented in another window.
+    """
+    counter_window, previous, current = counter
+
+    if counter_window == window:
+        return previous, current
+    elif counter_window == window - 1:
+        return current, 0
+    else:
+        return 0, 0
+
+
+class RateLimiter:
+    """
+    Limits the number of hits per key to limit per period seconds.
+
+    Uses a sliding window counter. The hits are counted in fixed windows of
+    period seconds, and the number of hits in the last period seconds is
+    estimated from the counts of the current and the previous window,
+    weighting the previous window by how much of it is still inside the
+    sliding window. This needs two counters per key instead of one timestamp
+    per hit.
+    """
+
+    def __init__(self, store, limit, period):
+        self.store = store
+        self.limit = limit
+        self.period = period
+
+    def window(self, now):
+        return int(now // self.period), (now % self.period) / self.period
+
+    def retry_after(self, key, now=None):
+        """
+        Returns the number of seconds until the key may be hit again, or None
+        if the key is within its limit.
+        """
+        now = time.time() if now is None else now
+        window, elapsed = self.window(now)
+        previous, current = self.store.get(key, window)
+
+        if previous * (1 - elapsed) + current < self.limit:
+            return None
+
+        if current >= self.limit:
+            # Wait for the next window, and then for the current window to
+            # slide far enough out of the sliding window.
+            wait = (1 - elapsed) + (1 - self.limit / current)
+        else:
+            wait = (1 - (self.limit - current) / previous) - elapsed
+
+        return max(1, math.ceil(wait * self.period))
+
+    def hit(self, key, now=None):
+        """
+        Counts a hit for the key.
+        """
+        now = time.time() if now is None else now
+        window, _ = self.window(now)
+        self.store.increment(key, window)
+
+    def reset(self):
+        self.store.reset()
+
+
+def create_rate_limit_store(config):
+    """
+    Creates the rate limit store selected by the RATE_LIMIT_STORE setting.
+    """
+    name = config['RATE_LIMIT_STORE']
+
+    if name == 'memory':
+        return MemoryStore(max_keys=config['RATE_LIMIT_MAX_KEYS'])
+    elif name == 'sqlite':
+        return SqliteStore(config['RATE_LIMIT_SQLITE_FILENAME'])
+    else:
+        raise ValueError("Unknown rate limit store {}".format(name))
@@ -1,28 +1,28 @@
 import os
 import time
-import pytz
 import json
-from dateutil.relativedelta import relativedelta
 
 from flask import (
     Flask,
+    Response,
     render_template,
     request,
-    make_response
+    make_response,
+    g
 )
 from flask import redirect, url_for, abort, send_file
 from flask import send_from_directory
 from werkzeug import secure_filename
+from jinja2 import FileSystemBytecodeCache
 import settings
+from storage import configure_storage, get_backend, storage_metrics
+from downloads import send_stored_file
 from storage import (
     get_s3_files_from_result,
     get_s3_folders_from_result
 )
 from storage import (
-    read_s3_bucket_folder,
-    read_s3_file,
-    write_s3_file,
-    read_s3_stream,
+    write_s3_stream,
     delete_s3_file
 )
 from photos import (
@@ -32,17 +32,23 @@ from photos import (
 )
 from photos import (
     add_collection_url,
-    load_photo_collection_list,
     get_raw_photo_collection
 )
-from photos import (
-    create_image_dict,
-    get_photo_collection
-)
-
-from bookmarks import load_all_bookmarks
-from bookmarks import load_bookmark_collections
-from writings import load_writing
+from photos import create_image_dict
+from photos import PhotoRegistry
+
+from bookmarks import BookmarkCatalog
+from bookmarks import encode_cursor, decode_cursor
+from search import BookmarkIndex
+from http_cache import Payload, PayloadCache, payload_response
+from page_cache import PageCache
+from listing_cache import ListingCache
+from assets import AssetStore
+from identity_cache import IdentityCache
+from ratelimit import RateLimiter, create_rate_limit_store
+from passwords import configured_parameters, hash_password, needs_rehash, verify_password
+from notes import NotesCache, NotesMirror, sync_notes
+from writings import WritingStore
 
 from util import load_json
 from datetime import (
@@ -51,28 +57,176 @@ from datetime import (
 )
 
 import jwt
-import hashlib
-from jwt import ExpiredSignatureError
+import hmac
+from jwt import InvalidTokenError
 from functools import wraps
 
-from markdown import markdown
-
 from settings import load_environment_variable
 
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    """
+    A bytecode cache that finds a compiled template by its name only. Jinja
+    also uses the absolute filename of the template, but the templates are
+    compiled by build.py in another folder than the one the application runs
+    from. A changed template is still compiled again, since jinja checks the
+    checksum of the source stored with the bytecode.
+    """
+
+    def get_cache_key(self, name, filename=None):
+        return super().get_cache_key(name)
+
+
 def create_app():
     app = Flask(__name__)
     app.config.from_object(settings.DefaultConfiguration)
 
+    # The jinja options have to be set before the jinja environment is
+    # created on first use.
+    cache_folder = app.config['TEMPLATE_CACHE_FOLDER']
+    if cache_folder:
+        os.makedirs(cache_folder, exist_ok=True)
+        app.jinja_options = dict(app.jinja_options,
+                                 bytecode_cache=TemplateBytecodeCache(cache_folder))
+
     return app
 
 
 app = create_app()
 
+configure_storage(app.config)
+
+bookmark_catalog = BookmarkCatalog(
+    reload_interval=app.config['BOOKMARK_RELOAD_INTERVAL'],
+    bundle_filename=app.config['BOOKMARK_BUNDLE_FILENAME'])
+
+bookmark_index = BookmarkIndex()
+bookmark_catalog.add_listener(bookmark_index.update)
+
+bookmark_payloads = PayloadCache()
+
+photo_registry = PhotoRegistry(
+    app.config['PHOTO_COLLECTION_FILENAME'],
+    reload_interval=app.config['PHOTO_RELOAD_INTERVAL'])
+
+page_cache = PageCache(app.config['PAGE_CACHE_MAX_BYTES'],
+                       app.config['PAGE_CACHE_TTL'],
+                       logged_in=lambda: get_current_user() is not None)
+
+writing_store = WritingStore(
+    reload_interval=app.config['WRITING_RELOAD_INTERVAL'],
+    artifact_filename=app.config['WRITINGS_ARTIFACT_FILENAME'])
+
+if app.config['WRITINGS_PRECOMPILE']:
+    writing_store.refresh()
+
+identity_cache = IdentityCache(app.config['IDENTITY_CACHE_SIZE'])
+
+asset_store = AssetStore(build_folder=app.config['ASSET_BUILD_FOLDER'],
+                         max_memory_size=app.config['ASSET_MEMORY_MAX_SIZE'])
+
+rate_limit_store = create_rate_limit_store(app.config)
+login_ip_limiter = RateLimiter(rate_limit_store,
+                               app.config['LOGIN_RATE_LIMIT_PER_IP'],
+                               app.config['LOGIN_RATE_LIMIT_PERIOD'])
+login_username_limiter = RateLimiter(rate_limit_store,
+                                     app.config['LOGIN_RATE_LIMIT_PER_USERNAME'],
+                                     app.config['LOGIN_RATE_LIMIT_PERIOD'])
+
+listing_cache = ListingCache(get_backend, ttl=app.config['LISTING_CACHE_TTL'])
+
+notes_cache = NotesCache(get_backend, app.config['NOTES_BUCKET'],
+                         cache_folder=app.config['NOTES_CACHE_FOLDER'],
+                         max_bytes=app.config['NOTES_CACHE_MAX_BYTES'],
+                         ttl=app.config['NOTES_CACHE_TTL'])
+
+notes_mirror = NotesMirror(app.config['NOTES_MIRROR_FOLDER'])
+
+def sync_notes_mirror():
+    """
+    Mirrors the notes bucket to the local disk. Called by the gunicorn master
+    before the workers are forked when NOTES_SYNC_ON_STARTUP is set.
+    """
+    try:
+        changed, removed = sync_notes(get_backend(), app.config['NOTES_BUCKET'],
+                                      app.config['NOTES_MIRROR_FOLDER'],
+                                      workers=app.config['NOTES_SYNC_WORKERS'])
+        app.logger.info("Synced the notes mirror. Downloaded {} and removed {} notes.".format(
+            len(changed), len(removed)))
+    except Exception:
+        app.logger.exception("Could not sync the notes mirror")
+
+def precompile_templates():
+    """
+    Compiles all the templates, so that the first render of a template does
+    not have to. The compiled templates are also written to the template
+    cache folder. Returns the number of templates.
+    """
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+def warm_up():
+    """
+    Loads the bookmarks, photo collections, writings and assets and compiles
+    the templates, so that the first requests are as fast as later ones. In
+    a preloaded gunicorn master this is done once before the workers are
+    forked, so the workers share the loaded data.
+    """
+    bookmark_catalog.refresh(force=True)
+    photo_registry.refresh(force=True)
+    writing_store.refresh(force=True)
+    asset_store.load()
+    precompile_templates()
+
+bookmark_catalog.add_listener(lambda catalog, changed: page_cache.invalidate('bookmarks'))
+photo_registry.add_listener(lambda registry, changed: page_cache.invalidate('photos'))
+writing_store.add_listener(lambda store, changed: page_cache.invalidate('writings'))
+
 
 @app.route('/favicon.png')
 def favicon():
+    # The favicon url can not be fingerprinted, so it is only cached for a day.
     return send_from_directory(os.path.join(app.root_path, 'static'),
-                               'favicon.png', mimetype='image/png')
+                               'favicon.png', mimetype='image/png',
+                               cache_timeout=24*60*60)
+
+
+@app.template_global()
+def static_url(name):
+    """
+    Returns the fingerprinted url of a file in the static folder.
+    """
+    return asset_store.url(name)
+
+
+@app.route('/assets/<path:path>')
+def assets(path):
+    """
+    Serves a fingerprinted asset. The content of a fingerprinted url never
+    changes, so browsers can cache it forever without revalidating.
+    """
+    asset = asset_store.get(path)
+
+    if asset is None:
+        abort(404)
+
+    encoding = asset.choose_encoding(request.accept_encodings)
+
+    if encoding in asset.variants:
+        response = make_response(asset.variants[encoding])
+        response.mimetype = asset.mimetype
+    else:
+        response = send_file(asset.files[encoding], mimetype=asset.mimetype)
+
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
 
 
 def get_jwt_from_request():
@@ -89,23 +243,46 @@ def get_jwt_from_request():
         return header_identity_jwt
 
 
-def get_current_user():
+def decode_identity(identity_jwt):
     """
-    Gets the current user. Gets the JWT from the request and parses out
-    the result. Returns None if the JWT has expired.
+    Verifies an identity JWT and returns its claims. Returns None if the JWT
+    has expired or is invalid. The claims of verified tokens are cached until
+    they expire.
     """
-    identity_jwt = get_jwt_from_request()
+    secret = app.config['IDENTITY_JWT_SECRET']
+    identity = identity_cache.get(secret, identity_jwt)
 
-    if identity_jwt:
+    if identity is None:
         try:
-            secret = app.config['IDENTITY_JWT_SECRET']
             identity = jwt.decode(identity_jwt.encode('utf-8'),
                                   secret, algorithms=['HS256'])
-            return identity
-        except ExpiredSignatureError as err:
-            return None
+            identity_cache.put(secret, identity_jwt, identity)
+        except InvalidTokenError as err:
+            identity = None
 
-    return None
+    return identity
+
+
+def get_current_user():
+    """
+    Gets the current user. Gets the JWT from the request and parses out
+    the result. Returns None if the JWT has expired or is invalid.
+
+    The result is remembered for the rest of the request.
+    """
+    identity_jwt = get_jwt_from_request()
+
+    if not identity_jwt:
+        return None
+
+    memoized = g.get('current_user')
+    if memoized is not None and memoized[0] == identity_jwt:
+        return memoized[1]
+
+    identity = decode_identity(identity_jwt)
+
+    g.current_user = (identity_jwt, identity)
+    return identity
 
 
 @app.context_processor
@@ -128,6 +305,10 @@ def require_https():
     if not app.config['HTTPS_REQUIRED']:
         return None
 
+    # Public static files do not need to be redirected to HTTPS.
+    if request.endpoint in ('assets', 'favicon', 'static'):
+        return None
+
     # If we are already using HTTPS then do nothing.
     protocol_header = request.headers.get('x-forwarded-proto')
     if protocol_header == 'https':
@@ -144,6 +325,50 @@ def require_https():
     return None
 
 
+def get_client_ip():
+    """
+    Gets the ip address of the client. On Heroku the router appends the
+    address of the client to the X-Forwarded-For header. Earlier values in
+    the header are sent by the client and can not be trusted.
+    """
+    forwarded_for = request.headers.get('X-Forwarded-For')
+
+    if forwarded_for:
+        return forwarded_for.split(',')[-1].strip()
+
+    return request.remote_addr
+
+
+@app.before_request
+def limit_login_attempts():
+    """
+    Limits the number of login attempts per client ip address and per
+    username, so that guessing passwords does not keep the workers busy
+    hashing passwords. Responds with 429 Too Many Requests when the limit
+    has been reached.
+    """
+    if request.method != 'POST' or request.endpoint != 'login':
+        return None
+
+    now = time.time()
+    keys = [(login_ip_limiter, 'login-ip:' + (get_client_ip() or '')),
+            (login_username_limiter, 'login-username:' + request.form.get('username', ''))]
+
+    for limiter, key in keys:
+        retry_after = limiter.retry_after(key, now)
+        if retry_after is not None:
+            response = make_response(render_template("login.html",
+                login_error_message="Too many login attempts. Try again later.",
+                action_url=url_for('login', redirect=request.args.get('redirect'))), 429)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
+    for limiter, key in keys:
+        limiter.hit(key, now)
+
+    return None
+
+
 def login_required(f):
     """
     The login required decorator will redirect you to the login page if you are not
@@ -171,62 +396,58 @@ def index():
     return render_template('index.html')
 
 
-def validate_bookmarks(bookmark_categories):
+@app.route('/bookmarks')
+@page_cache.cached('bookmarks', version=bookmark_catalog.current_version)
+def bookmarks():
     """
-    Validate a list of bookmark categories from the bookmarks.
+    Show the different bookmark categories.
     """
-    errors = []
-    for collection in bookmark_categories:
-        slug = collection.get('slug', None)
-        category = collection.get('category', None)
-        visibility = collection.get('visibility', None)
+    user = get_current_user()
+
+    if user is None:
+        bookmark_categories = bookmark_catalog.public_collections()
+    else:
+        bookmark_categories = bookmark_catalog.all_collections()
+
+    return render_template('bookmarks.html', categories=bookmark_categories)
 
-        if category is None:
-            errors.append("Missing category")
 
-        if slug is None:
-            if category is not None:
-                errors.append("Missing slug for category {}".format(category))
-            else:
-                errors.append("Missing slug")
+def search_bookmarks(query):
+    """
+    Searches the bookmarks. Bookmarks in private categories are only included
+    if there is a logged in user.
+    """
+    limit = app.config['BOOKMARK_SEARCH_LIMIT']
+    include_private = get_current_user() is not None
 
-        if visibility is None:
-            if category is not None:
-                errors.append("Missing visibility for category {}".format(category))
-            elif slug is not None:
-                errors.append("Missing visibility for slug {}".format(slug))
-            else:
-                errors.append("Missing visibility")
+    # Make sure that the index contains the latest bookmarks.
+    bookmark_catalog.refresh()
 
-    return errors
+    return bookmark_index.search(query, include_private=include_private, limit=limit)
 
 
-@app.route('/bookmarks')
-def bookmarks():
+@app.route('/bookmarks/search')
+def bookmark_search():
     """
-    Show the different bookmark categories.
+    Search the bookmarks.
     """
-    user = get_current_user()
-    bookmark_categories = load_all_bookmarks()
+    query = request.args.get('q', '')
+    results = search_bookmarks(query)
 
-    if user is None:
-        bookmark_categories = [c for c in bookmark_categories if c['visibility'] == 'public']
-
-    return render_template('bookmarks.html', categories=bookmark_categories)
+    return render_template('bookmark-search.html', query=query, results=results)
 
 
 @app.route('/bookmarks/<collection_slug>')
+@page_cache.cached('bookmarks', version=bookmark_catalog.current_version)
 def bookmark_category(collection_slug):
     """
     Show the bookmarks for a given category.
     """
-    bookmark_collections = load_bookmark_collections()
+    collection = bookmark_catalog.get(collection_slug)
 
-    if not collection_slug in bookmark_collections:
+    if collection is None:
         abort(404)
 
-    collection = bookmark_collections[collection_slug]
-
     user = get_current_user()
     if user is None:
         if collection["visibility"] == "private":
@@ -237,44 +458,42 @@ def bookmark_category(collection_slug):
                            bookmarks=collection['bookmarks'])
 
 @app.route('/photos')
+@page_cache.cached('photos', version=photo_registry.current_version)
 def photo_collection_list():
     """
     Show list of photo collections.
     """
-    filename = app.config['PHOTO_COLLECTION_FILENAME']
-    photo_collections = load_photo_collection_list(filename)
+    photo_collections = photo_registry.get_collection_list()
     return render_template('photo-collection-list.html',
                            photo_collections=photo_collections)
 
 
 @app.route('/photos/<collection_name>')
+@page_cache.cached('photos', version=photo_registry.current_version)
 def photo_collection(collection_name):
     """
     Show a single photo collection.
     """
-    filename = app.config['PHOTO_COLLECTION_FILENAME']
-    collection = get_photo_collection(collection_name, filename)
+    collection = photo_registry.get_collection(collection_name)
 
-    if(collection):
-        return render_template('photo-collection.html', collection=collection)
-    else:
-        return "Could not find the collection. Should return a nice 404 error here."
+    if not collection:
+        abort(404)
+
+    return render_template('photo-collection.html', collection=collection)
 
 
 @app.route('/photos/<collection_name>/<photo>')
+@page_cache.cached('photos', version=photo_registry.current_version)
 def single_photo(collection_name, photo):
     """
     Show a single photo from a photo collection.
     """
-    filename = app.config['PHOTO_COLLECTION_FILENAME']
-    collection = get_photo_collection(collection_name, filename)
+    image = photo_registry.get_image(collection_name, photo)
 
-    if collection:
-        for image in collection['images']:
-            if image['name'] == photo:
-                return render_template("photo.html", image=image)
+    if not image:
+        abort(404)
 
-    return 'Could not find matching photo. Should return a nice 404 error here.'
+    return render_template("photo.html", image=image)
 
 
 @app.route('/time')
@@ -286,6 +505,9 @@ def current_time():
               {"name": "California:", "tz": "America/Los_Angeles"},
               {"name": "Wyoming:", "tz": "US/Mountain"}]
 
+    # pytz is only needed by this page, so it is not imported at startup.
+    import pytz
+
     for place in places:
         place['time'] = datetime.now(pytz.timezone(place['tz'])).strftime("%H:%M")
 
@@ -296,18 +518,34 @@ def valid_credentials(username, password):
     """
     Validates the users login credentials.
     """
-    if(username != app.config['USERNAME']):
+    expected_username = app.config['USERNAME'] or ''
+    valid_username = hmac.compare_digest(username.encode('utf-8'),
+                                         expected_username.encode('utf-8'))
+
+    # Always check the password so that the time taken does not reveal
+    # whether the username was valid.
+    password_hash = app.config['PASSWORD_HASH']
+    try:
+        valid_password = verify_password(password, password_hash,
+                                         legacy_salt=app.config['PASSWORD_SALT'])
+    except ValueError:
+        app.logger.exception("PASSWORD_HASH is not a valid password hash. "
+                             "Create a new hash with calc_password.py.")
+        valid_password = False
+
+    if not (valid_username and valid_password):
         return False
 
-    # Calculates the password hash using the sha256 algorithm.
-    # Uses salt and the password to calculate the password hash.
-    m = hashlib.sha256()
-    salt = app.config['PASSWORD_SALT']
-    m.update(salt.encode('utf-8'))
-    m.update(password.encode('utf-8'))
-    password_hash = m.hexdigest()
+    algorithm, parameters = configured_parameters(app.config)
+    if needs_rehash(password_hash, algorithm, parameters):
+        # The hash is stored in an environment variable that can not be
+        # updated from here. Use the new hash in this process and ask the
+        # operator to replace the environment variable.
+        app.config['PASSWORD_HASH'] = hash_password(password, algorithm, parameters)
+        app.logger.warning("PASSWORD_HASH does not use the configured algorithm "
+                           "and parameters. Create a new hash with calc_password.py.")
 
-    return password_hash == app.config['PASSWORD_HASH']
+    return True
 
 
 def create_user_jwt(username, expiration_time_delta, roles):
@@ -482,18 +720,32 @@ def notes(path='/'):
     In other words they require authentication to access.
     """
 
+    # Serve the notes from the local mirror if the notes have been synced.
+    use_mirror = notes_mirror.available()
+
     # If this is a folder
     if path.endswith('/'):
-        folders, files = read_s3_bucket_folder('redwood-notes', path)
+        if use_mirror:
+            folders, files = notes_mirror.list_folder(path)
+        else:
+            folders, files = listing_cache.list_folder(app.config['NOTES_BUCKET'], path)
 
         folders = process_folders(folders)
         files = process_files(path, files)
 
         return render_template('notes-folder.html', folders=folders, files=files)
     else: # Otherwise this is a file
-        text = read_s3_file('redwood-notes', path)
+        note = notes_mirror.get(path) if use_mirror else None
+
+        # Notes that were published after the mirror was synced are read
+        # from the bucket.
+        if note is None:
+            note = notes_cache.get(path)
 
-        return render_template('notes-file.html', text=text)
+        if note is None:
+            abort(404)
+
+        return render_template('notes-file.html', text=note.text, html=note.html)
 
 
 @app.route('/hacks')
@@ -536,16 +788,18 @@ def files():
     """
     Upload and download files.
     """
-    bucket_name = 'redwood-files'
+    bucket_name = app.config['FILES_BUCKET']
 
     if request.method == 'POST':
         f = request.files['file']
         if(f):
-            write_s3_file(bucket_name, secure_filename(f.filename), f.read())
+            key = secure_filename(f.filename)
+            write_s3_stream(bucket_name, key, f.stream)
+            listing_cache.added(bucket_name, key)
 
         return redirect(url_for('files'))
     else:
-        _, file_list = read_s3_bucket_folder(bucket_name, '/')
+        _, file_list = listing_cache.list_folder(bucket_name, '/')
         return render_template('file-list.html', file_list=file_list)
 
 
@@ -554,9 +808,10 @@ def delete_file(filename):
     """
     Delete a single file. The filename can not contain / characters.
     """
-    bucket_name = 'redwood-files'
+    bucket_name = app.config['FILES_BUCKET']
     if request.method == 'POST':
         delete_s3_file(bucket_name, filename)
+        listing_cache.removed(bucket_name, filename)
 
         return redirect(url_for('files'))
     else:
@@ -570,10 +825,12 @@ def single_file(filename):
     Upload or download a single file. The filename can not contain slash /
     characters.
     """
-    bucket_name = 'redwood-files'
+    bucket_name = app.config['FILES_BUCKET']
 
     if request.method == 'PUT':
-        write_s3_file(bucket_name, secure_filename(filename), request.data)
+        key = secure_filename(filename)
+        write_s3_stream(bucket_name, key, request.stream)
+        listing_cache.added(bucket_name, key)
         return redirect(url_for('files'))
     else:
         # Both wget and curl send the following Accept header.
@@ -582,9 +839,7 @@ def single_file(filename):
         # This allows us to return different pages for web browsers and curl/wget.
         # I'm not sure that I want to do this.
 
-        file_stream = read_s3_stream(bucket_name, filename)
-        return send_file(file_stream,
-                         mimetype=mimetype_from_extension(filename))
+        return download_file(bucket_name, filename)
 
 @app.route('/work')
 def work():
@@ -620,9 +875,26 @@ def mimetype_from_extension(filename):
     return extensionMap.get(extension.lower(), "application/octet-stream")
 
 
+def download_file(bucket_name, filename):
+    """
+    Sends a file from storage. In download redirect mode large files are
+    sent as a redirect to a presigned url instead.
+    """
+    if app.config['DOWNLOAD_REDIRECT']:
+        redirect_min_size = app.config['DOWNLOAD_REDIRECT_MIN_SIZE']
+    else:
+        redirect_min_size = None
+
+    return send_stored_file(bucket_name, filename,
+                            mimetype_from_extension(filename),
+                            buffer_size=app.config['DOWNLOAD_BUFFER_SIZE'],
+                            redirect_min_size=redirect_min_size,
+                            redirect_expires_in=app.config['PRESIGNED_URL_EXPIRATION'])
+
+
 @app.route('/public/<token>/<filename>')
 def public_files(token, filename):
-    bucket_name = 'redwood-files'
+    bucket_name = app.config['FILES_BUCKET']
     expected_token = load_environment_variable('PUBLIC_FILE_TOKEN')
     filename = secure_filename(filename)
 
@@ -630,51 +902,71 @@ def public_files(token, filename):
         abort(500)
 
     if token == expected_token:
-        file_stream = read_s3_stream(bucket_name, filename)
-        return send_file(file_stream,
-                         mimetype=mimetype_from_extension(filename))
+        return download_file(bucket_name, filename)
     else:
         raise abort(403)
 
 
 def render_markdown(title, markdown_filename):
-    content = load_writing(markdown_filename)
+    writing = writing_store.get(markdown_filename)
 
-    # Use the fenced_code markdown extension to get support for newlines
-    # in code blocks.
-    html = markdown(content, extensions=['markdown.extensions.fenced_code'])
+    if writing is None:
+        abort(404)
 
     return render_template("content.html",
-                           content=html,
+                           content=writing['html'],
                            title=title)
 
 
+@app.route('/writing/<slug>')
+@page_cache.cached('writings', version=writing_store.current_version)
+def writing(slug):
+    """
+    Shows a markdown file from the writing folder. The slug is the filename
+    without the .md extension and with underscores replaced by dashes.
+    """
+    writing = writing_store.get_by_slug(slug)
+
+    if writing is None:
+        abort(404)
+
+    return render_template("content.html",
+                           content=writing['html'],
+                           title=writing['title'])
+
+
 @app.route('/interesting-languages')
+@page_cache.cached('writings', version=writing_store.current_version)
 def interesting_languages():
     return render_markdown("Interesting Languages", "interesting-languages.md")
 
 
 @app.route('/gpg')
+@page_cache.cached('writings', version=writing_store.current_version)
 def gpg():
     return render_markdown("GPG", "gpg.md")
 
 
 @app.route('/ssh-keys')
+@page_cache.cached('writings', version=writing_store.current_version)
 def ssh_keys():
     return render_markdown("SSH keys", "ssh_keys.md")
 
 
 @app.route('/learning')
+@page_cache.cached('writings', version=writing_store.current_version)
 def learning():
     return render_markdown("Learning", "learning.md")
 
 
 @app.route('/psychology')
+@page_cache.cached('writings', version=writing_store.current_version)
 def psychology():
     return render_markdown("Psychology", "psychology.md")
 
 
 @app.route('/game-development-programming-languages')
+@page_cache.cached('writings', version=writing_store.current_version)
 def game_development_programming_languages():
     return render_markdown("Game Development Programming Languages",
                            "game_development_programming_languages.md")
@@ -690,6 +982,7 @@ def days_left():
     if days == 0:
         message = "Target date is today"
     elif days > 0:
+        from dateutil.relativedelta import relativedelta
         delta = relativedelta(target_date, now)
         message = "{} months and {} days left".format(delta.months, delta.days)
     else:
@@ -698,18 +991,172 @@ def days_left():
     return render_template("days_left.html", message=message)
 
 
+def create_public_bookmarks_payload(compact):
+    """
+    Serializes the public bookmark categories. The compact variant is not
+    indented.
+    """
+    filtered_bookmarks = [{"bookmarks": b["bookmarks"],
+                         "category": b["category"],
+                         "slug": b["slug"]} for b in bookmark_catalog.public_collections()]
+
+    if compact:
+        body = json.dumps(filtered_bookmarks, separators=(',', ':'), sort_keys=True)
+    else:
+        body = json.dumps(filtered_bookmarks, indent=4, sort_keys=True)
+
+    return Payload(body.encode('utf-8'), 'application/json',
+                   last_modified=bookmark_catalog.last_modified())
+
+
+# The bookmark category fields that can be selected with ?fields= in the
+# bookmark api.
+BOOKMARK_API_FIELDS = ['bookmarks', 'category', 'slug', 'url']
+BOOKMARK_API_PAGE_ARGUMENTS = ['category', 'fields', 'limit', 'cursor']
+
+
 @app.route('/api/bookmarks')
 def api_bookmarks():
-    all_bookmarks, errors = load_all_bookmarks()
+    """
+    Returns the public bookmark categories as json. The serialized payload is
+    cached for every version of the bookmark catalog. Use ?compact=1 to get
+    json without indentation.
+
+    The category, fields, limit and cursor arguments return a page of the
+    bookmark categories instead. See api_bookmarks_page.
+    """
+    errors = bookmark_catalog.validation_errors()
 
     if errors:
         return { "errors": ["There was an error parsing the bookmarks file"] }, 500
 
-    filtered_bookmarks = [{"bookmarks": b["bookmarks"],
-                         "category": b["category"],
-                         "slug": b["slug"]} for b in all_bookmarks
-                        if b['visibility'] == 'public']
-    response = make_response(json.dumps(filtered_bookmarks, indent=4, sort_keys=True))
+    if any(argument in request.args for argument in BOOKMARK_API_PAGE_ARGUMENTS):
+        return api_bookmarks_page()
+
+    compact = request.args.get('compact', '') not in ('', '0', 'false')
+    payload = bookmark_payloads.get(bookmark_catalog.version, compact,
+                                    lambda: create_public_bookmarks_payload(compact))
+
+    return payload_response(payload)
+
+
+def api_bookmarks_page():
+    """
+    Streams a page of the public bookmark categories.
+
+    ?category= is a comma separated list of category slugs to include.
+    ?fields= is a comma separated list of the category fields to include.
+    ?limit= is the maximum number of categories in the page.
+    ?cursor= is the next_cursor value from the previous page.
+    """
+    slugs = request.args.get('category')
+    if slugs:
+        slugs = set(slugs.split(','))
+    else:
+        slugs = None
+
+    fields = request.args.get('fields')
+    if fields:
+        fields = fields.split(',')
+        for field in fields:
+            if field not in BOOKMARK_API_FIELDS:
+                return {"errors": ["Unknown field {}".format(field)]}, 400
+    else:
+        fields = ['bookmarks', 'category', 'slug']
+
+    max_limit = app.config['BOOKMARK_API_MAX_LIMIT']
+    try:
+        limit = int(request.args.get('limit', max_limit))
+    except ValueError:
+        return {"errors": ["The limit must be a number"]}, 400
+
+    if limit < 1:
+        return {"errors": ["The limit must be at least 1"]}, 400
+
+    limit = min(limit, max_limit)
+
+    cursor = request.args.get('cursor')
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        collections = bookmark_catalog.iter_collections(after=after)
+    except ValueError:
+        return {"errors": ["Invalid cursor"]}, 400
+
+    return Response(generate_bookmarks_page(collections, slugs, fields, limit),
+                    mimetype='application/json')
+
+
+def generate_bookmarks_page(collections, slugs, fields, limit):
+    """
+    Generates the json for a page of bookmark categories one category at a
+    time so that the whole page is never held in memory.
+    """
+    yield '{"categories":['
+
+    count = 0
+    last_position = None
+    has_more = False
+
+    for filename, collection in collections:
+        if collection['visibility'] != 'public':
+            continue
+
+        if slugs is not None and collection['slug'] not in slugs:
+            continue
+
+        if count == limit:
+            has_more = True
+            break
+
+        item = {field: collection[field] for field in fields}
+        separator = ',' if count else ''
+        yield separator + json.dumps(item, separators=(',', ':'), sort_keys=True)
+
+        count += 1
+        last_position = (filename, collection['ordinal'])
+
+    if has_more:
+        next_cursor = encode_cursor(*last_position)
+    else:
+        next_cursor = None
+
+    yield '],"next_cursor":{}}}'.format(json.dumps(next_cursor))
+
+
+@app.route('/api/bookmarks/search')
+def api_bookmark_search():
+    query = request.args.get('q', '')
+    results = search_bookmarks(query)
+
+    response = make_response(json.dumps({"query": query, "results": results},
+                                        indent=4, sort_keys=True))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/api/page-cache')
+@login_required
+def api_page_cache():
+    """
+    Shows the hit and miss counters of the page cache.
+    """
+    response = make_response(json.dumps(page_cache.stats(), indent=4, sort_keys=True))
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@app.route('/api/storage-metrics')
+@login_required
+def api_storage_metrics():
+    """
+    Shows the client and connection reuse counters of the storage backend and
+    the counters of the listing and notes caches.
+    """
+    metrics = storage_metrics()
+    metrics["listing_cache"] = listing_cache.stats()
+    metrics["notes_cache"] = notes_cache.stats()
+
+    response = make_response(json.dumps(metrics, indent=4, sort_keys=True))
     response.headers['Content-Type'] = 'application/json'
     return response
 
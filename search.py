@@ -0,0 +1,187 @@
+from bisect import bisect_left
+from urllib.parse import urlparse
+import re
+import threading
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+# How much a match in the different parts of a bookmark counts when ranking
+# the search results.
+TEXT_WEIGHT = 4
+CATEGORY_WEIGHT = 2
+HOST_WEIGHT = 2
+PATH_WEIGHT = 1
+
+# A prefix match counts less than a match of the whole token.
+PREFIX_FACTOR = 0.5
+
+# Terms shorter than this are only matched against whole tokens since a one
+# letter prefix matches a large part of the index.
+MIN_PREFIX_LENGTH = 2
+
+
+def tokenize(text):
+    """
+    Splits the text into lower case alphanumeric tokens.
+    """
+    if not text:
+        return []
+
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def bookmark_tokens(bookmark, category):
+    """
+    Returns a dict that maps every token of the bookmark to its weight. The
+    tokens come from the bookmark text, the host and path of the bookmark url
+    and the name of the category. A token that occurs in several parts gets
+    the sum of the weights of the parts.
+    """
+    url = urlparse(bookmark.get('url', ''))
+    weights = {}
+
+    parts = [(bookmark.get('text', ''), TEXT_WEIGHT),
+             (category, CATEGORY_WEIGHT),
+             (url.hostname, HOST_WEIGHT),
+             (url.path, PATH_WEIGHT)]
+
+    for text, weight in parts:
+        for token in set(tokenize(text)):
+            weights[token] = weights.get(token, 0) + weight
+
+    return weights
+
+
+class BookmarkIndex:
+    """
+    An inverted index over the bookmarks in a BookmarkCatalog.
+
+    The index is registered as a listener on the catalog and only re-indexes
+    the bookmark files that the catalog reports as changed.
+    """
+
+    def __init__(self):
+        # Maps a token to a dict that maps a document id to the token weight.
+        self.postings = {}
+        # The sorted list of tokens, used for prefix matching.
+        self.tokens = []
+        # Maps a document id to the bookmark document.
+        self.documents = {}
+        # Maps a bookmark filename to the ids of the documents in the file.
+        self.file_documents = {}
+        self.next_document_id = 0
+        self.lock = threading.Lock()
+
+    def update(self, catalog, changed):
+        """
+        Re-indexes the changed bookmark files of the catalog.
+        """
+        with self.lock:
+            for filename in changed:
+                self._remove_file(filename)
+                if filename in catalog.files:
+                    self._add_file(filename, catalog.files[filename][1])
+
+            self.tokens = sorted(self.postings)
+
+    def _remove_file(self, filename):
+        for document_id in self.file_documents.pop(filename, []):
+            document = self.documents.pop(document_id)
+
+            for token in document['tokens']:
+                posting = self.postings[token]
+                del posting[document_id]
+                if not posting:
+                    del self.postings[token]
+
+    def _add_file(self, filename, collections):
+        document_ids = []
+
+        for collection in collections:
+            for bookmark in collection.get('bookmarks', []):
+                document_id = self.next_document_id
+                self.next_document_id += 1
+
+                tokens = bookmark_tokens(bookmark, collection.get('category'))
+                self.documents[document_id] = {
+                    'text': bookmark.get('text'),
+                    'url': bookmark.get('url'),
+                    'category': collection.get('category'),
+                    'slug': collection.get('slug'),
+                    'visibility': collection.get('visibility'),
+                    'tokens': tokens
+                }
+
+                for token, weight in tokens.items():
+                    self.postings.setdefault(token, {})[document_id] = weight
+
+                document_ids.append(document_id)
+
+        self.file_documents[filename] = document_ids
+
+    def _match_term(self, term):
+        """
+        Returns a dict that maps the ids of the documents matching the term
+        to the score of the match.
+        """
+        scores = dict(self.postings.get(term, {}))
+
+        if len(term) < MIN_PREFIX_LENGTH:
+            return scores
+
+        position = bisect_left(self.tokens, term)
+        while position < len(self.tokens) and self.tokens[position].startswith(term):
+            token = self.tokens[position]
+            position += 1
+
+            if token == term:
+                continue
+
+            for document_id, weight in self.postings[token].items():
+                score = weight * PREFIX_FACTOR
+                if score > scores.get(document_id, 0):
+                    scores[document_id] = score
+
+        return scores
+
+    def search(self, query, include_private=False, limit=50):
+        """
+        Returns the bookmarks that match every term in the query, best match
+        first. Every term matches tokens that start with the term. Bookmarks
+        in private categories are only returned if include_private is True.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+
+        with self.lock:
+            scores = None
+            for term in terms:
+                term_scores = self._match_term(term)
+
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {document_id: score + term_scores[document_id]
+                              for document_id, score in scores.items()
+                              if document_id in term_scores}
+
+                if not scores:
+                    return []
+
+            results = []
+            for document_id, score in scores.items():
+                document = self.documents[document_id]
+
+                if not include_private and document['visibility'] != 'public':
+                    continue
+
+                results.append((score, document_id, document))
+
+        results.sort(key=lambda r: (-r[0], r[1]))
+
+        return [{'text': document['text'],
+                 'url': document['url'],
+                 'category': document['category'],
+                 'slug': document['slug'],
+                 'score': score} for score, _, document in results[:limit]]
@@ -25,15 +25,161 @@ class DefaultConfiguration:
     TWELVE_HOURS = 12*60*60
     JWT_EXPIRATION_TIMEDELTA = TWELVE_HOURS
 
+    # The number of verified identity JWTs whose claims are kept in memory
+    # until they expire.
+    IDENTITY_CACHE_SIZE = int(load_environment_variable('IDENTITY_CACHE_SIZE', 256))
+
     USERNAME = load_environment_variable('USERNAME')
 
     # Use XKCD style pass phrase.
     # http://xkcd.com/936/
+    # Create the password hash with calc_password.py.
     PASSWORD_HASH = load_environment_variable('PASSWORD_HASH')
 
-    # The password salt can be generated using the token_hex function in
-    # the secrets module.
+    # The algorithm and work factors for password hashes. A password hash
+    # with other parameters still works, but a warning to replace it is
+    # logged on login. Use calc_password.py --target-ms to pick the work
+    # factors for the hardware.
+    PASSWORD_ALGORITHM = load_environment_variable('PASSWORD_ALGORITHM', 'pbkdf2_sha256')
+    PBKDF2_ITERATIONS = int(load_environment_variable('PBKDF2_ITERATIONS', 260000))
+    SCRYPT_N = int(load_environment_variable('SCRYPT_N', 2**14))
+    SCRYPT_R = int(load_environment_variable('SCRYPT_R', 8))
+    SCRYPT_P = int(load_environment_variable('SCRYPT_P', 1))
+
+    # The password salt is only used by legacy sha256 password hashes. It can
+    # be generated using the token_hex function in the secrets module.
     # You can also generate salt using the following command.
     # cat /dev/urandom | head -c 1024 | sha256sum
     PASSWORD_SALT = load_environment_variable('PASSWORD_SALT')
     HTTPS_REQUIRED = load_boolean_environment_variable('HTTPS_REQUIRED', True)
+
+    # The number of login attempts allowed per client ip address and per
+    # username in any LOGIN_RATE_LIMIT_PERIOD seconds.
+    LOGIN_RATE_LIMIT_PER_IP = int(load_environment_variable('LOGIN_RATE_LIMIT_PER_IP', 10))
+    LOGIN_RATE_LIMIT_PER_USERNAME = int(load_environment_variable('LOGIN_RATE_LIMIT_PER_USERNAME', 20))
+    LOGIN_RATE_LIMIT_PERIOD = int(load_environment_variable('LOGIN_RATE_LIMIT_PERIOD', 60))
+
+    # Rate limit counters are kept in memory per worker process by default.
+    # Set RATE_LIMIT_STORE to sqlite to share the counters between the
+    # workers on a machine through RATE_LIMIT_SQLITE_FILENAME.
+    RATE_LIMIT_STORE = load_environment_variable('RATE_LIMIT_STORE', 'memory')
+    RATE_LIMIT_MAX_KEYS = int(load_environment_variable('RATE_LIMIT_MAX_KEYS', 10000))
+    RATE_LIMIT_SQLITE_FILENAME = load_environment_variable('RATE_LIMIT_SQLITE_FILENAME',
+                                                           'tmp/ratelimit.sqlite3')
+
+    # The number of seconds between checks for changed bookmark files.
+    BOOKMARK_RELOAD_INTERVAL = int(load_environment_variable('BOOKMARK_RELOAD_INTERVAL', 5))
+
+    # The precompiled bookmark bundle written by build.py. The bookmark json
+    # files are used when the bundle is missing or out of date.
+    BOOKMARK_BUNDLE_FILENAME = load_environment_variable('BOOKMARK_BUNDLE_FILENAME',
+                                                         'build/bookmarks.bundle')
+
+    # The maximum number of results returned by a bookmark search.
+    BOOKMARK_SEARCH_LIMIT = 50
+
+    # The maximum number of bookmark categories in a page from the bookmark api.
+    BOOKMARK_API_MAX_LIMIT = 100
+
+    # The number of seconds between checks for changed photo collection files.
+    PHOTO_RELOAD_INTERVAL = int(load_environment_variable('PHOTO_RELOAD_INTERVAL', 5))
+
+    # Used by process_photos.py. The resized photos are written to a folder
+    # per collection in PHOTO_BUILD_FOLDER and uploaded to PHOTO_BUCKET.
+    PHOTO_BUILD_FOLDER = load_environment_variable('PHOTO_BUILD_FOLDER', 'build/photos')
+    PHOTO_BUCKET = load_environment_variable('PHOTO_BUCKET', 'rainforestphotos')
+    PHOTO_UPLOAD_WORKERS = int(load_environment_variable('PHOTO_UPLOAD_WORKERS', 8))
+
+    # The rendered page cache for pages that look the same for every visitor.
+    PAGE_CACHE_ENABLED = load_boolean_environment_variable('PAGE_CACHE_ENABLED', True)
+    PAGE_CACHE_MAX_BYTES = int(load_environment_variable('PAGE_CACHE_MAX_BYTES', 8*1024*1024))
+    PAGE_CACHE_TTL = int(load_environment_variable('PAGE_CACHE_TTL', 300))
+
+    # The fingerprinted static files written by build.py. The static files
+    # are fingerprinted at startup when the folder is missing. Files up to
+    # ASSET_MEMORY_MAX_SIZE bytes are served from memory.
+    ASSET_BUILD_FOLDER = load_environment_variable('ASSET_BUILD_FOLDER', 'build/static')
+    ASSET_MEMORY_MAX_SIZE = int(load_environment_variable('ASSET_MEMORY_MAX_SIZE', 256*1024))
+
+    # The number of seconds between checks for new and changed writings.
+    WRITING_RELOAD_INTERVAL = int(load_environment_variable('WRITING_RELOAD_INTERVAL', 5))
+
+    # The writings converted to html by build.py. The markdown files are
+    # converted when the artifact is missing or out of date.
+    WRITINGS_ARTIFACT_FILENAME = load_environment_variable('WRITINGS_ARTIFACT_FILENAME',
+                                                           'build/writings.json')
+
+    # The compiled templates are cached in this folder, so that a new worker
+    # does not have to compile them again. build.py fills the cache at build
+    # time. Set it to an empty string to disable the cache. Templates are
+    # only checked for changes on every render with TEMPLATES_AUTO_RELOAD,
+    # which defaults to on in debug mode only.
+    TEMPLATE_CACHE_FOLDER = load_environment_variable('TEMPLATE_CACHE_FOLDER', 'build/templates')
+    TEMPLATES_AUTO_RELOAD = load_boolean_environment_variable('TEMPLATES_AUTO_RELOAD', None)
+
+    # Convert all the writings to html when the application starts instead
+    # of on the first request.
+    WRITINGS_PRECOMPILE = load_boolean_environment_variable('WRITINGS_PRECOMPILE', False)
+
+    # The S3 client settings. Set S3_ENDPOINT_URL to use a local S3 stand-in
+    # like moto server instead of S3.
+    S3_ENDPOINT_URL = load_environment_variable('S3_ENDPOINT_URL')
+    S3_MAX_POOL_CONNECTIONS = int(load_environment_variable('S3_MAX_POOL_CONNECTIONS', 10))
+    S3_CONNECT_TIMEOUT = int(load_environment_variable('S3_CONNECT_TIMEOUT', 5))
+    S3_READ_TIMEOUT = int(load_environment_variable('S3_READ_TIMEOUT', 60))
+    S3_MAX_ATTEMPTS = int(load_environment_variable('S3_MAX_ATTEMPTS', 3))
+
+    # The storage backend is either s3 or local. The local backend stores
+    # every bucket as a folder in LOCAL_STORAGE_ROOT.
+    STORAGE_BACKEND = load_environment_variable('STORAGE_BACKEND', 's3')
+    LOCAL_STORAGE_ROOT = load_environment_variable('LOCAL_STORAGE_ROOT', 'tmp/storage')
+
+    NOTES_BUCKET = load_environment_variable('NOTES_BUCKET', 'redwood-notes')
+    FILES_BUCKET = load_environment_variable('FILES_BUCKET', 'redwood-files')
+
+    # Folder listings are served from memory. The keys in a bucket are listed
+    # again in the background when the listing is older than this many seconds.
+    LISTING_CACHE_TTL = int(load_environment_variable('LISTING_CACHE_TTL', 60))
+
+    # Notes and their rendered html are cached in memory and in a folder on
+    # the local disk. A cached note is checked for changes with a conditional
+    # get when it is older than NOTES_CACHE_TTL seconds.
+    NOTES_CACHE_FOLDER = load_environment_variable('NOTES_CACHE_FOLDER', 'tmp/notes-cache')
+    NOTES_CACHE_MAX_BYTES = int(load_environment_variable('NOTES_CACHE_MAX_BYTES', 4*1024*1024))
+    NOTES_CACHE_TTL = int(load_environment_variable('NOTES_CACHE_TTL', 30))
+
+    # The notes bucket can be mirrored to this folder with sync_notes.py. The
+    # notes are served from the mirror when it exists. Set
+    # NOTES_SYNC_ON_STARTUP to sync the mirror in the gunicorn master before
+    # the workers are started.
+    NOTES_MIRROR_FOLDER = load_environment_variable('NOTES_MIRROR_FOLDER', 'tmp/notes-mirror')
+    NOTES_SYNC_ON_STARTUP = load_boolean_environment_variable('NOTES_SYNC_ON_STARTUP', False)
+    NOTES_SYNC_WORKERS = int(load_environment_variable('NOTES_SYNC_WORKERS', 8))
+
+    # Streamed uploads to S3 are split in parts of this size and uploaded in
+    # parallel. The memory used by an upload is at most part size times the
+    # concurrency. S3 requires parts of at least 5 MB.
+    S3_UPLOAD_PART_SIZE = int(load_environment_variable('S3_UPLOAD_PART_SIZE', 8*1024*1024))
+    S3_UPLOAD_CONCURRENCY = int(load_environment_variable('S3_UPLOAD_CONCURRENCY', 4))
+
+    # File downloads are streamed in chunks of this size.
+    DOWNLOAD_BUFFER_SIZE = int(load_environment_variable('DOWNLOAD_BUFFER_SIZE', 64*1024))
+
+    # In download redirect mode files of at least DOWNLOAD_REDIRECT_MIN_SIZE
+    # bytes are downloaded directly from S3 using a presigned url instead of
+    # through the workers. Smaller files are still sent by the workers.
+    DOWNLOAD_REDIRECT = load_boolean_environment_variable('DOWNLOAD_REDIRECT', False)
+    DOWNLOAD_REDIRECT_MIN_SIZE = int(load_environment_variable('DOWNLOAD_REDIRECT_MIN_SIZE',
+                                                               1024*1024))
+    PRESIGNED_URL_EXPIRATION = int(load_environment_variable('PRESIGNED_URL_EXPIRATION', 300))
+
+    # With PRELOAD_APP gunicorn loads the application and its data in the
+    # master before forking the workers, so the workers share the memory.
+    # Set WORKER_MEMORY_REPORT to log the shared and private memory of every
+    # worker after it has started.
+    PRELOAD_APP = load_boolean_environment_variable('PRELOAD_APP', True)
+    WORKER_MEMORY_REPORT = load_boolean_environment_variable('WORKER_MEMORY_REPORT', False)
+
+    # The async entry point in asgi.py runs the storage calls in a thread
+    # pool with at most this many threads.
+    ASYNC_STORAGE_MAX_WORKERS = int(load_environment_variable('ASYNC_STORAGE_MAX_WORKERS', 32))
@@ -1,9 +1,714 @@
-import boto3
+import asyncio
+import functools
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from collections import OrderedDict
 from io import BytesIO
 
+
+class FileChangedError(Exception):
+    """
+    Raised when a file is read with the etag it had when it was stat'ed,
+    but it has been replaced since.
+    """
+
+
+class StorageBackend:
+    """
+    The interface for storing files. Files are stored in buckets and are
+    identified by a key. A key can contain / characters, which are used to
+    group the files in folders.
+    """
+
+    def list_folder(self, bucket_name, folder):
+        """
+        Lists the contents of a folder. The folder is / for the top level
+        folder and otherwise a prefix that ends with /. Returns a tuple with
+        the list of sub folder prefixes and the list of file keys.
+        """
+        raise NotImplementedError()
+
+    def list_all(self, bucket_name):
+        """
+        Generates the keys of all the files in a bucket.
+        """
+        raise NotImplementedError()
+
+    def list_etags(self, bucket_name):
+        """
+        Generates a (key, etag) tuple for every file in a bucket.
+        """
+        for key in self.list_all(bucket_name):
+            yield key, self.stat(bucket_name, key)['etag']
+
+    def read(self, bucket_name, key):
+        """
+        Returns the contents of a file as bytes.
+        """
+        raise NotImplementedError()
+
+    def read_stream(self, bucket_name, key, byte_range=None, etag=None):
+        """
+        Returns a file like object for reading a file. If byte_range is a
+        (first byte, last byte) tuple only that part of the file is read. If
+        etag is given and the file no longer has that etag, raises
+        FileChangedError.
+        """
+        raise NotImplementedError()
+
+    def write(self, bucket_name, key, content, mimetype=None):
+        """
+        Writes bytes to a file. The mimetype is stored with the file if the
+        backend supports it.
+        """
+        raise NotImplementedError()
+
+    def write_stream(self, bucket_name, key, stream):
+        """
+        Writes the contents of a file like object to a file.
+        """
+        raise NotImplementedError()
+
+    def delete(self, bucket_name, key):
+        """
+        Deletes a file.
+        """
+        raise NotImplementedError()
+
+    def stat(self, bucket_name, key):
+        """
+        Returns a dict with the size, etag and last_modified time of a file
+        or None if the file does not exist.
+        """
+        raise NotImplementedError()
+
+    def read_if_changed(self, bucket_name, key, etag):
+        """
+        Reads a file unless its etag is still the given etag. Returns a tuple
+        with the content and the etag of the file, or None if the file has
+        not changed. Raises FileNotFoundError if the file does not exist.
+        """
+        info = self.stat(bucket_name, key)
+
+        if info is None:
+            raise FileNotFoundError(key)
+
+        if info['etag'] == etag:
+            return None
+
+        return self.read(bucket_name, key), info['etag']
+
+    def local_path(self, bucket_name, key):
+        """
+        Returns the path of a file on the local disk or None if the file is
+        not stored on the local disk. A file on the local disk can be sent
+        without copying it through the worker.
+        """
+        return None
+
+    def presigned_url(self, bucket_name, key, mimetype, expires_in):
+        """
+        Returns a short lived url that the client can download the file
+        from directly, or None if the backend does not support that.
+        """
+        return None
+
+    def metrics(self):
+        """
+        Returns backend specific metrics.
+        """
+        return {}
+
+
+class S3Backend(StorageBackend):
+    """
+    Stores files in S3. The boto3 client, and with it the HTTP connection
+    pool, is created once per process and shared by all requests. The client
+    is created again after a fork since a connection pool can not be shared
+    between processes.
+    """
+
+    def __init__(self, endpoint_url=None, max_pool_connections=10,
+                 connect_timeout=5, read_timeout=60, max_attempts=3,
+                 upload_part_size=8*1024*1024, upload_concurrency=4,
+                 presigned_url_cache_size=1024):
+        self.endpoint_url = endpoint_url
+        self.max_pool_connections = max_pool_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_attempts = max_attempts
+        self.upload_part_size = upload_part_size
+        self.upload_concurrency = upload_concurrency
+
+        # Maps (bucket name, key, mimetype, expires in) to a (url, expires
+        # at) tuple, least recently used first.
+        self.presigned_urls = OrderedDict()
+        self.presigned_url_cache_size = presigned_url_cache_size
+
+        self._client = None
+        self._client_pid = None
+        self._lock = threading.Lock()
+
+        self.clients_created = 0
+        self.client_reuses = 0
+
+    def create_client(self):
+        """
+        Creates a new S3 client with the configured connection pool size,
+        timeouts and retries.
+        """
+        # boto3 takes a long time to import, so it is only imported when the
+        # first client is created.
+        import boto3
+        from botocore.config import Config
+
+        options = {'max_pool_connections': self.max_pool_connections,
+                   'connect_timeout': self.connect_timeout,
+                   'read_timeout': self.read_timeout,
+                   'retries': {'max_attempts': self.max_attempts}}
+
+        # Older versions of botocore do not support tcp keepalive. The pooled
+        # connections are kept alive between requests either way.
+        if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+            options['tcp_keepalive'] = True
+
+        return boto3.client('s3', endpoint_url=self.endpoint_url,
+                            config=Config(**options))
+
+    def client(self):
+        """
+        Returns the S3 client for the current process.
+        """
+        pid = os.getpid()
+
+        if self._client is not None and self._client_pid == pid:
+            self.client_reuses += 1
+            return self._client
+
+        with self._lock:
+            if self._client is None or self._client_pid != pid:
+                self._client = self.create_client()
+                self._client_pid = pid
+                self.clients_created += 1
+            else:
+                self.client_reuses += 1
+
+            return self._client
+
+    def connection_pools(self):
+        """
+        Returns the urllib3 connection pools of the client for the current
+        process.
+        """
+        if self._client is None or self._client_pid != os.getpid():
+            return []
+
+        try:
+            manager = self._client._endpoint.http_session._manager
+            return [manager.pools[key] for key in manager.pools.keys()]
+        except (AttributeError, KeyError):
+            return []
+
+    def metrics(self):
+        """
+        Returns counters for client and connection reuse. A request that did
+        not have to open a new connection reused a pooled connection.
+        """
+        pools = self.connection_pools()
+        connections = sum(pool.num_connections for pool in pools)
+        requests = sum(pool.num_requests for pool in pools)
+
+        return {"clients_created": self.clients_created,
+                "client_reuses": self.client_reuses,
+                "connections_opened": connections,
+                "requests": requests,
+                "connection_reuses": max(requests - connections, 0)}
+
+    def list_folder(self, bucket_name, folder):
+        kwargs = {'Bucket': bucket_name, 'Delimiter':'/'}
+
+        if(folder != '/'):
+            kwargs['Prefix'] = folder
+
+        folders = []
+        files = []
+
+        # A single list call returns at most 1000 keys, so follow the
+        # continuation tokens until the whole folder has been listed.
+        paginator = self.client().get_paginator('list_objects_v2')
+        for result in paginator.paginate(**kwargs):
+            folders.extend(get_s3_folders_from_result(result))
+            files.extend(get_s3_files_from_result(result))
+
+        return folders, files
+
+    def list_all(self, bucket_name):
+        paginator = self.client().get_paginator('list_objects_v2')
+        for result in paginator.paginate(Bucket=bucket_name):
+            for key in get_s3_files_from_result(result):
+                yield key
+
+    def list_etags(self, bucket_name):
+        paginator = self.client().get_paginator('list_objects_v2')
+        for result in paginator.paginate(Bucket=bucket_name):
+            for item in result.get('Contents', []):
+                yield item['Key'], item['ETag']
+
+    def read(self, bucket_name, key):
+        return self.read_stream(bucket_name, key).read()
+
+    def read_stream(self, bucket_name, key, byte_range=None, etag=None):
+        kwargs = {'Bucket': bucket_name, 'Key': key}
+
+        if byte_range is not None:
+            kwargs['Range'] = 'bytes={}-{}'.format(*byte_range)
+
+        if etag is not None:
+            kwargs['IfMatch'] = etag
+
+        from botocore.exceptions import ClientError
+
+        try:
+            result = self.client().get_object(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('412', 'PreconditionFailed'):
+                raise FileChangedError(key)
+            raise
+
+        return result['Body']
+
+    def read_if_changed(self, bucket_name, key, etag):
+        """
+        Reads a file with a conditional get, so an unchanged file costs a
+        single request without a body.
+        """
+        kwargs = {'Bucket': bucket_name, 'Key': key}
+
+        if etag is not None:
+            kwargs['IfNoneMatch'] = etag
+
+        from botocore.exceptions import ClientError
+
+        try:
+            result = self.client().get_object(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                raise FileNotFoundError(key)
+            raise
+
+        return result['Body'].read(), result['ETag']
+
+    def write(self, bucket_name, key, content, mimetype=None):
+        kwargs = {'Bucket': bucket_name, 'Key': key, 'Body': BytesIO(content)}
+
+        if mimetype is not None:
+            kwargs['ContentType'] = mimetype
+
+        self.client().put_object(**kwargs)
+
+    def write_stream(self, bucket_name, key, stream):
+        """
+        Writes a stream to S3 with a multipart upload. The stream is read one
+        part at a time and the parts are uploaded in parallel, with at most
+        upload_concurrency parts in memory at a time. The multipart upload is
+        aborted if anything fails. A stream that fits in a single part is
+        written with a single put.
+        """
+        client = self.client()
+        in_flight = threading.BoundedSemaphore(self.upload_concurrency)
+
+        in_flight.acquire()
+        data = read_part(stream, self.upload_part_size)
+        if len(data) < self.upload_part_size:
+            in_flight.release()
+            self.write(bucket_name, key, data)
+            return
+
+        result = client.create_multipart_upload(Bucket=bucket_name, Key=key)
+        upload_id = result['UploadId']
+        failed = threading.Event()
+
+        def upload_part(part_number, data):
+            try:
+                result = client.upload_part(Bucket=bucket_name, Key=key,
+                                            UploadId=upload_id,
+                                            PartNumber=part_number, Body=data)
+                return {'PartNumber': part_number, 'ETag': result['ETag']}
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                in_flight.release()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.upload_concurrency) as executor:
+                futures = []
+                part_number = 1
+
+                while data and not failed.is_set():
+                    futures.append(executor.submit(upload_part, part_number, data))
+                    part_number += 1
+
+                    in_flight.acquire()
+                    data = read_part(stream, self.upload_part_size)
+
+                # Do not keep the last part in memory while waiting.
+                data = None
+                in_flight.release()
+
+                parts = [future.result() for future in futures]
+
+            client.complete_multipart_upload(Bucket=bucket_name, Key=key,
+                                             UploadId=upload_id,
+                                             MultipartUpload={'Parts': parts})
+        except BaseException:
+            client.abort_multipart_upload(Bucket=bucket_name, Key=key,
+                                          UploadId=upload_id)
+            raise
+
+    def delete(self, bucket_name, key):
+        self.client().delete_object(Bucket=bucket_name, Key=key)
+
+    def presigned_url(self, bucket_name, key, mimetype, expires_in):
+        """
+        Returns a presigned GET url for the file. The url is cached and
+        reused until it is close to expiring.
+        """
+        cache_key = (bucket_name, key, mimetype, expires_in)
+        now = time.time()
+
+        # Hand out a cached url as long as more than a fifth of its lifetime
+        # remains, so the client has time to use it.
+        margin = expires_in / 5
+
+        with self._lock:
+            cached = self.presigned_urls.get(cache_key)
+            if cached is not None and cached[1] - now > margin:
+                self.presigned_urls.move_to_end(cache_key)
+                return cached[0]
+
+        url = self.client().generate_presigned_url(
+            'get_object',
+            Params={'Bucket': bucket_name, 'Key': key, 'ResponseContentType': mimetype},
+            ExpiresIn=expires_in)
+
+        with self._lock:
+            self.presigned_urls[cache_key] = (url, now + expires_in)
+            self.presigned_urls.move_to_end(cache_key)
+            while len(self.presigned_urls) > self.presigned_url_cache_size:
+                self.presigned_urls.popitem(last=False)
+
+        return url
+
+    def stat(self, bucket_name, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            result = self.client().head_object(Bucket=bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+        return {'size': result['ContentLength'],
+                'etag': result['ETag'],
+                'last_modified': result['LastModified']}
+
+
+def read_part(stream, size):
+    """
+    Reads size bytes from the stream. Returns fewer bytes only at the end of
+    the stream.
+    """
+    chunks = []
+    remaining = size
+
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        remaining -= len(chunk)
+
+    return b''.join(chunks)
+
+
+def local_etag(stat):
+    """
+    Returns the etag of a file on the local disk from its os.stat result.
+    """
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+class RangeReader:
+    """
+    A file like object that reads at most length bytes from a file.
+    """
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalBackend(StorageBackend):
+    """
+    Stores files on the local disk. Every bucket is a folder in the root
+    folder. Used for local development and tests, and for serving hot files
+    from the local disk.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, bucket_name, key=''):
+        """
+        Returns the path for a key in a bucket. Raises ValueError if the key
+        would give a path outside of the bucket.
+        """
+        bucket_path = os.path.join(self.root, bucket_name)
+        path = os.path.normpath(os.path.join(bucket_path, key.lstrip('/')))
+
+        if path != bucket_path and not path.startswith(bucket_path + os.sep):
+            raise ValueError("Invalid key {}".format(key))
+
+        return path
+
+    def list_folder(self, bucket_name, folder):
+        prefix = '' if folder == '/' else folder
+        folders = []
+        files = []
+
+        try:
+            entries = sorted(os.scandir(self.path(bucket_name, prefix)), key=lambda e: e.name)
+        except FileNotFoundError:
+            return folders, files
+
+        for entry in entries:
+            if entry.is_dir():
+                folders.append(prefix + entry.name + '/')
+            elif not entry.name.startswith('.'):
+                files.append(prefix + entry.name)
+
+        return folders, files
+
+    def list_all(self, bucket_name):
+        bucket_path = self.path(bucket_name)
+
+        for directory, folders, filenames in os.walk(bucket_path):
+            folders.sort()
+            relative = os.path.relpath(directory, bucket_path)
+            prefix = '' if relative == '.' else relative.replace(os.sep, '/') + '/'
+
+            for filename in sorted(filenames):
+                if not filename.startswith('.'):
+                    yield prefix + filename
+
+    def read(self, bucket_name, key):
+        with open(self.path(bucket_name, key), 'rb') as f:
+            return f.read()
+
+    def read_stream(self, bucket_name, key, byte_range=None, etag=None):
+        f = open(self.path(bucket_name, key), 'rb')
+
+        if etag is not None and local_etag(os.fstat(f.fileno())) != etag:
+            f.close()
+            raise FileChangedError(key)
+
+        if byte_range is None:
+            return f
+
+        first, last = byte_range
+        f.seek(first)
+        return RangeReader(f, last - first + 1)
+
+    def write(self, bucket_name, key, content, mimetype=None):
+        self.write_stream(bucket_name, key, BytesIO(content))
+
+    def write_stream(self, bucket_name, key, stream):
+        path = self.path(bucket_name, key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first so that readers never see a
+        # partially written file.
+        fd, temporary_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    def delete(self, bucket_name, key):
+        try:
+            os.unlink(self.path(bucket_name, key))
+        except FileNotFoundError:
+            pass
+
+    def stat(self, bucket_name, key):
+        try:
+            stat = os.stat(self.path(bucket_name, key))
+        except FileNotFoundError:
+            return None
+
+        last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+
+        return {'size': stat.st_size,
+                'etag': local_etag(stat),
+                'last_modified': last_modified}
+
+    def local_path(self, bucket_name, key):
+        path = self.path(bucket_name, key)
+
+        if os.path.isfile(path):
+            return path
+
+        return None
+
+
+class AsyncStorage:
+    """
+    Async counterparts of the storage functions for the async entry point.
+
+    The backends are blocking, so every call is run in a thread pool with at
+    most max_workers threads. A thread is only used while a call is waiting
+    for the backend, so many slow downloads can be served from a single
+    event loop. The thread pool is created again after a fork.
+    """
+
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._executor = None
+        self._executor_pid = None
+
+    def executor(self):
+        pid = os.getpid()
+
+        if self._executor is None or self._executor_pid != pid:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                thread_name_prefix='async-storage')
+            self._executor_pid = pid
+
+        return self._executor
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Runs a blocking function in the thread pool.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor(),
+                                          functools.partial(function, *args, **kwargs))
+
+    async def list_folder(self, bucket_name, folder):
+        return await self.run(get_backend().list_folder, bucket_name, folder)
+
+    async def read(self, bucket_name, key):
+        return await self.run(get_backend().read, bucket_name, key)
+
+    async def read_stream(self, bucket_name, key, byte_range=None, etag=None):
+        return await self.run(get_backend().read_stream, bucket_name, key,
+                              byte_range=byte_range, etag=etag)
+
+    async def stat(self, bucket_name, key):
+        return await self.run(get_backend().stat, bucket_name, key)
+
+    async def presigned_url(self, bucket_name, key, mimetype, expires_in):
+        return await self.run(get_backend().presigned_url, bucket_name, key, mimetype, expires_in)
+
+    async def iter_chunks(self, stream, length, buffer_size):
+        """
+        Generates the first length bytes of the stream in chunks of at most
+        buffer_size bytes. Closes the stream when done.
+        """
+        try:
+            remaining = length
+            while remaining > 0:
+                chunk = await self.run(stream.read, min(buffer_size, remaining))
+                if not chunk:
+                    break
+
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            stream.close()
+
+
+backend = None
+
+def create_backend(config):
+    """
+    Creates the storage backend selected by the STORAGE_BACKEND setting.
+    """
+    name = config['STORAGE_BACKEND']
+
+    if name == 's3':
+        return S3Backend(endpoint_url=config.get('S3_ENDPOINT_URL'),
+                         max_pool_connections=config['S3_MAX_POOL_CONNECTIONS'],
+                         connect_timeout=config['S3_CONNECT_TIMEOUT'],
+                         read_timeout=config['S3_READ_TIMEOUT'],
+                         max_attempts=config['S3_MAX_ATTEMPTS'],
+                         upload_part_size=config['S3_UPLOAD_PART_SIZE'],
+                         upload_concurrency=config['S3_UPLOAD_CONCURRENCY'])
+    elif name == 'local':
+        return LocalBackend(config['LOCAL_STORAGE_ROOT'])
+    else:
+        raise ValueError("Unknown storage backend {}".format(name))
+
+def configure_storage(config):
+    """
+    Configures the storage backend from the application configuration.
+    """
+    global backend
+
+    backend = create_backend(config)
+
+def get_backend():
+    """
+    Returns the configured storage backend. Uses an S3 backend with the
+    default settings if configure_storage has not been called.
+    """
+    global backend
+
+    if backend is None:
+        backend = S3Backend()
+
+    return backend
+
+def storage_metrics():
+    """
+    Returns the metrics of the storage backend.
+    """
+    return get_backend().metrics()
+
 def get_s3_folders_from_result(result):
     """
-    Gets the folders from a s3 list_objects result.
+    Gets the folders from a s3 list_objects_v2 result.
     """
 
     if 'CommonPrefixes' in result:
@@ -15,7 +720,7 @@ def get_s3_folders_from_result(result):
 
 def get_s3_files_from_result(result):
     """
-    Gets the files from a s3 list_objects result.
+    Gets the files from a s3 list_objects_v2 result.
     """
     if 'Contents' in result:
         files = result['Contents']
@@ -26,69 +731,39 @@ def get_s3_files_from_result(result):
 
 def read_s3_bucket_folder(bucket_name, folder):
     """
-    Reads the contents of an s3 folder in a bucket.
+    Reads the contents of a folder in a bucket.
     """
-    client = boto3.client('s3')
-
-    kwargs = {'Bucket': bucket_name, 'Delimiter':'/'}
-
-    if(folder != '/'):
-        kwargs['Prefix'] = folder
-
-    result = client.list_objects(**kwargs)
-
-    folders = get_s3_folders_from_result(result)
-    files = get_s3_files_from_result(result)
-
-    return folders, files
+    return get_backend().list_folder(bucket_name, folder)
 
 def read_s3_file(bucket_name, key, binary=False):
     """
-    Reads the contents of an S3 text file.
+    Reads the contents of a text file.
     """
-    client = boto3.client('s3')
-
-    result = client.get_object(Bucket=bucket_name, Key=key)
-
-    if result['ResponseMetadata']['HTTPStatusCode'] != 200:
-        pass
+    content = get_backend().read(bucket_name, key)
 
     if binary:
-        return result['Body'].read()
+        return content
     else:
-        return result['Body'].read().decode('utf-8')
+        return content.decode('utf-8')
 
 def write_s3_file(bucket_name, key, content):
     """
-    Writes text to an S3 text file.
+    Writes bytes to a file.
     """
-    client = boto3.client('s3')
-    file_like_content = BytesIO(content)
-    result = client.put_object(Bucket=bucket_name, Key=key, Body=file_like_content)
-
-    # TODO: Some kind of error handling.
+    get_backend().write(bucket_name, key, content)
 
-def read_s3_stream(bucket_name, key):
+def read_s3_stream(bucket_name, key, byte_range=None):
     """
-    Returns a stream for an S3 file.
+    Returns a stream for a file.
     """
-    client = boto3.client('s3')
-
-    result = client.get_object(Bucket=bucket_name, Key=key)
-
-    if result['ResponseMetadata']['HTTPStatusCode'] != 200:
-        pass
-
-    return result['Body']
+    return get_backend().read_stream(bucket_name, key, byte_range=byte_range)
 
 def write_s3_stream(bucket_name, key, stream):
     """
-    Writes a stream to S3.
+    Writes a stream to a file.
     """
-    pass
+    get_backend().write_stream(bucket_name, key, stream)
 
 def delete_s3_file(bucket_name, key):
-    """Delete file from S3."""
-    client = boto3.client('s3')
-    client.delete_object(Bucket=bucket_name,
-                         Key=key)
+    """Delete file from storage."""
+    get_backend().delete(bucket_name, key)
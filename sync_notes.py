@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+
+"""
+Mirrors the notes bucket to the local disk so that the notes can be served
+without calling the storage backend.
+
+Usage:
+
+    python sync_notes.py
+"""
+
+import sys
+import time
+
+from flask import Config
+
+from notes import sync_notes
+from settings import DefaultConfiguration
+from storage import create_backend
+
+
+def main():
+    config = Config('.')
+    config.from_object(DefaultConfiguration)
+
+    start = time.monotonic()
+    changed, removed = sync_notes(create_backend(config),
+                                  config['NOTES_BUCKET'],
+                                  config['NOTES_MIRROR_FOLDER'],
+                                  workers=config['NOTES_SYNC_WORKERS'])
+
+    print("Downloaded {} and removed {} notes in {:.2f} s.".format(
+        len(changed), len(removed), time.monotonic() - start))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,12 +1,39 @@
 import unittest
 from flask import Flask
 from flask_testing import TestCase
-from redwood import app, create_user_jwt
+from jinja2 import Environment, FileSystemLoader
+from redwood import app, create_user_jwt, page_cache, rate_limit_store
 import hashlib
 import jwt
 import time
+import gzip
 import json
+import os
+import tempfile
+from io import BytesIO
 from glob import glob
+from bookmarks import BookmarkCatalog
+from bookmarks import load_bookmark_bundle, write_bookmark_bundle
+from search import BookmarkIndex
+from photos import PhotoRegistry
+from page_cache import CachedPage, PageCache
+from listing_cache import ListingCache, PrefixTree
+from notes import NotesCache, NotesMirror, sync_notes
+from identity_cache import IdentityCache
+from ratelimit import MemoryStore, RateLimiter, SqliteStore
+from assets import AssetStore, write_assets
+from photos import create_image_dict
+from process_photos import resized_widths, update_collection_file
+from profile_startup import IMPORT_TIMES_AVAILABLE, parse_import_times, profile_startup
+from passwords import SCRYPT_AVAILABLE, benchmark, hash_password, needs_rehash, verify_password
+import redwood
+import settings
+import asgi
+import asyncio
+import storage
+from botocore.exceptions import ClientError
+from storage import FileChangedError, S3Backend, LocalBackend
+from writings import WritingStore, load_writings_artifact, write_writings_artifact
 
 class RedwoodTest(TestCase):
 
@@ -23,12 +50,16 @@ class RedwoodTest(TestCase):
         app.config['USERNAME'] = username
         app.config['PASSWORD_SALT'] = salt
         app.config['PASSWORD_HASH'] = password_hash
+        app.config['PASSWORD_ALGORITHM'] = 'pbkdf2_sha256'
+        app.config['PBKDF2_ITERATIONS'] = 1000
         app.config['IDENTITY_JWT_SECRET'] = 'some kind of secret'
         app.config['JWT_EXPIRATION_TIMEDELTA'] = 3600 # One hour
 
     def create_app(self):
         self.configure_user(app)
         app.config['TESTING'] = True
+        page_cache.clear()
+        rate_limit_store.reset()
         return app
 
     def get_cookie_from_client(self, cookie_name, client):
@@ -96,6 +127,45 @@ class RedwoodTest(TestCase):
         self.assertContext('action_url', '/login/')
         self.assertContext('login_error_message', "Incorrect username or password.")
 
+    def test_login_rehashes_legacy_password_hash(self):
+        payload = {'username': 'henrik', 'password': 'foo'}
+        response = self.client.post('/login/', data=payload)
+        self.assertStatus(response, status_code=302)
+
+        password_hash = app.config['PASSWORD_HASH']
+        self.assertTrue(password_hash.startswith('pbkdf2_sha256$1000$'))
+
+        # The new hash is used for the next login.
+        response = self.client.post('/login/', data=payload)
+        self.assertStatus(response, status_code=302)
+        self.assertEqual(password_hash, app.config['PASSWORD_HASH'])
+
+    def test_login_with_invalid_password_hash(self):
+        app.config['PASSWORD_HASH'] = 'pbkdf2_sha256$not-a-number$salt$hash'
+
+        with self.assertLogs(app.logger, 'ERROR'):
+            response = self.client.post('/login/', data={'username': 'henrik', 'password': 'foo'})
+
+        self.assertStatus(response, status_code=200)
+        self.assertIsNone(self.get_cookie_from_client('identity_jwt', self.client))
+
+    def test_login_attempts_are_limited(self):
+        payload = {'username': 'henrik', 'password': 'bar'}
+        headers = {'X-Forwarded-For': '10.0.0.1, 192.168.0.1'}
+
+        for _ in range(app.config['LOGIN_RATE_LIMIT_PER_IP']):
+            response = self.client.post('/login/', data=payload, headers=headers)
+            self.assertStatus(response, status_code=200)
+
+        response = self.client.post('/login/', data=payload, headers=headers)
+        self.assertStatus(response, status_code=429)
+        self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+
+        # Only the last address in the header is used.
+        headers = {'X-Forwarded-For': '10.0.0.1, 192.168.0.2'}
+        response = self.client.post('/login/', data=payload, headers=headers)
+        self.assertStatus(response, status_code=200)
+
     def assert_post_successful_login(self, login_url, redirect_url):
         payload = {'username': 'henrik', 'password': 'foo'}
         response = self.client.post(login_url, data=payload)
@@ -196,5 +266,1307 @@ class RedwoodTest(TestCase):
                 except json.decoder.JSONDecodeError:
                     assert False, "Invalid json file: {}".format(filename)
 
+    def test_bookmarks_page_hides_private_categories(self):
+        response = self.client.get('/bookmarks')
+        self.assertStatus(response, status_code=200)
+        self.assertTemplateUsed('bookmarks.html')
+
+        categories = self.get_context_variable('categories')
+        self.assertTrue(categories)
+        self.assertTrue(all(c['visibility'] == 'public' for c in categories))
+
+    def test_bookmark_category_not_found(self):
+        response = self.client.get('/bookmarks/no-such-category')
+        self.assertStatus(response, status_code=404)
+
+    def test_api_bookmarks(self):
+        response = self.client.get('/api/bookmarks')
+        self.assertStatus(response, status_code=200)
+
+        categories = json.loads(response.data.decode('utf-8'))
+        self.assertTrue(categories)
+        self.assertEqual({'bookmarks', 'category', 'slug'}, set(categories[0].keys()))
+
+
+    def test_api_bookmark_search(self):
+        response = self.client.get('/api/bookmarks/search?q=pyth')
+        self.assertStatus(response, status_code=200)
+
+        results = json.loads(response.data.decode('utf-8'))['results']
+        self.assertTrue(results)
+        self.assertTrue(all('python' in (r['text'] + r['url'] + r['category']).lower()
+                            for r in results))
+
+    def test_bookmark_search_page(self):
+        response = self.client.get('/bookmarks/search?q=python')
+        self.assertStatus(response, status_code=200)
+        self.assertTemplateUsed('bookmark-search.html')
+        self.assertContext('query', 'python')
+
+    def test_api_bookmarks_conditional_requests(self):
+        response = self.client.get('/api/bookmarks')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertTrue(etag)
+        self.assertTrue(last_modified)
+
+        response = self.client.get('/api/bookmarks', headers={'If-None-Match': etag})
+        self.assertStatus(response, status_code=304)
+        self.assertEqual(b'', response.data)
+
+        response = self.client.get('/api/bookmarks', headers={'If-Modified-Since': last_modified})
+        self.assertStatus(response, status_code=304)
+
+        response = self.client.get('/api/bookmarks', headers={'If-None-Match': '"other"'})
+        self.assertStatus(response, status_code=200)
+
+    def test_api_bookmarks_variants(self):
+        indented = self.client.get('/api/bookmarks')
+        compact = self.client.get('/api/bookmarks?compact=1')
+        self.assertLess(len(compact.data), len(indented.data))
+        self.assertEqual(json.loads(indented.data.decode('utf-8')),
+                         json.loads(compact.data.decode('utf-8')))
+        self.assertNotEqual(indented.headers['ETag'], compact.headers['ETag'])
+
+        gzipped = self.client.get('/api/bookmarks', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual('gzip', gzipped.headers['Content-Encoding'])
+        self.assertEqual(indented.data, gzip.decompress(gzipped.data))
+        self.assertNotEqual(indented.headers['ETag'], gzipped.headers['ETag'])
+
+    def get_json(self, url):
+        response = self.client.get(url)
+        self.assertStatus(response, status_code=200)
+        return json.loads(response.data.decode('utf-8'))
+
+    def test_api_bookmarks_pages(self):
+        all_slugs = [c['slug'] for c in self.get_json('/api/bookmarks')]
+
+        slugs = []
+        url = '/api/bookmarks?limit=7&fields=slug'
+        while True:
+            page = self.get_json(url)
+            self.assertLessEqual(len(page['categories']), 7)
+            self.assertTrue(all(list(c.keys()) == ['slug'] for c in page['categories']))
+            slugs.extend(c['slug'] for c in page['categories'])
+
+            if page['next_cursor'] is None:
+                break
+            url = '/api/bookmarks?limit=7&fields=slug&cursor=' + page['next_cursor']
+
+        self.assertEqual(all_slugs, slugs)
+
+    def test_api_bookmarks_category(self):
+        page = self.get_json('/api/bookmarks?category=python&fields=category,url')
+        self.assertEqual([{'category': 'Python', 'url': '/bookmarks/python'}], page['categories'])
+        self.assertIsNone(page['next_cursor'])
+
+    def test_api_bookmarks_invalid_page_arguments(self):
+        self.assertStatus(self.client.get('/api/bookmarks?fields=password'), status_code=400)
+        self.assertStatus(self.client.get('/api/bookmarks?limit=zero'), status_code=400)
+        self.assertStatus(self.client.get('/api/bookmarks?limit=0'), status_code=400)
+        self.assertStatus(self.client.get('/api/bookmarks?cursor=garbage'), status_code=400)
+
+    def test_photo_collection_list(self):
+        response = self.client.get('/photos')
+        self.assertStatus(response, status_code=200)
+        self.assertTemplateUsed('photo-collection-list.html')
+
+    def test_single_photo(self):
+        response = self.client.get('/photos/hawaii-2015/peacock.jpg')
+        self.assertStatus(response, status_code=200)
+        self.assertTemplateUsed('photo.html')
+        self.assertEqual('peacock.jpg', self.get_context_variable('image')['name'])
+
+    def test_page_cache(self):
+        hits = page_cache.stats()['hits']
+
+        first = self.client.get('/photos/hawaii-2015')
+        self.assertTemplateUsed('photo-collection.html')
+        second = self.client.get('/photos/hawaii-2015')
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(hits + 1, page_cache.stats()['hits'])
+
+        # The query string does not make a new page.
+        self.client.get('/photos/hawaii-2015?utm_source=test')
+        self.assertEqual(hits + 2, page_cache.stats()['hits'])
+
+        # Logged in visitors get their own cached pages.
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+        third = self.client.get('/photos/hawaii-2015')
+        self.assertNotEqual(first.data, third.data)
+        self.assertEqual(hits + 2, page_cache.stats()['hits'])
+
+        response = self.client.get('/api/page-cache')
+        self.assertStatus(response, status_code=200)
+        stats = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(hits + 2, stats['hits'])
+
+    def test_missing_photos_are_not_cached(self):
+        entries = page_cache.stats()['entries']
+
+        self.assertStatus(self.client.get('/photos/missing'), 404)
+        self.assertStatus(self.client.get('/photos/hawaii-2015/missing.jpg'), 404)
+        self.assertEqual(entries, page_cache.stats()['entries'])
+
+    def test_markdown_page(self):
+        response = self.client.get('/gpg')
+        self.assertStatus(response, status_code=200)
+        self.assertTemplateUsed('content.html')
+        self.assertContext('title', 'GPG')
+        self.assertIn('<h1>GPG</h1>', self.get_context_variable('content'))
+
+    def test_warm_up(self):
+        redwood.warm_up()
+
+        self.assertIsNotNone(redwood.asset_store.paths)
+        self.assertEqual(len(app.jinja_env.list_templates()), len(app.jinja_env.cache))
+        self.assertStatus(self.client.get("/photos"), 200)
+
+    def test_template_bytecode_cache(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        previous_folder = settings.DefaultConfiguration.TEMPLATE_CACHE_FOLDER
+        settings.DefaultConfiguration.TEMPLATE_CACHE_FOLDER = folder.name
+        self.addCleanup(setattr, settings.DefaultConfiguration, 'TEMPLATE_CACHE_FOLDER',
+                        previous_folder)
+
+        test_app = redwood.create_app()
+        test_app.jinja_env.get_template('base.html')
+
+        self.assertFalse(test_app.jinja_env.auto_reload)
+        self.assertEqual(1, len(os.listdir(folder.name)))
+
+    def test_template_bytecode_cache_is_independent_of_the_root_path(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        environments = []
+        for root in ('build', 'app'):
+            os.makedirs(os.path.join(folder.name, root))
+            with open(os.path.join(folder.name, root, 'page.html'), 'w') as f:
+                f.write('Hello {{ name }}')
+
+            bytecode_cache = redwood.TemplateBytecodeCache(folder.name)
+            environments.append(Environment(loader=FileSystemLoader(os.path.join(folder.name, root)),
+                                             bytecode_cache=bytecode_cache))
+
+        environments[0].get_template('page.html')
+
+        compiled = []
+        compile_source = environments[1].compile
+        def recording_compile(*args, **kwargs):
+            compiled.append(args)
+            return compile_source(*args, **kwargs)
+        environments[1].compile = recording_compile
+
+        self.assertEqual('Hello a', environments[1].get_template('page.html').render(name='a'))
+        self.assertEqual([], compiled)
+
+    def test_writing_page(self):
+        response = self.client.get('/writing/ssh-keys')
+        self.assertStatus(response, status_code=200)
+        self.assertContext('title', 'SSH')
+
+        response = self.client.get('/writing/no-such-writing')
+        self.assertStatus(response, status_code=404)
+
+    def use_local_storage(self, backend_class=LocalBackend):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        previous_backend = storage.backend
+        storage.backend = backend_class(folder.name)
+        self.addCleanup(setattr, storage, 'backend', previous_backend)
+
+        return storage.backend
+
+    def test_files_with_local_storage(self):
+        backend = self.use_local_storage()
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        response = self.client.put('/files/hello.txt', data=b'Hello')
+        self.assertStatus(response, status_code=302)
+        self.assertEqual(b'Hello', backend.read(app.config['FILES_BUCKET'], 'hello.txt'))
+
+        response = self.client.post('/files', data={'file': (BytesIO(b'Upload'), 'up load.txt')})
+        self.assertStatus(response, status_code=302)
+        self.assertEqual(b'Upload', backend.read(app.config['FILES_BUCKET'], 'up_load.txt'))
+
+        response = self.client.get('/files')
+        self.assertContext('file_list', ['hello.txt', 'up_load.txt'])
+
+        response = self.client.get('/files/hello.txt')
+        self.assertStatus(response, status_code=200)
+        self.assertEqual(b'Hello', response.data)
+        self.assertEqual('text/plain', response.mimetype)
+        response.close()
+
+    def test_notes_with_local_storage(self):
+        backend = self.use_local_storage()
+        backend.write(app.config['NOTES_BUCKET'], 'linux/bash.md', b'# Bash')
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        self.client.get('/notes')
+        self.assertContext('folders', [{'text': 'linux/', 'url': '/notes/linux/'}])
+
+        self.client.get('/notes/linux/')
+        self.assertContext('files', [{'text': 'bash.md', 'url': '/notes/linux/bash.md'}])
+
+        self.client.get('/notes/linux/bash.md')
+        self.assertContext('text', '# Bash')
+        self.assertContext('html', '<h1>Bash</h1>')
+
+        response = self.client.get('/notes/linux/missing.md')
+        self.assertStatus(response, status_code=404)
+
+    def test_identity_is_cached(self):
+        identity_jwt = create_user_jwt('henrik', 3600, ['token_creator'])
+        redwood.identity_cache.clear()
+
+        for _ in range(2):
+            with app.app_context(), app.test_request_context(headers={'Authorization': identity_jwt}):
+                hits = redwood.identity_cache.hits
+                self.assertEqual('henrik', redwood.get_current_user()['username'])
+                self.assertEqual('henrik', redwood.get_current_user()['username'])
+
+        # The second request is served by the cache, and the second call in
+        # each request by the request memo.
+        self.assertEqual(hits + 1, redwood.identity_cache.hits)
+
+    def test_tampered_identity_is_rejected(self):
+        identity_jwt = create_user_jwt('henrik', 3600, ['token_creator'])
+        header, payload, signature = identity_jwt.split('.')
+        tampered_signature = ('A' if signature[0] != 'A' else 'B') + signature[1:]
+        self.client.set_cookie('localhost', 'identity_jwt',
+                               '.'.join([header, payload, tampered_signature]))
+
+        self.client.get('/account')
+        self.assertContext('user', None)
+
+    def test_notes_from_mirror(self):
+        backend = self.use_local_storage()
+        backend.write(app.config['NOTES_BUCKET'], 'linux/bash.md', b'# Bash')
+        mirror_folder = tempfile.TemporaryDirectory()
+        self.addCleanup(mirror_folder.cleanup)
+
+        sync_notes(backend, app.config['NOTES_BUCKET'], mirror_folder.name)
+        backend.delete(app.config['NOTES_BUCKET'], 'linux/bash.md')
+
+        previous_mirror = redwood.notes_mirror
+        redwood.notes_mirror = NotesMirror(mirror_folder.name)
+        self.addCleanup(setattr, redwood, 'notes_mirror', previous_mirror)
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        self.client.get('/notes/linux/')
+        self.assertContext('files', [{'text': 'bash.md', 'url': '/notes/linux/bash.md'}])
+
+        self.client.get('/notes/linux/bash.md')
+        self.assertContext('html', '<h1>Bash</h1>')
+
+        # A note that was published after the sync is read from the bucket.
+        backend.write(app.config['NOTES_BUCKET'], 'linux/zsh.md', b'# Zsh')
+        self.client.get('/notes/linux/zsh.md')
+        self.assertContext('html', '<h1>Zsh</h1>')
+
+        response = self.client.get('/notes/linux/missing.md')
+        self.assertStatus(response, status_code=404)
+
+    def test_streamed_download(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'digits.txt', b'0123456789')
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        response = self.client.get('/files/digits.txt')
+        self.assertStatus(response, status_code=200)
+        self.assertEqual(b'0123456789', response.data)
+        self.assertEqual('10', response.headers['Content-Length'])
+        self.assertEqual('bytes', response.headers['Accept-Ranges'])
+        etag = response.headers['ETag']
+
+        response = self.client.get('/files/digits.txt', headers={'If-None-Match': etag})
+        self.assertStatus(response, status_code=304)
+
+    def test_fingerprinted_assets(self):
+        response = self.client.get('/')
+        url = redwood.asset_store.url('styles/redwood.css')
+        self.assertIn(url, response.data.decode('utf-8'))
+        self.assertRegex(url, r'^/assets/styles/redwood\.[0-9a-f]{12}\.css$')
+
+        response = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertStatus(response, status_code=200)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        with open('static/styles/redwood.css', 'rb') as f:
+            self.assertEqual(f.read(), gzip.decompress(response.data))
+
+        response = self.client.get(url)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        response = self.client.get('/assets/styles/redwood.000000000000.css')
+        self.assertStatus(response, status_code=404)
+
+    def call_asgi(self, path, headers=(), disconnect_after=None):
+        """
+        Calls the ASGI application and returns the status, the headers and
+        the body of the response. The client disconnects after
+        disconnect_after messages have been sent to it.
+        """
+        messages = []
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': b'',
+                 'root_path': '', 'scheme': 'http', 'server': ('localhost', 80),
+                 'http_version': '1.1',
+                 'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers]}
+
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+
+            # Like a server, wait until the client disconnects.
+            while disconnect_after is None or len(messages) < disconnect_after:
+                await asyncio.sleep(0)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(asgi.application(scope, receive, send))
+        finally:
+            loop.close()
+
+        response_headers = {k.decode('latin-1').lower(): v.decode('latin-1')
+                            for k, v in messages[0]['headers']}
+        body = b''.join(m.get('body', b'') for m in messages[1:])
+
+        return messages[0]['status'], response_headers, body
+
+    def test_asgi_download_stops_when_the_client_disconnects(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'digits.txt', b'0123456789' * 100)
+        identity_jwt = create_user_jwt('henrik', 3600, ['token_creator'])
+        cookie = [('Cookie', 'identity_jwt=' + identity_jwt)]
+
+        streams = []
+        read_stream = backend.read_stream
+        def recording_read_stream(*args, **kwargs):
+            streams.append(read_stream(*args, **kwargs))
+            return streams[-1]
+        backend.read_stream = recording_read_stream
+
+        previous_buffer_size = app.config['DOWNLOAD_BUFFER_SIZE']
+        app.config['DOWNLOAD_BUFFER_SIZE'] = 10
+        self.addCleanup(app.config.update, DOWNLOAD_BUFFER_SIZE=previous_buffer_size)
+
+        status, _, body = self.call_asgi('/files/digits.txt', cookie, disconnect_after=3)
+
+        self.assertEqual(200, status)
+        self.assertLess(len(body), 1000)
+        self.assertTrue(streams[0].closed)
+
+    def test_asgi_download(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'digits.txt', b'0123456789')
+        identity_jwt = create_user_jwt('henrik', 3600, ['token_creator'])
+        cookie = [('Cookie', 'identity_jwt=' + identity_jwt)]
+
+        status, headers, body = self.call_asgi('/files/digits.txt', cookie)
+        self.assertEqual(200, status)
+        self.assertEqual(b'0123456789', body)
+        self.assertEqual('text/plain', headers['content-type'])
+
+        status, headers, body = self.call_asgi('/files/digits.txt',
+                                               cookie + [('Range', 'bytes=2-4')])
+        self.assertEqual(206, status)
+        self.assertEqual(b'234', body)
+        self.assertEqual('bytes 2-4/10', headers['content-range'])
+
+        status, _, _ = self.call_asgi('/files/digits.txt',
+                                      cookie + [('If-None-Match', headers['etag'])])
+        self.assertEqual(304, status)
+
+    def test_asgi_falls_back_to_flask(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'digits.txt', b'0123456789')
+
+        # Requests that are not logged in are redirected to the login page
+        # by the Flask application.
+        status, headers, _ = self.call_asgi('/files/digits.txt')
+        self.assertEqual(302, status)
+        self.assertIn('/login/', headers['location'])
+
+        status, _, body = self.call_asgi('/')
+        self.assertEqual(200, status)
+
+    def test_range_download(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'digits.txt', b'0123456789')
+        etag = backend.stat(app.config['FILES_BUCKET'], 'digits.txt')['etag']
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        response = self.client.get('/files/digits.txt', headers={'Range': 'bytes=2-4'})
+        self.assertStatus(response, status_code=206)
+        self.assertEqual(b'234', response.data)
+        self.assertEqual('bytes 2-4/10', response.headers['Content-Range'])
+        self.assertEqual('3', response.headers['Content-Length'])
+
+        response = self.client.get('/files/digits.txt', headers={'Range': 'bytes=-3'})
+        self.assertEqual(b'789', response.data)
+
+        response = self.client.get('/files/digits.txt',
+                                   headers={'Range': 'bytes=2-4', 'If-Range': etag})
+        self.assertStatus(response, status_code=206)
+
+        response = self.client.get('/files/digits.txt',
+                                   headers={'Range': 'bytes=2-4', 'If-Range': '"changed"'})
+        self.assertStatus(response, status_code=200)
+        self.assertEqual(b'0123456789', response.data)
+
+        response = self.client.get('/files/digits.txt', headers={'Range': 'bytes=20-30'})
+        self.assertStatus(response, status_code=416)
+        self.assertEqual('bytes */10', response.headers['Content-Range'])
+
+    def test_download_of_replaced_file(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'digits.txt', b'0123456789')
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        # Replace the file right after the first stat.
+        stat = backend.stat
+        def replacing_stat(bucket_name, key):
+            info = stat(bucket_name, key)
+            backend.stat = stat
+            backend.write(bucket_name, key, b'abc')
+            return info
+        backend.stat = replacing_stat
+
+        response = self.client.get('/files/digits.txt')
+        self.assertStatus(response, status_code=200)
+        self.assertEqual(b'abc', response.data)
+        self.assertEqual('3', response.headers['Content-Length'])
+
+    def test_download_missing_file(self):
+        self.use_local_storage(StreamingLocalBackend)
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        response = self.client.get('/files/missing.txt')
+        self.assertStatus(response, status_code=404)
+
+    def test_download_redirect_mode(self):
+        backend = self.use_local_storage(StreamingLocalBackend)
+        backend.write(app.config['FILES_BUCKET'], 'small.txt', b'0123')
+        backend.write(app.config['FILES_BUCKET'], 'large.txt', b'0123456789')
+        self.set_client_identity_jwt('henrik', 3600, ['token_creator'])
+
+        previous_config = app.config['DOWNLOAD_REDIRECT'], app.config['DOWNLOAD_REDIRECT_MIN_SIZE']
+        self.addCleanup(app.config.update, DOWNLOAD_REDIRECT=previous_config[0],
+                        DOWNLOAD_REDIRECT_MIN_SIZE=previous_config[1])
+        app.config.update(DOWNLOAD_REDIRECT=True, DOWNLOAD_REDIRECT_MIN_SIZE=8)
+
+        response = self.client.get('/files/large.txt')
+        self.assertStatus(response, status_code=302)
+        self.assertEqual('https://example.com/redwood-files/large.txt', response.location)
+
+        response = self.client.get('/files/small.txt')
+        self.assertStatus(response, status_code=200)
+        self.assertEqual(b'0123', response.data)
+
+        # The redirect is only sent after the login check.
+        self.client.cookie_jar.clear()
+        response = self.client.get('/files/large.txt')
+        self.assertTrue(response.location.startswith('http://localhost/login/'))
+
+
+class StreamingLocalBackend(LocalBackend):
+    """
+    A local backend that does not expose local paths, so downloads are
+    streamed the same way as downloads from S3.
+    """
+
+    def local_path(self, bucket_name, key):
+        return None
+
+    def presigned_url(self, bucket_name, key, mimetype, expires_in):
+        return 'https://example.com/{}/{}'.format(bucket_name, key)
+
+
+class BookmarkCatalogTest(unittest.TestCase):
+
+    def write_bookmark_file(self, filename, collections):
+        with open(os.path.join(self.folder.name, filename), 'w') as f:
+            json.dump(collections, f)
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.write_bookmark_file('a.json', [
+            {"category": "A", "slug": "a", "visibility": "public", "bookmarks": []}])
+        self.write_bookmark_file('b.json', [
+            {"category": "B", "slug": "b", "visibility": "private", "bookmarks": []}])
+        self.catalog = BookmarkCatalog(folder=self.folder.name,
+                                       filenames=['a.json', 'b.json'],
+                                       reload_interval=0)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_indexes(self):
+        self.assertEqual(['a', 'b'], [c['slug'] for c in self.catalog.all_collections()])
+        self.assertEqual(['a'], [c['slug'] for c in self.catalog.public_collections()])
+        self.assertEqual('/bookmarks/b', self.catalog.get('b')['url'])
+        self.assertIsNone(self.catalog.get('c'))
+
+    def test_reloads_only_changed_files(self):
+        changes = []
+        self.catalog.add_listener(lambda catalog, changed: changes.append(changed))
+        self.catalog.refresh()
+        version = self.catalog.version
+
+        self.write_bookmark_file('b.json', [
+            {"category": "C", "slug": "c", "visibility": "public", "bookmarks": []}])
+
+        self.assertTrue(self.catalog.refresh(force=True))
+        self.assertEqual(['b.json'], changes[-1])
+        self.assertEqual(version + 1, self.catalog.version)
+        self.assertEqual(['a', 'c'], [c['slug'] for c in self.catalog.public_collections()])
+        self.assertFalse(self.catalog.refresh(force=True))
+
+    def test_bundle(self):
+        bundle_filename = os.path.join(self.folder.name, 'bookmarks.bundle')
+        write_bookmark_bundle(bundle_filename, self.folder.name, ['a.json', 'b.json'])
+
+        files = load_bookmark_bundle(bundle_filename, self.folder.name)
+        self.assertEqual(['a.json', 'b.json'], sorted(files))
+        self.assertEqual(0, files['a.json'][1][0]['ordinal'])
+        self.assertEqual('/bookmarks/a', files['a.json'][1][0]['url'])
+
+        # Stale files are left out of the bundle and loaded from json.
+        self.write_bookmark_file('b.json', [
+            {"category": "C", "slug": "c", "visibility": "public", "bookmarks": []}])
+        self.assertEqual(['a.json'], sorted(load_bookmark_bundle(bundle_filename, self.folder.name)))
+
+        catalog = BookmarkCatalog(folder=self.folder.name,
+                                  filenames=['a.json', 'b.json'],
+                                  bundle_filename=bundle_filename)
+        self.assertEqual(['a', 'c'], [c['slug'] for c in catalog.all_collections()])
+
+    def test_missing_bundle(self):
+        bundle_filename = os.path.join(self.folder.name, 'missing.bundle')
+        self.assertEqual({}, load_bookmark_bundle(bundle_filename, self.folder.name))
+
+
+class BookmarkIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = BookmarkCatalog(filenames=[])
+        self.catalog.files = {
+            'a.json': (None, [{"category": "Python", "slug": "python", "visibility": "public",
+                               "bookmarks": [{"text": "Awesome Python",
+                                              "url": "https://awesome-python.com/"},
+                                             {"text": "Testing Your Code",
+                                              "url": "http://docs.python-guide.org/writing/tests/"}]}]),
+            'b.json': (None, [{"category": "Secret", "slug": "secret", "visibility": "private",
+                               "bookmarks": [{"text": "Private Python",
+                                              "url": "https://example.com/"}]}])
+        }
+        self.index = BookmarkIndex()
+        self.index.update(self.catalog, ['a.json', 'b.json'])
+
+    def search_texts(self, query, include_private=False):
+        return [r['text'] for r in self.index.search(query, include_private=include_private)]
+
+    def test_search(self):
+        self.assertEqual(['Awesome Python', 'Testing Your Code'], self.search_texts('python'))
+        self.assertEqual(['Testing Your Code'], self.search_texts('test pyth'))
+        self.assertEqual(['Testing Your Code'], self.search_texts('docs'))
+        self.assertEqual([], self.search_texts('java'))
+        self.assertEqual([], self.search_texts(''))
+
+    def test_search_private(self):
+        self.assertNotIn('Private Python', self.search_texts('python'))
+        self.assertIn('Private Python', self.search_texts('python', include_private=True))
+
+    def test_update(self):
+        self.catalog.files['b.json'] = (None, [])
+        self.index.update(self.catalog, ['b.json'])
+
+        self.assertEqual([], self.search_texts('private', include_private=True))
+        self.assertNotIn('private', self.index.postings)
+        self.assertEqual(['Awesome Python', 'Testing Your Code'], self.search_texts('python'))
+
+
+class PageCacheTest(unittest.TestCase):
+
+    def create_page(self, tag, size=10, ttl=60):
+        return CachedPage(b'x' * size, 200, [], tag, time.monotonic() + ttl)
+
+    def setUp(self):
+        self.cache = PageCache(max_bytes=25, default_ttl=60, logged_in=lambda: False)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put('a', self.create_page('bookmarks'))
+        self.cache.put('b', self.create_page('bookmarks'))
+        self.cache.get('a')
+        self.cache.put('c', self.create_page('bookmarks'))
+
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(20, self.cache.stats()['bytes'])
+
+    def test_expires(self):
+        self.cache.put('a', self.create_page('bookmarks', ttl=-1))
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(0, self.cache.stats()['bytes'])
+
+    def test_invalidate(self):
+        self.cache.put('a', self.create_page('bookmarks'))
+        self.cache.put('b', self.create_page('photos'))
+        self.cache.invalidate('bookmarks')
+
+        self.assertIsNone(self.cache.get('a'))
+        self.assertIsNotNone(self.cache.get('b'))
+        self.assertEqual(1, self.cache.stats()['hits'])
+        self.assertEqual(1, self.cache.stats()['misses'])
+
+
+class WritingStoreTest(unittest.TestCase):
+
+    def write_markdown(self, filename, text):
+        with open(os.path.join(self.folder.name, filename), 'w') as f:
+            f.write(text)
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.write_markdown('first_post.md', '# First Post\nHello')
+        self.store = WritingStore(folder=self.folder.name, reload_interval=0)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_new_and_changed_writings(self):
+        writing = self.store.get_by_slug('first-post')
+        self.assertEqual('First Post', writing['title'])
+        self.assertIn('<p>Hello</p>', writing['html'])
+
+        self.write_markdown('second.md', 'No title')
+        self.write_markdown('first_post.md', '# First Post\nHello again')
+
+        self.assertEqual('second', self.store.get('second.md')['title'])
+        self.assertIn('Hello again', self.store.get('first_post.md')['html'])
+        self.assertFalse(self.store.refresh(force=True))
+
+    def test_artifact(self):
+        artifact_filename = os.path.join(self.folder.name, 'build', 'writings.json')
+        write_writings_artifact(artifact_filename, self.folder.name)
+
+        writings = load_writings_artifact(artifact_filename, self.folder.name)
+        self.assertEqual(['first_post.md'], list(writings))
+
+        self.write_markdown('first_post.md', '# Changed')
+        self.assertEqual({}, load_writings_artifact(artifact_filename, self.folder.name))
+
+
+class S3BackendTest(unittest.TestCase):
+
+    def test_client_is_reused(self):
+        backend = S3Backend(endpoint_url='http://localhost:5000', max_pool_connections=4)
+        client = backend.client()
+
+        self.assertIs(client, backend.client())
+        self.assertEqual(1, backend.metrics()['clients_created'])
+        self.assertEqual(1, backend.metrics()['client_reuses'])
+        self.assertEqual(4, client.meta.config.max_pool_connections)
+
+    def test_new_client_after_fork(self):
+        backend = S3Backend()
+        client = backend.client()
+
+        # Pretend that the client was created in a parent process.
+        backend._client_pid = -1
+
+        self.assertIsNot(client, backend.client())
+        self.assertEqual(2, backend.metrics()['clients_created'])
+
+
+class FakeS3Client:
+    """
+    Records the multipart upload calls made by S3Backend.write_stream.
+    """
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.calls = []
+        self.parts = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self.calls.append('put_object')
+        self.body = Body.read()
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.calls.append('create_multipart_upload')
+        return {'UploadId': 'upload-id'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise IOError("Upload failed")
+
+        self.parts[PartNumber] = Body
+        return {'ETag': 'etag-{}'.format(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.calls.append('complete_multipart_upload')
+        self.completed_parts = MultipartUpload['Parts']
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.calls.append('abort_multipart_upload')
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        self.calls.append('generate_presigned_url')
+        return 'https://example.com/{}?{}'.format(Params['Key'], len(self.calls))
+
+
+class FakePaginator:
+    """
+    Returns list_objects_v2 results in pages of two keys.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def paginate(self, Bucket, Prefix='', Delimiter=None):
+        keys = [k for k in self.keys if k.startswith(Prefix)]
+        for i in range(0, len(keys), 2):
+            yield {'Contents': [{'Key': k} for k in keys[i:i + 2]]}
+
+
+class S3UploadTest(unittest.TestCase):
+
+    def create_backend(self, client):
+        backend = S3Backend(upload_part_size=4, upload_concurrency=2)
+        backend._client = client
+        backend._client_pid = os.getpid()
+        return backend
+
+    def test_small_stream_uses_single_put(self):
+        client = FakeS3Client()
+        self.create_backend(client).write_stream('bucket', 'key', BytesIO(b'abc'))
+
+        self.assertEqual(['put_object'], client.calls)
+        self.assertEqual(b'abc', client.body)
+
+    def test_multipart_upload(self):
+        client = FakeS3Client()
+        self.create_backend(client).write_stream('bucket', 'key', BytesIO(b'0123456789'))
+
+        self.assertEqual(['create_multipart_upload', 'complete_multipart_upload'], client.calls)
+        self.assertEqual([1, 2, 3], [p['PartNumber'] for p in client.completed_parts])
+        self.assertEqual(b'0123456789', b''.join(client.parts[n] for n in [1, 2, 3]))
+
+    def test_failed_multipart_upload_is_aborted(self):
+        client = FakeS3Client(fail_part=2)
+
+        with self.assertRaises(IOError):
+            self.create_backend(client).write_stream('bucket', 'key', BytesIO(b'0123456789'))
+
+        self.assertEqual(['create_multipart_upload', 'abort_multipart_upload'], client.calls)
+
+    def test_presigned_urls_are_cached(self):
+        client = FakeS3Client()
+        backend = self.create_backend(client)
+
+        url = backend.presigned_url('bucket', 'key', 'text/plain', 300)
+        self.assertEqual(url, backend.presigned_url('bucket', 'key', 'text/plain', 300))
+        self.assertNotEqual(url, backend.presigned_url('bucket', 'other', 'text/plain', 300))
+        self.assertEqual(2, client.calls.count('generate_presigned_url'))
+
+        # A url that is close to expiring is replaced.
+        url, _ = backend.presigned_urls[('bucket', 'key', 'text/plain', 300)]
+        backend.presigned_urls[('bucket', 'key', 'text/plain', 300)] = (url, time.time() + 10)
+        self.assertNotEqual(url, backend.presigned_url('bucket', 'key', 'text/plain', 300))
+
+    def test_listings_follow_continuation_tokens(self):
+        client = FakeS3Client()
+        client.get_paginator = lambda name: FakePaginator(['a/1', 'a/2', 'a/3', 'b'])
+        backend = self.create_backend(client)
+
+        self.assertEqual(['a/1', 'a/2', 'a/3', 'b'], list(backend.list_all('bucket')))
+        self.assertEqual(([], ['a/1', 'a/2', 'a/3']), backend.list_folder('bucket', 'a/'))
+
+    def test_conditional_read(self):
+        client = FakeS3Client()
+
+        def get_object(Bucket, Key, IfNoneMatch=None):
+            if IfNoneMatch == '"1"':
+                raise ClientError({'Error': {'Code': '304'}}, 'GetObject')
+            return {'Body': BytesIO(b'content'), 'ETag': '"1"'}
+
+        client.get_object = get_object
+        backend = self.create_backend(client)
+
+        self.assertEqual((b'content', '"1"'), backend.read_if_changed('bucket', 'key', None))
+        self.assertIsNone(backend.read_if_changed('bucket', 'key', '"1"'))
+
+    def test_read_of_replaced_file(self):
+        client = FakeS3Client()
+
+        def get_object(Bucket, Key, IfMatch=None):
+            if IfMatch is not None and IfMatch != '"2"':
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'GetObject')
+            return {'Body': BytesIO(b'content')}
+
+        client.get_object = get_object
+        backend = self.create_backend(client)
+
+        self.assertEqual(b'content', backend.read_stream('bucket', 'key', etag='"2"').read())
+        with self.assertRaises(FileChangedError):
+            backend.read_stream('bucket', 'key', etag='"1"')
+
+
+class LocalBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.backend = LocalBackend(self.folder.name)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_read_write_delete(self):
+        self.backend.write('bucket', 'a/b.txt', b'content')
+        self.assertEqual(b'content', self.backend.read('bucket', 'a/b.txt'))
+        self.assertEqual(7, self.backend.stat('bucket', 'a/b.txt')['size'])
+
+        with self.backend.read_stream('bucket', 'a/b.txt') as f:
+            self.assertEqual(b'content', f.read())
+
+        self.backend.delete('bucket', 'a/b.txt')
+        self.assertIsNone(self.backend.stat('bucket', 'a/b.txt'))
+
+    def test_list_folder(self):
+        self.backend.write('bucket', 'top.txt', b'')
+        self.backend.write('bucket', 'a/b.txt', b'')
+        self.backend.write('bucket', 'a/c/d.txt', b'')
+
+        self.assertEqual((['a/'], ['top.txt']), self.backend.list_folder('bucket', '/'))
+        self.assertEqual((['a/c/'], ['a/b.txt']), self.backend.list_folder('bucket', 'a/'))
+        self.assertEqual(([], []), self.backend.list_folder('bucket', 'missing/'))
+
+    def test_list_all(self):
+        self.backend.write('bucket', 'top.txt', b'')
+        self.backend.write('bucket', 'a/b.txt', b'')
+        self.backend.write('bucket', 'a/c/d.txt', b'')
+
+        self.assertEqual(['top.txt', 'a/b.txt', 'a/c/d.txt'], list(self.backend.list_all('bucket')))
+
+    def test_keys_can_not_leave_the_bucket(self):
+        with self.assertRaises(ValueError):
+            self.backend.read('bucket', '../secret.txt')
+
+
+class ListingCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.backend = LocalBackend(self.folder.name)
+        self.backend.write('bucket', 'top.txt', b'')
+        self.backend.write('bucket', 'a/b.txt', b'')
+        self.cache = ListingCache(lambda: self.backend, ttl=60)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_prefix_tree(self):
+        tree = PrefixTree(['top.txt', 'a/b.txt', 'a/c/d.txt', 'e/'])
+
+        self.assertEqual((['a/', 'e/'], ['top.txt']), tree.list_folder('/'))
+        self.assertEqual((['a/c/'], ['a/b.txt']), tree.list_folder('a/'))
+        self.assertEqual(([], []), tree.list_folder('missing/'))
+
+        tree.remove('a/b.txt')
+        self.assertEqual((['a/c/'], []), tree.list_folder('a/'))
+
+    def test_listings_are_served_from_memory(self):
+        self.assertEqual((['a/'], ['top.txt']), self.cache.list_folder('bucket', '/'))
+
+        self.cache.crawl('bucket')
+        self.backend.write('bucket', 'unknown.txt', b'')
+        self.assertEqual((['a/'], ['top.txt']), self.cache.list_folder('bucket', '/'))
+
+        self.cache.added('bucket', 'a/new.txt')
+        self.cache.removed('bucket', 'a/b.txt')
+        self.assertEqual(([], ['a/new.txt']), self.cache.list_folder('bucket', 'a/'))
+
+    def test_changes_during_crawl_are_kept(self):
+        list_all = self.backend.list_all
+
+        def list_all_and_write(bucket_name):
+            keys = list(list_all(bucket_name))
+            self.cache.added(bucket_name, 'during.txt')
+            return keys
+
+        self.backend.list_all = list_all_and_write
+        self.cache.crawl('bucket')
+
+        self.assertEqual(['during.txt', 'top.txt'], self.cache.list_folder('bucket', '/')[1])
+
+    def test_tree_from_another_backend_is_not_used(self):
+        self.cache.crawl('bucket')
+        self.assertFalse(self.cache.is_stale('bucket'))
+
+        self.backend = LocalBackend(self.folder.name)
+        self.assertTrue(self.cache.is_stale('bucket'))
+
+
+class CountingLocalBackend(LocalBackend):
+    """
+    Counts the conditional reads made by the notes cache.
+    """
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.reads = []
+
+    def read_if_changed(self, bucket_name, key, etag):
+        result = super().read_if_changed(bucket_name, key, etag)
+        self.reads.append('changed' if result else 'not modified')
+        return result
+
+
+class NotesCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.backend = CountingLocalBackend(os.path.join(self.folder.name, 'storage'))
+        self.backend.write('notes', 'a.md', b'# A')
+        self.cache_folder = os.path.join(self.folder.name, 'cache')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def create_cache(self, ttl=30):
+        return NotesCache(lambda: self.backend, 'notes', cache_folder=self.cache_folder, ttl=ttl)
+
+    def test_notes_are_rendered_and_cached(self):
+        cache = self.create_cache()
+        note = cache.get('a.md')
+
+        self.assertEqual('# A', note.text)
+        self.assertEqual('<h1>A</h1>', note.html)
+        self.assertIs(note, cache.get('a.md'))
+        self.assertEqual(['changed'], self.backend.reads)
+
+    def test_notes_are_validated_after_ttl(self):
+        cache = self.create_cache(ttl=0)
+        cache.get('a.md')
+        cache.get('a.md')
+        self.assertEqual(['changed', 'not modified'], self.backend.reads)
+
+        self.backend.write('notes', 'a.md', b'# Changed')
+        self.assertEqual('<h1>Changed</h1>', cache.get('a.md').html)
+
+    def test_notes_are_loaded_from_disk(self):
+        self.create_cache().get('a.md')
+
+        note = self.create_cache().get('a.md')
+        self.assertEqual('<h1>A</h1>', note.html)
+        self.assertEqual(['changed', 'not modified'], self.backend.reads)
+
+    def test_missing_notes(self):
+        cache = self.create_cache(ttl=0)
+        self.assertIsNone(cache.get('missing.md'))
+
+        cache.get('a.md')
+        self.backend.delete('notes', 'a.md')
+        self.assertIsNone(cache.get('a.md'))
+        self.assertEqual([], list(cache.entries))
+        self.assertIsNone(cache.load_from_disk('a.md'))
+
+    def test_cache_is_bounded(self):
+        self.backend.write('notes', 'b.md', b'# B')
+        cache = NotesCache(lambda: self.backend, 'notes', max_bytes=20)
+        cache.get('a.md')
+        cache.get('b.md')
+
+        self.assertEqual(['b.md'], list(cache.entries))
+
+
+class NotesSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.backend = CountingLocalBackend(os.path.join(self.folder.name, 'storage'))
+        self.backend.write('notes', 'a.md', b'# A')
+        self.backend.write('notes', 'b/c.md', b'# C')
+        self.mirror_folder = os.path.join(self.folder.name, 'mirror')
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_only_changed_notes_are_downloaded(self):
+        self.assertEqual((['a.md', 'b/c.md'], []),
+                         sync_notes(self.backend, 'notes', self.mirror_folder))
+        self.assertEqual(([], []), sync_notes(self.backend, 'notes', self.mirror_folder))
+
+        self.backend.write('notes', 'a.md', b'# Changed')
+        self.backend.delete('notes', 'b/c.md')
+        self.assertEqual((['a.md'], ['b/c.md']),
+                         sync_notes(self.backend, 'notes', self.mirror_folder))
+        self.assertEqual(3, len(self.backend.reads))
+
+    def test_failed_sync_is_logged(self):
+        def failing_sync(*args, **kwargs):
+            raise IOError("Sync failed")
+
+        previous_sync = redwood.sync_notes
+        redwood.sync_notes = failing_sync
+        self.addCleanup(setattr, redwood, 'sync_notes', previous_sync)
+
+        with self.assertLogs(app.logger, 'ERROR') as logs:
+            redwood.sync_notes_mirror()
+
+        self.assertIn('Sync failed', logs.output[0])
+
+    def test_mirror(self):
+        mirror = NotesMirror(self.mirror_folder, reload_interval=0)
+        self.assertFalse(mirror.available())
+
+        sync_notes(self.backend, 'notes', self.mirror_folder)
+        self.assertTrue(mirror.available())
+        self.assertEqual((['b/'], ['a.md']), mirror.list_folder('/'))
+        self.assertEqual('<h1>C</h1>', mirror.get('b/c.md').html)
+        self.assertIsNone(mirror.get('missing.md'))
+
+
+class IdentityCacheTest(unittest.TestCase):
+
+    def test_claims_are_cached_until_they_expire(self):
+        cache = IdentityCache()
+        cache.put('secret', 'token', {'username': 'henrik', 'exp': time.time() + 60})
+        cache.put('secret', 'expired', {'username': 'henrik', 'exp': time.time() - 1})
+
+        self.assertEqual('henrik', cache.get('secret', 'token')['username'])
+        self.assertIsNone(cache.get('other secret', 'token'))
+        self.assertIsNone(cache.get('secret', 'expired'))
+        self.assertNotIn(cache.key('secret', 'expired'), cache.entries)
+
+    def test_cache_is_bounded(self):
+        cache = IdentityCache(max_entries=2)
+        for token in ['a', 'b', 'c']:
+            cache.put('secret', token, {'exp': time.time() + 60})
+
+        self.assertIsNone(cache.get('secret', 'a'))
+        self.assertIsNotNone(cache.get('secret', 'c'))
+
+
+class PasswordTest(unittest.TestCase):
+
+    def test_pbkdf2(self):
+        password_hash = hash_password('foo', 'pbkdf2_sha256', {'iterations': 1000})
+
+        self.assertTrue(password_hash.startswith('pbkdf2_sha256$1000$'))
+        self.assertTrue(verify_password('foo', password_hash))
+        self.assertFalse(verify_password('bar', password_hash))
+        self.assertFalse(needs_rehash(password_hash, 'pbkdf2_sha256', {'iterations': 1000}))
+        self.assertTrue(needs_rehash(password_hash, 'pbkdf2_sha256', {'iterations': 2000}))
+
+    @unittest.skipUnless(SCRYPT_AVAILABLE, "hashlib.scrypt needs OpenSSL 1.1")
+    def test_scrypt(self):
+        password_hash = hash_password('foo', 'scrypt', {'n': 2**10, 'r': 8, 'p': 1})
+
+        self.assertTrue(verify_password('foo', password_hash))
+        self.assertFalse(verify_password('bar', password_hash))
+        self.assertTrue(needs_rehash(password_hash, 'pbkdf2_sha256', {'iterations': 1000}))
+
+    def test_legacy_sha256(self):
+        password_hash = hashlib.sha256(b'123456789foo').hexdigest()
+
+        self.assertTrue(verify_password('foo', password_hash, legacy_salt='123456789'))
+        self.assertFalse(verify_password('foo', password_hash, legacy_salt='other'))
+        self.assertTrue(needs_rehash(password_hash))
+        self.assertFalse(verify_password('foo', None))
+
+    def test_benchmark(self):
+        parameters, elapsed = benchmark('pbkdf2_sha256', 5)
+        self.assertGreaterEqual(parameters['iterations'], 1000)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def check_sliding_window(self, store):
+        limiter = RateLimiter(store, limit=4, period=10)
+
+        for i in range(4):
+            self.assertIsNone(limiter.retry_after('key', 100 + i))
+            limiter.hit('key', 100 + i)
+
+        self.assertEqual(5, limiter.retry_after('key', 105))
+        self.assertEqual(10, limiter.retry_after('key', 100))
+        self.assertIsNone(limiter.retry_after('other', 105))
+
+        # Half of the previous window is inside the sliding window, so two
+        # more hits are allowed.
+        self.assertIsNone(limiter.retry_after('key', 115))
+        limiter.hit('key', 115)
+        limiter.hit('key', 115)
+        self.assertEqual(1, limiter.retry_after('key', 115))
+
+    def test_memory_store(self):
+        self.check_sliding_window(MemoryStore())
+
+    def test_sqlite_store(self):
+        folder = tempfile.TemporaryDirectory()
+        self.addCleanup(folder.cleanup)
+
+        self.check_sliding_window(SqliteStore(os.path.join(folder.name, 'ratelimit.sqlite3')))
+
+    def test_memory_store_is_bounded(self):
+        store = MemoryStore(max_keys=2)
+        for key in ['a', 'b', 'c']:
+            store.increment(key, 1)
+
+        self.assertEqual(['b', 'c'], list(store.counters))
+
+
+class AssetStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.folder.name, 'static')
+        os.makedirs(os.path.join(self.source, 'styles'))
+        with open(os.path.join(self.source, 'styles', 'site.css'), 'w') as f:
+            f.write('body { margin: 0; }\n' * 100)
+        with open(os.path.join(self.source, 'image.png'), 'wb') as f:
+            f.write(b'\x89PNG' + bytes(range(256)) * 4)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_build_folder(self):
+        build_folder = os.path.join(self.folder.name, 'build')
+        manifest = write_assets(build_folder, self.source)
+
+        self.assertIn('gzip', manifest['styles/site.css']['encodings'])
+        self.assertEqual(['identity'], manifest['image.png']['encodings'])
+
+        store = AssetStore(self.source, build_folder, max_memory_size=1024)
+        path = store.url('styles/site.css')[len('/assets/'):]
+        self.assertEqual(path, manifest['styles/site.css']['path'])
+        self.assertIn('gzip', store.get(path).variants)
+
+        # The image is larger than max_memory_size, so it is read from disk.
+        image = store.get(manifest['image.png']['path'])
+        self.assertEqual({'identity'}, set(image.files))
+
+    def test_stale_build_folder(self):
+        build_folder = os.path.join(self.folder.name, 'build')
+        manifest = write_assets(build_folder, self.source)
+        built_path = '/assets/' + manifest['styles/site.css']['path']
+
+        # A copy with a new modification time but the same content is fine.
+        os.utime(os.path.join(self.source, 'styles', 'site.css'), ns=(0, 0))
+        self.assertEqual(built_path, AssetStore(self.source, build_folder).url('styles/site.css'))
+
+        with open(os.path.join(self.source, 'styles', 'site.css'), 'w') as f:
+            f.write('body { margin: 1px; }\n')
+        store = AssetStore(self.source, build_folder)
+        self.assertNotEqual(built_path, store.url('styles/site.css'))
+        self.assertIsNotNone(store.get(store.url('styles/site.css')[len('/assets/'):]))
+
+        write_assets(build_folder, self.source)
+        with open(os.path.join(self.source, 'new.js'), 'w') as f:
+            f.write('var a = 1;\n')
+        self.assertRegex(AssetStore(self.source, build_folder).url('new.js'), r'^/assets/new\.')
+
+    def test_compiled_at_startup_without_build_folder(self):
+        store = AssetStore(self.source, os.path.join(self.folder.name, 'missing'))
+
+        self.assertRegex(store.url('styles/site.css'), r'^/assets/styles/site\.[0-9a-f]{12}\.css$')
+        self.assertEqual('/static/unknown.css', store.url('unknown.css'))
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_parse_import_times(self):
+        output = ("import time: self [us] | cumulative | imported package\n"
+                  "import time:       120 |        120 |   json.decoder\n"
+                  "import time:       300 |        420 | json\n")
+
+        self.assertEqual([('json.decoder', 120, 120), ('json', 300, 420)],
+                         parse_import_times(output))
+
+    def test_heavy_dependencies_are_imported_lazily(self):
+        profile = profile_startup('redwood')
+
+        self.assertEqual([], profile["loaded"])
+
+    @unittest.skipUnless(IMPORT_TIMES_AVAILABLE, "-X importtime needs Python 3.7")
+    def test_import_times(self):
+        profile = profile_startup('redwood')
+
+        self.assertIn('redwood', [name for name, _, _ in profile["imports"]])
+
+
+class PhotoRegistryTest(unittest.TestCase):
+
+    def write_json(self, filename, data):
+        with open(os.path.join(self.folder.name, filename), 'w') as f:
+            json.dump(data, f)
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.write_json('collections.json', [
+            {"slug": "a", "description": "A", "collection": "a.json", "image": "1.jpg"}])
+        self.write_json('a.json', {"name": "a", "images": ["1.jpg", "2.jpg"]})
+        self.registry = PhotoRegistry(os.path.join(self.folder.name, 'collections.json'),
+                                      reload_interval=0)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_image_entries_with_sizes(self):
+        image = create_image_dict('a', {"name": "1.jpg", "width": 2000, "height": 1000,
+                                        "widths": [480, 960]})
+
+        self.assertEqual(2000, image['width'])
+        self.assertEqual('https://rainforestphotos.s3.amazonaws.com/a/w480/1.webp 480w, '
+                         'https://rainforestphotos.s3.amazonaws.com/a/w960/1.webp 960w',
+                         image['srcset_webp'])
+        self.assertNotIn('srcset_webp', create_image_dict('a', '2.jpg'))
+
+    def test_update_collection_file(self):
+        filename = os.path.join(self.folder.name, 'a.json')
+        update_collection_file(filename, 'a', [
+            {"name": "3.jpg", "width": 600, "height": 400, "widths": resized_widths(600)},
+            {"name": "2.jpg", "width": 300, "height": 200, "widths": resized_widths(300)}])
+
+        self.registry.refresh(force=True)
+        images = self.registry.get_collection('a')['images']
+        self.assertEqual(['1.jpg', '2.jpg', '3.jpg'], [image['name'] for image in images])
+        self.assertIsNone(images[0]['width'])
+        self.assertEqual(200, images[1]['height'])
+        self.assertIn('/a/w300/2.jpg 300w', images[1]['srcset_jpeg'])
+        self.assertIn('/a/w480/3.jpg 480w', images[2]['srcset_jpeg'])
+
+    def test_lookups(self):
+        collection_list = self.registry.get_collection_list()
+        self.assertEqual('/photos/a', collection_list[0]['url'])
+
+        collection = self.registry.get_collection('a')
+        self.assertEqual(['1.jpg', '2.jpg'], [image['name'] for image in collection['images']])
+        self.assertEqual('/photos/a/2.jpg', self.registry.get_image('a', '2.jpg')['url'])
+        self.assertIsNone(self.registry.get_image('a', '3.jpg'))
+        self.assertIsNone(self.registry.get_collection('b'))
+
+    def test_reload(self):
+        self.registry.refresh()
+        self.assertFalse(self.registry.refresh(force=True))
+
+        self.write_json('a.json', {"name": "a", "images": ["1.jpg", "2.jpg", "3.jpg"]})
+        self.assertTrue(self.registry.refresh(force=True))
+        self.assertIsNotNone(self.registry.get_image('a', '3.jpg'))
+
 if __name__ == '__main__':
     unittest.main()
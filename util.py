@@ -1,4 +1,6 @@
+import hashlib
 import json
+import os
 
 def load_json(filename):
     """
@@ -8,3 +10,23 @@ def load_json(filename):
         contents = f.read()
 
     return json.loads(contents)
+
+def file_signature(filename):
+    """
+    Returns a (modification time, size) tuple for the file with the given
+    filename. Returns None if the file does not exist. Used to detect that
+    a file has changed without having to read it.
+    """
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return None
+
+    return (stat.st_mtime_ns, stat.st_size)
+
+def file_digest(filename):
+    """
+    Returns the sha1 hex digest of the contents of the given file.
+    """
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
@@ -1,5 +1,221 @@
+from util import file_signature, file_digest
+import json
 import os
+import threading
+import time
+
+WRITING_FOLDER = "writing/"
+
+# Use the fenced_code markdown extension to get support for newlines
+# in code blocks.
+MARKDOWN_EXTENSIONS = ['markdown.extensions.fenced_code']
+
+# The format version of the precompiled writings artifact.
+ARTIFACT_VERSION = 1
 
 def load_writing(filename):
-    with open(os.path.join("writing/", filename)) as f:
+    with open(os.path.join(WRITING_FOLDER, filename)) as f:
         return f.read()
+
+def render_markdown_html(text):
+    """
+    Converts markdown text to html.
+    """
+    # Markdown takes a long time to import and most workers only serve the
+    # prerendered writings, so it is imported on first use.
+    from markdown import markdown
+
+    return markdown(text, extensions=MARKDOWN_EXTENSIONS)
+
+def writing_slug(filename):
+    """
+    Returns the url slug for a writing. The slug is the filename without the
+    .md extension and with underscores replaced by dashes.
+    """
+    return os.path.splitext(filename)[0].replace('_', '-')
+
+def writing_title(text, filename):
+    """
+    Returns the title of a writing, which is the first level one heading in
+    the markdown text. Falls back to the slug if there is no such heading.
+    """
+    for line in text.splitlines():
+        if line.startswith('# '):
+            return line[2:].strip()
+
+    return writing_slug(filename)
+
+def compile_writing(folder, filename):
+    """
+    Reads a markdown writing and converts it to html. Returns a dict with the
+    file signature and digest, the slug, the title and the html.
+    """
+    path = os.path.join(folder, filename)
+    signature = file_signature(path)
+
+    with open(path) as f:
+        text = f.read()
+
+    return {"filename": filename,
+            "signature": signature,
+            "digest": file_digest(path),
+            "slug": writing_slug(filename),
+            "title": writing_title(text, filename),
+            "html": render_markdown_html(text)}
+
+def list_writing_filenames(folder):
+    """
+    Returns the sorted filenames of the markdown files in the folder.
+    """
+    return sorted(entry.name for entry in os.scandir(folder)
+                  if entry.is_file() and entry.name.endswith('.md'))
+
+def write_writings_artifact(artifact_filename, folder=WRITING_FOLDER):
+    """
+    Converts all the writings in the folder to html and writes them to a
+    single json artifact.
+    """
+    writings = [compile_writing(folder, filename)
+                for filename in list_writing_filenames(folder)]
+
+    directory = os.path.dirname(artifact_filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    temporary_filename = artifact_filename + '.tmp'
+    with open(temporary_filename, 'w') as f:
+        json.dump({"version": ARTIFACT_VERSION, "writings": writings}, f)
+    os.replace(temporary_filename, artifact_filename)
+
+    return writings
+
+def load_writings_artifact(artifact_filename, folder=WRITING_FOLDER):
+    """
+    Loads the writings artifact written by write_writings_artifact. Returns a
+    dict that maps a filename to the compiled writing for every writing that
+    is still up to date. Returns an empty dict if the artifact is missing or
+    has the wrong format version.
+    """
+    try:
+        with open(artifact_filename) as f:
+            artifact = json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+    if artifact.get("version") != ARTIFACT_VERSION:
+        return {}
+
+    result = {}
+    for writing in artifact["writings"]:
+        path = os.path.join(folder, writing["filename"])
+        signature = file_signature(path)
+
+        if signature is None:
+            continue
+
+        if list(signature) != writing["signature"] and file_digest(path) != writing["digest"]:
+            continue
+
+        writing["signature"] = signature
+        result[writing["filename"]] = writing
+
+    return result
+
+
+class WritingStore:
+    """
+    Keeps the html for all the markdown writings in memory so that markdown
+    is only converted when a writing has changed.
+
+    The writing folder is checked for new and changed files at most once
+    every reload_interval seconds. If an artifact filename is given the
+    store starts from the precompiled html in the artifact.
+    """
+
+    def __init__(self, folder=WRITING_FOLDER, reload_interval=5, artifact_filename=None):
+        self.folder = folder
+        self.reload_interval = reload_interval
+        self.artifact_filename = artifact_filename
+        self.version = 0
+
+        # Maps a filename to the compiled writing.
+        self.writings = {}
+        self.by_slug = {}
+        self.listeners = []
+        self.last_checked = None
+        self.lock = threading.Lock()
+
+    def add_listener(self, listener):
+        """
+        Adds a listener that is called with the store and the list of changed
+        filenames every time the store has been reloaded.
+        """
+        self.listeners.append(listener)
+
+    def refresh(self, force=False):
+        """
+        Converts the writings that are new or have changed since they were
+        last converted. Returns True if anything changed.
+        """
+        now = time.monotonic()
+        if not force and self.last_checked is not None:
+            if now - self.last_checked < self.reload_interval:
+                return False
+
+        with self.lock:
+            self.last_checked = now
+            changed = []
+            writings = dict(self.writings)
+
+            if not writings and self.artifact_filename:
+                writings = load_writings_artifact(self.artifact_filename, self.folder)
+                changed.extend(writings)
+
+            filenames = list_writing_filenames(self.folder)
+            for filename in filenames:
+                signature = file_signature(os.path.join(self.folder, filename))
+                writing = writings.get(filename)
+
+                if writing is None or writing["signature"] != signature:
+                    writings[filename] = compile_writing(self.folder, filename)
+                    changed.append(filename)
+
+            for filename in list(writings):
+                if filename not in filenames:
+                    del writings[filename]
+                    changed.append(filename)
+
+            if changed:
+                self.writings = writings
+                self.by_slug = {w["slug"]: w for w in writings.values()}
+                self.version += 1
+
+        if changed:
+            for listener in self.listeners:
+                listener(self, changed)
+
+        return bool(changed)
+
+    def current_version(self):
+        """
+        Returns the version of the store, which changes every time any of the
+        writings is converted again.
+        """
+        self.refresh()
+        return self.version
+
+    def get(self, filename):
+        """
+        Returns the compiled writing for the given filename or None if there
+        is no such writing.
+        """
+        self.refresh()
+        return self.writings.get(filename)
+
+    def get_by_slug(self, slug):
+        """
+        Returns the compiled writing with the given slug or None if there is
+        no such writing.
+        """
+        self.refresh()
+        return self.by_slug.get(slug)